@@ -42,4 +42,12 @@ CREATE TABLE IF NOT EXISTS chat_history (
 -- 简单地尝试创建索引，如果存在则忽略错误
 -- 注意：MySQL不支持CREATE INDEX IF NOT EXISTS语法
 CREATE INDEX idx_chat_history_created_at ON chat_history (created_at);
-CREATE INDEX idx_chat_history_user_input ON chat_history (user_input(255));
+
+-- 全文索引，ngram解析器按两个字切分，支持中文关键词检索
+-- 服务运行时只检查该索引是否存在，不会自动添加；旧版本创建的数据库重新运行create_database.py完成迁移
+-- 表很大时添加索引需要较长时间，建议在低峰期执行
+ALTER TABLE chat_history ADD FULLTEXT INDEX ft_chat_history (user_input, ai_response, image_description) WITH PARSER ngram;
+
+-- 旧版本的user_input前缀索引无法用于关键词检索，还会拖慢写入，已由全文索引取代
+-- 索引不存在时会报错，可以忽略
+DROP INDEX idx_chat_history_user_input ON chat_history;
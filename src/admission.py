@@ -0,0 +1,140 @@
+"""准入控制模块，限制每个上游服务商的并发请求数，并为等待的请求提供有界队列"""
+
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from .config import CONFIG, WORKERS_ENV
+from .metrics import METRICS
+
+
+class AdmissionRejected(Exception):
+    """上游繁忙，请求未被接纳（排队已满或排队超时）"""
+
+    def __init__(self, provider: str, reason: str, retry_after: int = 1):
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"服务繁忙，请稍后再试（{provider}: {reason}）")
+
+
+class AdmissionController:
+    """单个上游服务商的并发限制
+
+    同时最多max_concurrency个请求访问上游，其余请求按到达顺序排队；
+    排队人数达到max_queue时新请求立即被拒绝，排队超过queue_timeout秒的请求也会被拒绝。
+    指标名以admission_{name}为前缀。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+
+    def _reject(self, reason: str):
+        METRICS.incr(f'admission_{self.name}_rejected')
+        raise AdmissionRejected(self.name, reason, retry_after=max(1, int(self.queue_timeout)))
+
+    def check(self):
+        """排队已满时立即拒绝（用于在返回流式响应之前快速失败）"""
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self._reject('queue_full')
+
+    @asynccontextmanager
+    async def slot(self, timeout: Optional[float] = None):
+        """占用一个上游并发名额
+
+        Args:
+            timeout (float): 排队等待的最长时间（秒），默认使用queue_timeout
+
+        Raises:
+            AdmissionRejected: 排队已满或等待超时
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        start = time.monotonic()
+        if self._semaphore.locked():
+            self.check()
+            self.waiting += 1
+            METRICS.set_gauge(f'admission_{self.name}_queue_depth', self.waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self._reject('queue_timeout')
+            finally:
+                self.waiting -= 1
+                METRICS.set_gauge(f'admission_{self.name}_queue_depth', self.waiting)
+        else:
+            # 有空闲名额时直接占用，不会挂起
+            await self._semaphore.acquire()
+
+        METRICS.incr(f'admission_{self.name}_admitted')
+        METRICS.incr(f'admission_{self.name}_wait_seconds', time.monotonic() - start)
+        self.in_flight += 1
+        METRICS.set_gauge(f'admission_{self.name}_in_flight', self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            METRICS.set_gauge(f'admission_{self.name}_in_flight', self.in_flight)
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回当前并发、排队和平均等待时间"""
+        admitted = METRICS.get(f'admission_{self.name}_admitted')
+        wait_seconds = METRICS.get(f'admission_{self.name}_wait_seconds')
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queue_depth': self.waiting,
+            'admitted': admitted,
+            'rejected': METRICS.get(f'admission_{self.name}_rejected'),
+            'avg_wait_ms': round(wait_seconds / admitted * 1000, 2) if admitted else 0.0
+        }
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def _worker_count() -> int:
+    """当前服务的工作进程数（单进程模式下为1）"""
+    try:
+        return max(1, int(os.environ.get(WORKERS_ENV, 1)))
+    except ValueError:
+        return 1
+
+
+def get_admission(provider: str) -> AdmissionController:
+    """获取上游服务商（deepseek、kimi、dashscope）的准入控制器
+
+    配置中的上限是所有工作进程合计的值，多进程模式下每个进程只使用其中的一份，
+    所有进程加起来不会超过配置的并发数和排队数。
+    """
+    controller = _controllers.get(provider)
+    if controller is None:
+        with _controllers_lock:
+            controller = _controllers.get(provider)
+            if controller is None:
+                settings = CONFIG['admission'][provider]
+                workers = _worker_count()
+                controller = AdmissionController(
+                    provider,
+                    max_concurrency=max(1, settings['max_concurrency'] // workers),
+                    max_queue=max(1, settings['max_queue'] // workers),
+                    queue_timeout=CONFIG['admission']['queue_timeout']
+                )
+                _controllers[provider] = controller
+    return controller
+
+
+def admission_stats() -> Dict[str, Any]:
+    """返回所有已创建的准入控制器的统计信息"""
+    return {name: controller.stats() for name, controller in _controllers.items()}
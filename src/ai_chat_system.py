@@ -1,25 +1,34 @@
 # -*- coding: utf-8 -*-
 """AI聊天系统模块"""
 
+import asyncio
+import hashlib
 import json
 import logging
 import os
 import time
 import threading
 import base64
+import binascii
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Tuple
-from io import BytesIO
 
-import requests
 from mysql.connector import Error
-from PIL import Image
-from openai import OpenAI, APITimeoutError
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
 
+from src.admission import AdmissionRejected, get_admission
+from src.cache import TTLCache
+from src.http_clients import get_async_client, get_session
+from src.image_pipeline import prepare_image, prepare_image_async
 from src.config import CONFIG
 from src.database import get_connection, DatabaseManager
-from src.shared_utils import count_tokens, estimate_tokens
+from src.session_store import SessionManager
+from src.metrics import METRICS, record_token_usage, record_token_usage_async
+from src.shared_state import SharedStateStore, get_shared_state
+from src.shared_utils import (classify_search_query, count_tokens, estimate_tokens, normalize_query,
+                               trim_messages_to_budget, should_search as util_should_search)
 
 # 全局变量用于跟踪Token使用（需要在web_server.py中更新这些值）
 try:
@@ -29,12 +38,18 @@ except ImportError:
     INPUT_TOKENS = 0
     OUTPUT_TOKENS = 0
 
+# 同步聊天路径中并行执行图片识别、搜索等增强步骤的线程池
+_ENRICHMENT_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="enrichment")
+
 
 class AIChatSystem:
     """AI聊天系统类，使用单例模式实现"""
 
     _instance = None
     _lock = threading.Lock()
+    # 搜索结果和图片描述缓存，所有实例共享（搜索和图片识别方法是静态方法）
+    _search_cache = None
+    _image_cache = None
 
     def __init__(self):
         """初始化AI聊天系统"""
@@ -62,13 +77,45 @@ class AIChatSystem:
             base_url=CONFIG['api']['base_url'],
             timeout=30.0  # 添加超时设置
         )
-        messages = [{"role": "system", "content": system_prompt}]
+        # 异步客户端，供FastAPI等事件循环环境使用，避免阻塞事件循环
+        async_client = AsyncOpenAI(
+            api_key=CONFIG['api']['key'],
+            base_url=CONFIG['api']['base_url'],
+            timeout=30.0
+        )
+        # 多工作进程模式下，会话历史和回复缓存保存在共享状态中
+        store = get_shared_state()
+
+        # 每个会话（QQ群、用户等）拥有独立的消息历史
+        sessions = SessionManager(
+            system_prompt,
+            max_sessions=CONFIG['sessions']['max_sessions'],
+            ttl=CONFIG['sessions']['ttl'],
+            max_messages=CONFIG['sessions']['max_messages'],
+            max_bytes=CONFIG['sessions']['max_bytes'],
+            store=store
+        )
+
+        # 重复问题的回复缓存（需要在配置中开启）
+        response_cache = TTLCache(
+            'response_cache',
+            max_entries=CONFIG['response_cache']['max_entries'],
+            ttl=CONFIG['response_cache']['ttl'],
+            store=store
+        )
 
         # 确保赋值成功
         self.db = db
         self.system_prompt = system_prompt
         self.client = client
-        self.messages = messages
+        self.async_client = async_client
+        self.sessions = sessions
+        self.response_cache = response_cache
+
+    @property
+    def messages(self):
+        """默认会话的消息历史（兼容旧的单会话调用方式）"""
+        return self.sessions.get().snapshot()
 
     @staticmethod
     def _build_headers(api_key):
@@ -95,9 +142,15 @@ class AIChatSystem:
         return False
 
     @staticmethod
-    def _make_api_request(url, headers, payload):
-        """发送API请求的通用方法"""
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+    def _make_api_request(provider, url, headers, payload):
+        """发送API请求的通用方法，复用服务商的长连接"""
+        response = get_session(provider).post(url, headers=headers, json=payload)
+        return response
+
+    @staticmethod
+    async def _make_api_request_async(provider, url, headers, payload):
+        """发送API请求的通用方法（异步版本）"""
+        response = await get_async_client(provider).post(url, headers=headers, json=payload)
         return response
 
     @staticmethod
@@ -109,98 +162,204 @@ class AIChatSystem:
 
     @staticmethod
     def compress_image(base64_data):
-        """压缩图片以减少大小"""
+        """压缩图片以减少大小（缩放到配置的最长边，并按目标大小选择JPEG质量）"""
+        if not CONFIG['image_pipeline']['enabled']:
+            return base64_data
         try:
-            # 提取纯base64数据
-            if ',' in base64_data:
-                base64_data = base64_data.split(',', 1)[1]
+            return prepare_image(base64_data)
+        except Exception as e:
+            print(f"图片压缩错误: {e}")
+            return base64_data.split(',')[-1] if ',' in base64_data else base64_data
 
-            # 解码base64
-            img_data = base64.b64decode(base64_data)
-            img = Image.open(BytesIO(img_data))
+    @staticmethod
+    async def compress_image_async(base64_data):
+        """压缩图片（异步版本，图片处理在线程池或进程池中执行）"""
+        if not CONFIG['image_pipeline']['enabled']:
+            return base64_data
+        try:
+            return await prepare_image_async(base64_data)
+        except Exception as e:
+            print(f"图片压缩错误: {e}")
+            return base64_data.split(',')[-1] if ',' in base64_data else base64_data
 
-            # 压缩图片：调整大小和质量
-            max_size = 1024
-            if max(img.size) > max_size:
-                img.thumbnail((max_size, max_size))
+    @staticmethod
+    def _build_vision_payload(image_data):
+        """构建阿里云通义VL MAX请求体
 
-            # 转换为JPEG格式减少大小
-            output_buffer = BytesIO()
-            img = img.convert("RGB")  # 确保是RGB格式
-            img.save(output_buffer, format="JPEG", quality=85)
-            compressed_data = output_buffer.getvalue()
+        Args:
+            image_data (str): Base64图片数据（可带data URI前缀）
 
-            # 重新编码为base64
-            return base64.b64encode(compressed_data).decode('utf-8')
+        Returns:
+            dict: 请求体
+        """
+        # 提取纯base64数据
+        if ',' in image_data:
+            base64_data = image_data.split(',', 1)[1]
+        else:
+            base64_data = image_data
 
-        except Exception as e:
-            print(f"图片压缩错误: {e}")
-            return base64_data.split(',')[-1] if ',' in base64_data else base64_data
+        return {
+            "model": "qwen-vl-max",
+            "input": {
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "image": f"data:image/jpeg;base64,{base64_data}"
+                            },
+                            {
+                                "text": "请详细描述这张图片的内容"
+                            }
+                        ]
+                    }
+                ]
+            },
+            "parameters": {
+                "max_tokens": 300
+            }
+        }
+
+    @staticmethod
+    def _parse_vision_response(response):
+        """解析阿里云通义VL MAX的响应
+
+        Args:
+            response: HTTP响应对象（requests或httpx）
+
+        Returns:
+            str: 图片描述或错误信息
+        """
+        if response.status_code != 200:
+            error_msg = f"阿里云API错误: {response.status_code} - {response.text}"
+            print(f"Aliyun API Error: {error_msg}")
+            return error_msg
+
+        result = response.json()
+        if "output" in result and "choices" in result["output"]:
+            content = result["output"]["choices"][0]["message"]["content"]
+            # 确保返回的是字符串而不是列表
+            if isinstance(content, list):
+                # 如果是列表，提取其中的文本内容
+                text_parts = []
+                for item in content:
+                    if isinstance(item, dict) and "text" in item:
+                        text_parts.append(item["text"])
+                    elif isinstance(item, str):
+                        text_parts.append(item)
+                return " ".join(text_parts)
+            return str(content)
+        else:
+            return "无法解析图片内容"
+
+    @classmethod
+    def get_image_cache(cls):
+        """获取图片描述缓存（首次使用时创建）
+
+        键为图片内容的哈希（sha256:...）或图片URL（url:...），
+        开启磁盘缓存时使用data/image_cache.db。
+        """
+        if cls._image_cache is None:
+            settings = CONFIG['image_cache']
+            if settings['disk_enabled']:
+                store = SharedStateStore(settings['disk_path'], max_entries=settings['disk_max_entries'])
+            else:
+                store = get_shared_state()
+            cls._image_cache = TTLCache(
+                'image_cache',
+                max_entries=settings['max_entries'],
+                ttl=settings['ttl'],
+                max_bytes=settings['max_bytes'],
+                size_of=lambda description: len(description.encode('utf-8')),
+                store=store
+            )
+        return cls._image_cache
+
+    @staticmethod
+    def _image_content_key(image_data):
+        """计算图片内容的缓存键
+
+        对解码后的图片字节求哈希，data URI前缀和换行不同的同一张图片得到相同的键。
+        """
+        base64_data = image_data.split(',', 1)[1] if ',' in image_data else image_data
+        try:
+            raw = base64.b64decode(base64_data)
+        except (binascii.Error, ValueError):
+            raw = base64_data.encode('utf-8')
+        return f"sha256:{hashlib.sha256(raw).hexdigest()}"
+
+    @staticmethod
+    def _lookup_image_cache(key):
+        """查询图片描述缓存，未开启缓存时返回None"""
+        if not CONFIG['image_cache']['enabled']:
+            return None
+        description = AIChatSystem.get_image_cache().get(key)
+        if description is not None:
+            print(f"图片描述缓存命中: {key[:24]}")
+        return description
+
+    @staticmethod
+    def _store_image_description(key, description):
+        """缓存成功的图片描述（错误信息不缓存）"""
+        if not CONFIG['image_cache']['enabled']:
+            return
+        if description.startswith(("阿里云API错误", "图片分析失败", "无法解析图片内容", "从URL获取图片失败")):
+            return
+        AIChatSystem.get_image_cache().set(key, description)
 
     @staticmethod
     def analyze_image_with_aliyun(image_data):
         """使用阿里云通义VL MAX分析图片"""
+        cache_key = AIChatSystem._image_content_key(image_data)
+        cached = AIChatSystem._lookup_image_cache(cache_key)
+        if cached is not None:
+            METRICS.incr('image_cache_bytes_saved', len(image_data))
+            return cached
         try:
-            # 提取纯base64数据
-            if ',' in image_data:
-                base64_data = image_data.split(',', 1)[1]
-            else:
-                base64_data = image_data
-
             # 构建请求头
             headers = AIChatSystem._build_headers(CONFIG['aliyun_api']['key'])
 
-            # 构建请求体
-            payload = {
-                "model": "qwen-vl-max",
-                "input": {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "image": f"data:image/jpeg;base64,{base64_data}"
-                                },
-                                {
-                                    "text": "请详细描述这张图片的内容"
-                                }
-                            ]
-                        }
-                    ]
-                },
-                "parameters": {
-                    "max_tokens": 300
-                }
-            }
+            # 构建请求体（先缩小图片，减少上传大小）
+            payload = AIChatSystem._build_vision_payload(AIChatSystem.compress_image(image_data))
 
             # 发送请求到阿里云通义VL MAX API
             response = AIChatSystem._make_api_request(
+                "dashscope",
                 f"{CONFIG['aliyun_api']['base_url']}/services/aigc/multimodal-generation/generation",
                 headers,
                 payload
             )
+            description = AIChatSystem._parse_vision_response(response)
+            AIChatSystem._store_image_description(cache_key, description)
+            return description
 
-            if response.status_code != 200:
-                error_msg = f"阿里云API错误: {response.status_code} - {response.text}"
-                print(f"Aliyun API Error: {error_msg}")
-                return error_msg
+        except Exception as e:
+            error_msg = f"图片分析失败: {str(e)}"
+            print(f"Image Analysis Error: {error_msg}")
+            return error_msg
 
-            result = response.json()
-            if "output" in result and "choices" in result["output"]:
-                content = result["output"]["choices"][0]["message"]["content"]
-                # 确保返回的是字符串而不是列表
-                if isinstance(content, list):
-                    # 如果是列表，提取其中的文本内容
-                    text_parts = []
-                    for item in content:
-                        if isinstance(item, dict) and "text" in item:
-                            text_parts.append(item["text"])
-                        elif isinstance(item, str):
-                            text_parts.append(item)
-                    return " ".join(text_parts)
-                return str(content)
-            else:
-                return "无法解析图片内容"
+    @staticmethod
+    async def analyze_image_with_aliyun_async(image_data):
+        """使用阿里云通义VL MAX分析图片（异步版本）"""
+        cache_key = AIChatSystem._image_content_key(image_data)
+        cached = AIChatSystem._lookup_image_cache(cache_key)
+        if cached is not None:
+            METRICS.incr('image_cache_bytes_saved', len(image_data))
+            return cached
+        try:
+            headers = AIChatSystem._build_headers(CONFIG['aliyun_api']['key'])
+            payload = AIChatSystem._build_vision_payload(await AIChatSystem.compress_image_async(image_data))
+
+            async with get_admission('dashscope').slot():
+                response = await AIChatSystem._make_api_request_async(
+                    "dashscope",
+                    f"{CONFIG['aliyun_api']['base_url']}/services/aigc/multimodal-generation/generation",
+                    headers,
+                    payload
+                )
+            description = AIChatSystem._parse_vision_response(response)
+            AIChatSystem._store_image_description(cache_key, description)
+            return description
 
         except Exception as e:
             error_msg = f"图片分析失败: {str(e)}"
@@ -210,51 +369,186 @@ class AIChatSystem:
     @staticmethod
     def analyze_image_from_url(image_url):
         """通过URL获取图片并使用阿里云通义VL MAX分析图片"""
+        cached = AIChatSystem._lookup_image_cache(f"url:{image_url}")
+        if cached is not None:
+            return cached
         try:
             # 从URL获取图片
-            response = requests.get(image_url, timeout=30)
+            response = get_session("images").get(image_url)
             response.raise_for_status()
 
             # 将图片转换为Base64
             image_data = base64.b64encode(response.content).decode('utf-8')
 
-            # 使用现有的方法分析图片
-            return AIChatSystem.analyze_image_with_aliyun(image_data)
+            # 使用现有的方法分析图片（同一张图片换了URL时仍能命中内容哈希）
+            description = AIChatSystem.analyze_image_with_aliyun(image_data)
+            AIChatSystem._store_image_description(f"url:{image_url}", description)
+            return description
 
         except Exception as e:
             error_msg = f"从URL获取图片失败: {str(e)}"
             print(f"Image URL Error: {error_msg}")
             return error_msg
 
+    @staticmethod
+    async def analyze_image_from_url_async(image_url):
+        """通过URL获取图片并使用阿里云通义VL MAX分析图片（异步版本）"""
+        cached = AIChatSystem._lookup_image_cache(f"url:{image_url}")
+        if cached is not None:
+            return cached
+        try:
+            response = await get_async_client("images").get(image_url)
+            response.raise_for_status()
+
+            image_data = base64.b64encode(response.content).decode('utf-8')
+            description = await AIChatSystem.analyze_image_with_aliyun_async(image_data)
+            AIChatSystem._store_image_description(f"url:{image_url}", description)
+            return description
+
+        except Exception as e:
+            error_msg = f"从URL获取图片失败: {str(e)}"
+            print(f"Image URL Error: {error_msg}")
+            return error_msg
+
+    @staticmethod
+    def _build_search_payload(query):
+        """构建Kimi搜索请求体
+
+        Args:
+            query (str): 搜索查询
+
+        Returns:
+            dict: 请求体，其中messages会在工具调用时被追加
+        """
+        # 构造Kimi API请求消息
+        kimi_messages = AIChatSystem._build_chat_messages(
+            "你是 Kimi，由 Moonshot AI 提供支持的人工智能助手。",
+            query
+        )
+
+        return {
+            "model": "kimi-k2-0905-preview",
+            "messages": kimi_messages,
+            "temperature": 0.6,
+            "max_tokens": 32768,
+            "tools": [
+                {
+                    "type": "builtin_function",
+                    "function": {
+                        "name": "$web_search",
+                    },
+                }
+            ]
+        }
+
+    @staticmethod
+    def _prepare_search_followup(result, kimi_payload):
+        """根据首轮响应准备工具调用的后续请求
+
+        Args:
+            result (dict): Kimi API首轮响应
+            kimi_payload (dict): 首轮请求体，会被就地追加工具调用消息
+
+        Returns:
+            bool: 需要发送后续请求时返回True
+        """
+        # 检查是否需要工具调用
+        if not (result.get("choices") and len(result["choices"]) > 0):
+            return False
+        choice = result["choices"][0]
+        if not (choice.get("finish_reason") == "tool_calls" and
+                choice.get("message") and choice["message"].get("tool_calls")):
+            return False
+
+        kimi_messages = kimi_payload["messages"]
+        for tool_call in choice["message"]["tool_calls"]:
+            if tool_call["function"]["name"] == "$web_search":
+                # 执行搜索工具调用
+                tool_call_id, tool_call_arguments = AIChatSystem._handle_tool_call(tool_call)
+
+                # 将工具调用结果返回给Kimi API
+                kimi_messages.append(choice["message"])
+                kimi_messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call_id,
+                    "name": "$web_search",
+                    "content": json.dumps(tool_call_arguments)
+                })
+                return True
+        return False
+
+    @staticmethod
+    def _parse_search_final(final_response):
+        """解析Kimi工具调用后的最终响应，无结果时返回None"""
+        if final_response.status_code == 200:
+            final_result = final_response.json()
+            if final_result.get("choices") and len(final_result["choices"]) > 0:
+                final_choice = final_result["choices"][0]
+                if final_choice.get("message") and final_choice["message"].get("content"):
+                    return final_choice["message"]["content"]
+        return None
+
+    @classmethod
+    def get_search_cache(cls):
+        """获取搜索结果缓存（首次使用时创建）
+
+        开启磁盘缓存时使用data/search_cache.db，重启后仍然有效；
+        否则在开启共享状态时与其他工作进程共享。
+        """
+        if cls._search_cache is None:
+            settings = CONFIG['search_cache']
+            if settings['disk_enabled']:
+                store = SharedStateStore(settings['disk_path'], max_entries=settings['disk_max_entries'])
+            else:
+                store = get_shared_state()
+            cls._search_cache = TTLCache(
+                'search_cache',
+                max_entries=settings['max_entries'],
+                ttl=settings['ttl']['general'],
+                store=store
+            )
+        return cls._search_cache
+
+    @staticmethod
+    def _lookup_search_cache(query):
+        """按规范化后的问题查询搜索结果缓存
+
+        Returns:
+            tuple: (缓存键, 缓存的搜索结果)，未开启缓存时缓存键为None
+        """
+        if not CONFIG['search_cache']['enabled']:
+            return None, None
+        key = normalize_query(query)
+        if not key:
+            return None, None
+        cached = AIChatSystem.get_search_cache().get(key)
+        if cached is not None:
+            # 命中时省下了两次Kimi调用，按结果大小累计节省的字节数
+            METRICS.incr('search_cache_bytes_saved', len(cached.encode('utf-8')))
+            print(f"搜索缓存命中: {key}")
+        return key, cached
+
+    @staticmethod
+    def _store_search_result(key, query, result):
+        """按问题类型的有效期缓存成功的搜索结果"""
+        if key is None:
+            return
+        category = classify_search_query(query)
+        AIChatSystem.get_search_cache().set(key, result, ttl=CONFIG['search_cache']['ttl'][category])
+
     @staticmethod
     def search_with_ai_search(query):
         """使用Kimi API进行搜索"""
+        cache_key, cached = AIChatSystem._lookup_search_cache(query)
+        if cached is not None:
+            return cached
         try:
             headers = AIChatSystem._build_headers(CONFIG['search_api']['key'])
-
-            # 构造Kimi API请求消息
-            kimi_messages = AIChatSystem._build_chat_messages(
-                "你是 Kimi，由 Moonshot AI 提供支持的人工智能助手。",
-                query
-            )
+            kimi_payload = AIChatSystem._build_search_payload(query)
 
             # 发送请求到Kimi API
-            kimi_payload = {
-                "model": "kimi-k2-0905-preview",
-                "messages": kimi_messages,
-                "temperature": 0.6,
-                "max_tokens": 32768,
-                "tools": [
-                    {
-                        "type": "builtin_function",
-                        "function": {
-                            "name": "$web_search",
-                        },
-                    }
-                ]
-            }
-
             response = AIChatSystem._make_api_request(
+                "kimi",
                 f"{CONFIG['search_api']['base_url']}/chat/completions",
                 headers,
                 kimi_payload
@@ -265,42 +559,61 @@ class AIChatSystem:
                 print(f"Search API Error: {error_msg}")
                 return error_msg
 
-            result = response.json()
-            # 检查是否需要工具调用
-            if result.get("choices") and len(result["choices"]) > 0:
-                choice = result["choices"][0]
-                if choice.get("finish_reason") == "tool_calls" and \
-                        choice.get("message") and choice["message"].get("tool_calls"):
-                    # 处理工具调用
-                    tool_calls = choice["message"]["tool_calls"]
-                    for tool_call in tool_calls:
-                        if tool_call["function"]["name"] == "$web_search":
-                            # 执行搜索工具调用
-                            tool_call_id, tool_call_arguments = AIChatSystem._handle_tool_call(tool_call)
-
-                            # 将工具调用结果返回给Kimi API
-                            kimi_messages.append(choice["message"])
-                            kimi_messages.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call_id,
-                                "name": "$web_search",
-                                "content": json.dumps(tool_call_arguments)
-                            })
-
-                            # 再次调用Kimi API获取最终结果
-                            kimi_payload["messages"] = kimi_messages
-                            final_response = AIChatSystem._make_api_request(
-                                f"{CONFIG['search_api']['base_url']}/chat/completions",
-                                headers,
-                                kimi_payload
-                            )
-
-                            if final_response.status_code == 200:
-                                final_result = final_response.json()
-                                if final_result.get("choices") and len(final_result["choices"]) > 0:
-                                    final_choice = final_result["choices"][0]
-                                    if final_choice.get("message") and final_choice["message"].get("content"):
-                                        return final_choice["message"]["content"]
+            if AIChatSystem._prepare_search_followup(response.json(), kimi_payload):
+                # 再次调用Kimi API获取最终结果
+                final_response = AIChatSystem._make_api_request(
+                    "kimi",
+                    f"{CONFIG['search_api']['base_url']}/chat/completions",
+                    headers,
+                    kimi_payload
+                )
+                content = AIChatSystem._parse_search_final(final_response)
+                if content:
+                    AIChatSystem._store_search_result(cache_key, query, content)
+                    return content
+
+            return "未找到相关搜索结果"
+
+        except Exception as e:
+            error_msg = f"搜索失败: {str(e)}"
+            print(f"Search Error: {error_msg}")
+            return error_msg
+
+    @staticmethod
+    async def search_with_ai_search_async(query):
+        """使用Kimi API进行搜索（异步版本）"""
+        cache_key, cached = AIChatSystem._lookup_search_cache(query)
+        if cached is not None:
+            return cached
+        try:
+            headers = AIChatSystem._build_headers(CONFIG['search_api']['key'])
+            kimi_payload = AIChatSystem._build_search_payload(query)
+
+            async with get_admission('kimi').slot():
+                response = await AIChatSystem._make_api_request_async(
+                    "kimi",
+                    f"{CONFIG['search_api']['base_url']}/chat/completions",
+                    headers,
+                    kimi_payload
+                )
+
+            if response.status_code != 200:
+                error_msg = f"搜索API错误: {response.status_code} - {response.text}"
+                print(f"Search API Error: {error_msg}")
+                return error_msg
+
+            if AIChatSystem._prepare_search_followup(response.json(), kimi_payload):
+                async with get_admission('kimi').slot():
+                    final_response = await AIChatSystem._make_api_request_async(
+                        "kimi",
+                        f"{CONFIG['search_api']['base_url']}/chat/completions",
+                        headers,
+                        kimi_payload
+                    )
+                content = AIChatSystem._parse_search_final(final_response)
+                if content:
+                    AIChatSystem._store_search_result(cache_key, query, content)
+                    return content
 
             return "未找到相关搜索结果"
 
@@ -312,7 +625,6 @@ class AIChatSystem:
     @staticmethod
     def should_search(user_input):
         """判断是否需要进行搜索"""
-        from src.shared_utils import should_search as util_should_search
         return util_should_search(user_input)
 
     def _send_deepseek_request(self, messages: list) -> Tuple[str, int, int]:
@@ -337,7 +649,7 @@ class AIChatSystem:
         }
 
         # 发送请求
-        response = requests.post(
+        response = get_session("deepseek").post(
             f"{CONFIG['api']['base_url']}/chat/completions",
             headers=headers,
             json=data,
@@ -354,6 +666,7 @@ class AIChatSystem:
         completion_tokens = result.get('usage', {}).get('completion_tokens', 0)
         
         # 更新全局token计数
+        record_token_usage(prompt_tokens, completion_tokens)
         global INPUT_TOKENS, OUTPUT_TOKENS
         try:
             from src.web_server import INPUT_TOKENS, OUTPUT_TOKENS
@@ -365,67 +678,402 @@ class AIChatSystem:
 
         return content, prompt_tokens, completion_tokens
 
-    def chat(self, user_input, image=None):
-        """处理聊天请求，支持文本和图片"""
-        image_description = None
+    @staticmethod
+    def build_context(session, pending=None):
+        """构建发送给上游的消息列表
+
+        保留系统提示语和能放进context.max_prompt_tokens预算的最新消息，
+        无论机器人运行多久，每次请求的提示长度都有上限。
+
+        Args:
+            session (ChatSession): 当前会话
+            pending (list): 尚未写入会话、但需要一起发送的消息
+
+        Returns:
+            list: 裁剪后的消息列表
+        """
+        messages = session.snapshot() + (pending or [])
+        budget = CONFIG['context']['max_prompt_tokens']
+        context, dropped_messages, dropped_tokens = trim_messages_to_budget(messages, budget)
+
+        METRICS.incr('context_requests')
+        METRICS.incr('context_prompt_tokens', estimate_tokens(context))
+        if dropped_messages:
+            METRICS.incr('context_dropped_messages', dropped_messages)
+            METRICS.incr('context_dropped_tokens', dropped_tokens)
+            print(f"上下文裁剪[{session.session_id}]: 丢弃 {dropped_messages} 条消息，约 {dropped_tokens} tokens")
+        return context
+
+    @staticmethod
+    def response_cache_key(session, user_input, image=None, model="deepseek-chat"):
+        """计算回复缓存的缓存键
+
+        缓存键由规范化的用户输入、模型、人设和最近几条消息的指纹组成。
+        带图片的请求和should_search判定为时效性问题的输入不走缓存。
+
+        Returns:
+            str: 缓存键，不可缓存时为None
+        """
+        settings = CONFIG['response_cache']
+        if not settings['enabled'] or image or not user_input or not isinstance(user_input, str):
+            return None
+        if AIChatSystem.should_search(user_input):
+            return None
 
-        # 处理图片
+        history = session.snapshot()
+        recent = history[1:][-settings['context_messages']:] if settings['context_messages'] else []
+        key_source = json.dumps(
+            [normalize_query(user_input), model, history[0]['content'], recent],
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def lookup_response_cache(self, session, user_input, image=None, model="deepseek-chat"):
+        """查询回复缓存
+
+        Args:
+            session (ChatSession): 当前会话（在写入本轮消息之前调用）
+            user_input (str): 用户输入
+            image: 图片数据
+            model (str): 模型名
+
+        Returns:
+            tuple: (缓存键, 缓存的回复)，不可缓存时缓存键为None，未命中时回复为None
+        """
+        key = self.response_cache_key(session, user_input, image, model)
+        if key is None:
+            return None, None
+        return key, self.response_cache.get(key)
+
+    async def lookup_response_cache_async(self, session, user_input, image=None, model="deepseek-chat"):
+        """查询回复缓存（异步版本），查询共享存储时不阻塞事件循环"""
+        key = self.response_cache_key(session, user_input, image, model)
+        if key is None:
+            return None, None
+        return key, await self.response_cache.get_async(key)
+
+    @staticmethod
+    def _turn_messages(user_input, image, image_description, search_result):
+        """生成本轮需要写入会话历史的图片描述、搜索结果和用户输入
+
+        Args:
+            user_input (str): 用户输入
+            image: 图片数据
+            image_description (str): 图片描述，没有图片时为None
+            search_result (str): 搜索结果，未触发搜索时为None
+
+        Returns:
+            tuple: (消息列表, 需要直接返回给用户的提示)，正常情况下提示为None
+        """
+        messages = []
         if image:
-            # 使用阿里云通义VL MAX分析图片
-            image_description = self.analyze_image_with_aliyun(image)
             # 将图片描述添加到消息历史中
-            self.messages.append({
+            messages.append({
                 "role": "user",
                 "content": f"[图片内容]: {image_description}"
             })
 
         # 处理文本输入
         if user_input:
-            # 判断是否需要搜索
-            if AIChatSystem.should_search(user_input):
-                print(f"检测到搜索请求: {user_input}")
-                search_result = AIChatSystem.search_with_ai_search(user_input)
-
-                # 检查搜索是否成功
-                if "搜索API错误" in search_result or "搜索失败" in search_result:
-                    # 如果搜索失败，使用普通聊天模式
-                    self.messages.append({"role": "user", "content": user_input})
-                else:
-                    # 将搜索结果添加到消息历史中
-                    search_context = f"用户问题: {user_input}\n{search_result}"
-                    self.messages.append({
-                        "role": "user",
-                        "content": search_context
-                    })
-                    print(f"搜索结果: {search_result[:100]}...")
+            if search_result is None:
+                messages.append({"role": "user", "content": user_input})
+            # 检查搜索是否成功
+            elif "搜索API错误" in search_result or "搜索失败" in search_result:
+                # 如果搜索失败，使用普通聊天模式
+                messages.append({"role": "user", "content": user_input})
             else:
-                self.messages.append({"role": "user", "content": user_input})
+                # 将搜索结果添加到消息历史中
+                search_context = f"用户问题: {user_input}\n{search_result}"
+                messages.append({
+                    "role": "user",
+                    "content": search_context
+                })
+                print(f"搜索结果: {search_result[:100]}...")
         # 如果没有文本输入但有图片
-        elif not user_input and image:
-            self.messages.append({"role": "user", "content": "[用户发送了一张图片]"})
+        elif image:
+            messages.append({"role": "user", "content": "[用户发送了一张图片]"})
         # 如果没有文本输入
-        elif not user_input:
-            return "请发送文本内容喵~"
+        else:
+            return messages, "请发送文本内容喵~"
+        return messages, None
 
-        try:
-            # 使用DeepSeek-Chat模型生成回复（添加超时）
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
-                messages=self.messages,
-                temperature=0.7,
-                max_tokens=200,
-                timeout=30  # 30秒超时
-            )
+    @staticmethod
+    def _record_enrichment(timings, wall):
+        """记录各增强步骤的耗时
 
-            ai_response = response.choices[0].message.content
-            self.messages.append({"role": "assistant", "content": ai_response})
+        Args:
+            timings (dict): 步骤名 -> 耗时（秒）
+            wall (float): 所有步骤并行执行的总耗时（秒）
+        """
+        if not timings:
+            return
+        for step, elapsed in timings.items():
+            METRICS.incr(f'enrichment_{step}_calls')
+            METRICS.incr(f'enrichment_{step}_seconds', elapsed)
+        METRICS.incr('enrichment_wall_seconds', wall)
+        # 串行执行时需要的时间减去实际耗时，即并行节省的时间
+        METRICS.incr('enrichment_saved_seconds', max(sum(timings.values()) - wall, 0.0))
+        if len(timings) > 1:
+            steps = ", ".join(f"{step} {elapsed:.2f}s" for step, elapsed in timings.items())
+            print(f"增强步骤耗时: {steps}, 总计 {wall:.2f}s")
 
-            # 保存对话记录（包括图片描述）
-            self.db.save_chat(user_input or "[图片]", ai_response, image_description)
+    @staticmethod
+    def _enrichment_steps(user_input, image):
+        """确定本轮需要执行的增强步骤（vision: 图片识别，search: 联网搜索）"""
+        steps = []
+        if image:
+            steps.append('vision')
+        if user_input and AIChatSystem.should_search(user_input):
+            print(f"检测到搜索请求: {user_input}")
+            steps.append('search')
+        return steps
 
-            return ai_response
+    def _prepare_turn(self, session, user_input, image):
+        """执行图片识别和搜索增强，并把本轮输入写入会话历史
 
-        except APITimeoutError:
-            return "呜...思考太久超时啦Nanaoda! (>_<)"
-        except Exception as e:
-            return f"呜...出错啦Nanaoda! ({str(e)})"
+        图片识别和搜索互不依赖，同时需要时在线程池中并行执行，
+        结果按固定顺序（图片在前、搜索在后）写入会话历史。
+
+        Returns:
+            tuple: (图片描述, 需要直接返回给用户的提示)
+        """
+        calls = {
+            # 使用阿里云通义VL MAX分析图片
+            'vision': lambda: self.analyze_image_with_aliyun(image),
+            'search': lambda: AIChatSystem.search_with_ai_search(user_input),
+        }
+        steps = self._enrichment_steps(user_input, image)
+        results = {}
+        timings = {}
+
+        def run(step):
+            begin = time.perf_counter()
+            results[step] = calls[step]()
+            timings[step] = time.perf_counter() - begin
+
+        start = time.perf_counter()
+        if len(steps) > 1:
+            for future in [_ENRICHMENT_POOL.submit(run, step) for step in steps]:
+                future.result()
+        elif steps:
+            run(steps[0])
+        self._record_enrichment(timings, time.perf_counter() - start)
+
+        image_description = results.get('vision')
+        messages, notice = self._turn_messages(user_input, image, image_description, results.get('search'))
+        if messages:
+            session.extend(messages)
+        return image_description, notice
+
+    async def _prepare_turn_async(self, session, user_input, image):
+        """执行图片识别和搜索增强，并把本轮输入写入会话历史（异步版本）
+
+        Returns:
+            tuple: (图片描述, 需要直接返回给用户的提示)
+        """
+        calls = {
+            'vision': lambda: self.analyze_image_with_aliyun_async(image),
+            'search': lambda: AIChatSystem.search_with_ai_search_async(user_input),
+        }
+        steps = self._enrichment_steps(user_input, image)
+        timings = {}
+
+        async def run(step):
+            begin = time.perf_counter()
+            result = await calls[step]()
+            timings[step] = time.perf_counter() - begin
+            return result
+
+        start = time.perf_counter()
+        results = dict(zip(steps, await asyncio.gather(*(run(step) for step in steps))))
+        self._record_enrichment(timings, time.perf_counter() - start)
+
+        image_description = results.get('vision')
+        messages, notice = self._turn_messages(user_input, image, image_description, results.get('search'))
+        if messages:
+            await session.extend_async(messages)
+        return image_description, notice
+
+    def chat(self, user_input, image=None, session_id=None):
+        """处理聊天请求，支持文本和图片
+
+        Args:
+            user_input (str): 用户输入
+            image: 图片数据
+            session_id (str): 会话ID，为空时使用默认会话
+        """
+        session = self.sessions.get(session_id)
+        # 同一会话的请求按顺序处理，不同会话之间互不阻塞
+        with session.lock:
+            cache_key, cached = self.lookup_response_cache(session, user_input, image)
+            if cached is not None:
+                session.extend([{"role": "user", "content": user_input}, {"role": "assistant", "content": cached}])
+                self.db.save_chat(user_input, cached)
+                return cached
+
+            image_description, notice = self._prepare_turn(session, user_input, image)
+            if notice:
+                return notice
+
+            try:
+                # 使用DeepSeek-Chat模型生成回复（添加超时）
+                response = self.client.chat.completions.create(
+                    model="deepseek-chat",
+                    messages=self.build_context(session),
+                    temperature=0.7,
+                    max_tokens=200,
+                    timeout=30  # 30秒超时
+                )
+
+                ai_response = response.choices[0].message.content
+                if response.usage:
+                    record_token_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+                session.append({"role": "assistant", "content": ai_response})
+                if cache_key:
+                    self.response_cache.set(cache_key, ai_response)
+
+                # 保存对话记录（包括图片描述）
+                self.db.save_chat(user_input or "[图片]", ai_response, image_description)
+
+                return ai_response
+
+            except APITimeoutError:
+                return "呜...思考太久超时啦Nanaoda! (>_<)"
+            except Exception as e:
+                return f"呜...出错啦Nanaoda! ({str(e)})"
+
+    async def chat_async(self, user_input, image=None, session_id=None):
+        """处理聊天请求，支持文本和图片（异步版本）
+
+        所有上游调用都通过异步客户端完成，数据库写入放到线程池中执行，
+        因此不会阻塞事件循环。共享状态存储的读写同样在线程池中执行。
+        """
+        session = await self.sessions.get_async(session_id)
+        async with session.async_lock:
+            cache_key, cached = await self.lookup_response_cache_async(session, user_input, image)
+            if cached is not None:
+                await session.extend_async([{"role": "user", "content": user_input},
+                                            {"role": "assistant", "content": cached}])
+                await asyncio.to_thread(self.db.save_chat, user_input, cached)
+                return cached
+
+            image_description, notice = await self._prepare_turn_async(session, user_input, image)
+            if notice:
+                return notice
+
+            try:
+                # 上游繁忙时排队等待，排队已满或超时则把AdmissionRejected交给调用方返回429
+                async with get_admission('deepseek').slot():
+                    response = await self.async_client.chat.completions.create(
+                        model="deepseek-chat",
+                        messages=self.build_context(session),
+                        temperature=0.7,
+                        max_tokens=200,
+                        timeout=30
+                    )
+
+                ai_response = response.choices[0].message.content
+                if response.usage:
+                    await record_token_usage_async(response.usage.prompt_tokens, response.usage.completion_tokens)
+                await session.extend_async([{"role": "assistant", "content": ai_response}])
+                if cache_key:
+                    await self.response_cache.set_async(cache_key, ai_response)
+
+                await asyncio.to_thread(self.db.save_chat, user_input or "[图片]", ai_response, image_description)
+
+                return ai_response
+
+            except AdmissionRejected:
+                raise
+            except APITimeoutError:
+                return "呜...思考太久超时啦Nanaoda! (>_<)"
+            except Exception as e:
+                return f"呜...出错啦Nanaoda! ({str(e)})"
+
+    def chat_stream(self, user_input, image=None, session_id=None):
+        """以流式方式处理聊天请求
+
+        先完成图片识别和搜索增强，然后逐块转发上游返回的增量内容，
+        生成结束后把完整回复写入会话历史和数据库。
+
+        Yields:
+            str: 回复的增量文本
+        """
+        session = self.sessions.get(session_id)
+        with session.lock:
+            image_description, notice = self._prepare_turn(session, user_input, image)
+            if notice:
+                yield notice
+                return
+
+            content_accum = ""
+            try:
+                stream = self.client.chat.completions.create(
+                    model="deepseek-chat",
+                    messages=self.build_context(session),
+                    temperature=0.7,
+                    max_tokens=200,
+                    timeout=30,
+                    stream=True
+                )
+                for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        content_accum += delta
+                        yield delta
+            except APITimeoutError:
+                yield "呜...思考太久超时啦Nanaoda! (>_<)"
+                return
+            except Exception as e:
+                yield f"呜...出错啦Nanaoda! ({str(e)})"
+                return
+
+            session.append({"role": "assistant", "content": content_accum})
+            self.db.save_chat(user_input or "[图片]", content_accum, image_description)
+
+    async def chat_stream_async(self, user_input, image=None, session_id=None):
+        """以流式方式处理聊天请求（异步版本）
+
+        Yields:
+            str: 回复的增量文本
+        """
+        session = await self.sessions.get_async(session_id)
+        async with session.async_lock:
+            image_description, notice = await self._prepare_turn_async(session, user_input, image)
+            if notice:
+                yield notice
+                return
+
+            content_accum = ""
+            try:
+                # 流式响应占用上游名额直到生成结束
+                async with get_admission('deepseek').slot():
+                    stream = await self.async_client.chat.completions.create(
+                        model="deepseek-chat",
+                        messages=self.build_context(session),
+                        temperature=0.7,
+                        max_tokens=200,
+                        timeout=30,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            content_accum += delta
+                            yield delta
+            except AdmissionRejected:
+                yield "呜...现在找我聊天的人太多啦，稍后再试Nanaoda! (>_<)"
+                return
+            except APITimeoutError:
+                yield "呜...思考太久超时啦Nanaoda! (>_<)"
+                return
+            except Exception as e:
+                yield f"呜...出错啦Nanaoda! ({str(e)})"
+                return
+
+            await session.extend_async([{"role": "assistant", "content": content_accum}])
+            await asyncio.to_thread(self.db.save_chat, user_input or "[图片]", content_accum, image_description)
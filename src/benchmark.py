@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+性能基准测试脚本
+在本地启动模拟上游服务，测量聊天系统各条路径的吞吐量
+
+用法:
+    python -m src.benchmark concurrency [--requests 64] [--delay 0.2]
+    python -m src.benchmark workers [--requests 256] [--concurrency 64] [--delay 0.2]
+    python -m src.benchmark http [--requests 200]
+    python -m src.benchmark image [--size 4000]
+    python -m src.benchmark should_search [--rounds 2000]
+    python -m src.benchmark tokens [--turns 200] [--vocab path/to/tokenizer.json]
+    python -m src.benchmark storage [--rows 20000] [--batch 50]
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# 添加项目根目录到 sys.path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from io import BytesIO
+
+import uvicorn
+import httpx
+import requests
+from fastapi import FastAPI
+from openai import OpenAI, AsyncOpenAI
+from PIL import Image, ImageDraw
+
+from src.ai_chat_system import AIChatSystem
+from src.config import CONFIG, SHARED_STATE_ENV
+from src.http_clients import get_session, http_client_stats
+from src.image_pipeline import prepare_image
+from src.metrics import METRICS
+from src.shared_utils import estimate_tokens, should_search
+from src.tokenizer import (BPETokenizer, CJK_TOKENS_PER_CHAR, OTHER_TOKENS_PER_CHAR, count_text_tokens,
+                           get_tokenizer, heuristic_count)
+from src.session_store import SessionManager
+from src.shared_state import get_shared_state
+
+# workers基准测试中，工作进程通过该环境变量获取模拟上游地址
+UPSTREAM_ENV = "SHIZUKU_BENCH_UPSTREAM"
+
+
+class _NullDatabase:
+    """基准测试使用的空数据库，只统计写入次数"""
+
+    def __init__(self):
+        self.saved = 0
+
+    def save_chat(self, user_input, ai_response, image_description=None):
+        self.saved += 1
+
+    def close(self):
+        pass
+
+
+def _free_port():
+    """获取一个空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_upstream(delay, ssl_certfile=None, ssl_keyfile=None):
+    """在后台线程中启动模拟的OpenAI兼容上游服务
+
+    Args:
+        delay (float): 每个请求的模拟生成耗时（秒）
+        ssl_certfile (str): 证书文件，指定时以HTTPS提供服务
+        ssl_keyfile (str): 私钥文件
+
+    Returns:
+        str: 模拟服务的base_url
+    """
+    mock_app = FastAPI()
+
+    @mock_app.post("/chat/completions")
+    async def completions():
+        await asyncio.sleep(delay)
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "deepseek-chat",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "喵~"},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(mock_app, host="127.0.0.1", port=port, log_level="warning",
+                                           ssl_certfile=ssl_certfile, ssl_keyfile=ssl_keyfile))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    scheme = "https" if ssl_certfile else "http"
+    return f"{scheme}://127.0.0.1:{port}"
+
+
+def build_chat_system(base_url):
+    """构建指向模拟上游、且不连接数据库的聊天系统实例"""
+    system = object.__new__(AIChatSystem)
+    system.db = _NullDatabase()
+    system.system_prompt = "benchmark"
+    system.client = OpenAI(api_key="mock", base_url=base_url, timeout=30.0)
+    system.async_client = AsyncOpenAI(api_key="mock", base_url=base_url, timeout=30.0)
+    system.sessions = SessionManager(system.system_prompt, store=get_shared_state())
+    return system
+
+
+def bench_concurrency(args):
+    """对比同步chat()与异步chat_async()在不同并发数下的吞吐量"""
+    base_url = start_mock_upstream(args.delay)
+    system = build_chat_system(base_url)
+
+    start = time.perf_counter()
+    for i in range(min(args.requests, 8)):
+        system.chat("你好", session_id=f"sync-{i}")
+    serial = min(args.requests, 8) / (time.perf_counter() - start)
+    print(f"同步 chat()      并发=1   吞吐量: {serial:8.2f} req/s")
+
+    async def run(concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with semaphore:
+                # 每个请求使用独立会话，模拟多个QQ群同时对话
+                await system.chat_async("你好", session_id=f"c{concurrency}-{i}")
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        return args.requests / (time.perf_counter() - begin)
+
+    async def run_all():
+        # 在同一个事件循环中运行，复用异步客户端的连接池
+        for concurrency in (1, 4, 16, 64):
+            throughput = await run(concurrency)
+            print(f"异步 chat_async() 并发={concurrency:<3} 吞吐量: {throughput:8.2f} req/s")
+
+    asyncio.run(run_all())
+
+
+def create_benchmark_app():
+    """uvicorn多工作进程模式使用的应用工厂，聊天系统指向模拟上游"""
+    from src.koishi_service import create_app
+    return create_app(build_chat_system(os.environ[UPSTREAM_ENV]))
+
+
+def bench_workers(args):
+    """对比Koishi服务在不同工作进程数下的吞吐量"""
+    os.environ[UPSTREAM_ENV] = start_mock_upstream(args.delay)
+    print(f"CPU核心数: {os.cpu_count()}")
+
+    async def load(port, workers):
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            # 等待所有工作进程就绪
+            for _ in range(200):
+                try:
+                    await client.get("/health")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one(i):
+                async with semaphore:
+                    # 每个请求内容和会话都不同，避免被请求合并或回复缓存命中
+                    response = await client.post("/v1/chat/completions", json={
+                        "model": "neko",
+                        "user": f"w{workers}-{i}",
+                        "messages": [{"role": "user", "content": f"你好{i}"}]
+                    })
+                    response.raise_for_status()
+
+            begin = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.requests)))
+            return args.requests / (time.perf_counter() - begin)
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    for workers in (1, 2, 4):
+        env = dict(os.environ)
+        # 与run_koishi_service一致：多个工作进程时通过共享状态同步会话
+        if workers > 1:
+            env[SHARED_STATE_ENV] = "1"
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.benchmark:create_benchmark_app", "--factory",
+             "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+            cwd=root, env=env, stdout=subprocess.DEVNULL
+        )
+        try:
+            throughput = asyncio.run(load(port, workers))
+            print(f"Koishi服务 workers={workers:<2} 吞吐量: {throughput:8.2f} req/s")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_http(args):
+    """对比每次新建连接的requests.post与长连接会话在本地HTTPS服务上的耗时"""
+    workdir = tempfile.mkdtemp(prefix="shizuku-bench-")
+    certfile = os.path.join(workdir, "cert.pem")
+    keyfile = os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", keyfile, "-out", certfile],
+        check=True, capture_output=True
+    )
+    url = start_mock_upstream(0, ssl_certfile=certfile, ssl_keyfile=keyfile) + "/chat/completions"
+    payload = {"model": "deepseek-chat", "messages": [{"role": "user", "content": "你好"}]}
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        requests.post(url, json=payload, verify=certfile, timeout=30).raise_for_status()
+    fresh = (time.perf_counter() - start) / args.requests * 1000
+    print(f"requests.post  每次新建连接: {fresh:7.2f} ms/请求")
+
+    session = get_session("deepseek")
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        session.post(url, json=payload, verify=certfile).raise_for_status()
+    pooled = (time.perf_counter() - start) / args.requests * 1000
+    print(f"ProviderSession 复用长连接: {pooled:7.2f} ms/请求")
+    print(f"连接统计: {http_client_stats()['deepseek']}")
+
+
+def bench_image(args):
+    """测量图片预处理前后的大小和耗时"""
+    img = Image.new("RGB", (args.size, args.size * 3 // 4))
+    draw = ImageDraw.Draw(img)
+    # 画一些渐变和线条，避免纯色图片被压缩得过小
+    for x in range(0, img.width, 8):
+        draw.line([(x, 0), (img.width - x, img.height)], fill=(x % 256, (x * 7) % 256, (x * 13) % 256), width=5)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=95)
+    image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+    start = time.perf_counter()
+    result = prepare_image(image_data)
+    elapsed = time.perf_counter() - start
+    output = Image.open(BytesIO(base64.b64decode(result)))
+    print(f"输入: {img.width}x{img.height} {len(buffer.getvalue()) / 1024:8.1f} KB")
+    print(f"输出: {output.width}x{output.height} {len(base64.b64decode(result)) / 1024:8.1f} KB")
+    print(f"解码 {METRICS.get('image_pipeline_decode_seconds') * 1000:.1f} ms, "
+          f"编码 {METRICS.get('image_pipeline_encode_seconds') * 1000:.1f} ms, 总计 {elapsed * 1000:.1f} ms")
+
+
+# 预编译关键词匹配之前的should_search实现，用于对比
+_LEGACY_SEARCH_PATTERNS = [
+    r'(?:(?:搜索|查|找|了解|知道|什么是|是什么|怎么样|如何|怎么|哪里|哪儿|哪个|哪些|谁是|谁的|几点|时间|日期|天气|新闻|最新|最近|现在).*)',
+    r'(.*(?:天气|新闻|股价|比分|时间|日期|定义|解释|介绍|攻略|评测|比较|区别|方法|步骤|教程|怎么做).*)',
+    r'(.*(?:最新|最近|现在|今天|明天|昨天|今年|去年|这个月|下个月|上个月).*)'
+]
+
+
+def _legacy_should_search(user_input):
+    if not user_input:
+        return False
+    for pattern in _LEGACY_SEARCH_PATTERNS:
+        if re.search(pattern, user_input, re.IGNORECASE):
+            return True
+    if re.match(r'^(查询|请问|我想了解|我想知道)', user_input.strip(), re.IGNORECASE):
+        return True
+    return '?' in user_input or '？' in user_input
+
+
+def bench_should_search(args):
+    """对比should_search新旧实现在短输入、长输入和对抗输入上的耗时"""
+    cases = {
+        "短输入(命中)": ["今天天气怎么样", "请问现在几点", "帮我查一下新闻"],
+        "短输入(未命中)": ["喵喵喵", "早上好呀", "摸摸头"],
+        "长输入(末尾命中)": ["我们聊聊猫咪吧" * 300 + "天气"],
+        "对抗输入(无关键词)": ["喵" * 5000, "a" * 5000 + "\n" + "b" * 5000],
+    }
+    for name, inputs in cases.items():
+        for text in inputs:
+            assert should_search(text) == _legacy_should_search(text), text[:20]
+        rounds = max(1, args.rounds // max(1, sum(len(text) for text in inputs) // 100))
+        timings = []
+        for func in (_legacy_should_search, should_search):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for text in inputs:
+                    func(text)
+            timings.append((time.perf_counter() - start) / (rounds * len(inputs)) * 1e6)
+        print(f"{name:<12} 旧实现 {timings[0]:10.2f} us  新实现 {timings[1]:8.2f} us  "
+              f"加速 {timings[0] / timings[1]:7.1f}x")
+
+
+def bench_tokens(args):
+    """对比len(text)计数与新的token计数器的速度和准确度"""
+    samples = [
+        "今天天气真好，我们一起去公园散步吧喵~",
+        "The quick brown fox jumps over the lazy dog. " * 3,
+        "帮我看看这段代码：def add(a, b):\n    return a + b",
+        "DeepSeek-V3 在 2024 年 12 月发布，参数量为 671B，激活参数 37B。",
+        "用户问题: 北京明天的天气怎么样？\n根据搜索结果，北京明天晴，气温 -3°C 到 8°C，北风 3 级。",
+    ]
+    reference = BPETokenizer.from_file(args.vocab) if args.vocab else None
+    print(f"{'样本':<24} {'len()':>6} {'新计数':>6}" + (f" {'BPE':>6}" if reference else ""))
+    for text in samples:
+        line = f"{text[:20]!r:<24} {len(text):>6} {count_text_tokens(text):>6}"
+        if reference:
+            line += f" {reference.count(text):>6}"
+        print(line)
+    if get_tokenizer() is None:
+        print(f"未找到{CONFIG['tokenizer']['vocab_path']}，新计数是按字符比例的估算值（中文每字"
+              f"{CJK_TOKENS_PER_CHAR}、其他字符每字{OTHER_TOKENS_PER_CHAR}个token），不是精确的token数")
+    if reference is None:
+        print("未指定--vocab，没有BPE精确计数可供对比")
+
+    # 模拟会话：每轮追加两条消息并估算整个历史
+    history = [{"role": "system", "content": "你是猫娘静流"}]
+    legacy = uncached = cached = 0.0
+    for turn in range(args.turns):
+        history.append({"role": "user", "content": f"{samples[turn % len(samples)]} #{turn}"})
+        history.append({"role": "assistant", "content": f"好的喵~ 这是第{turn}轮回复。{samples[(turn + 1) % len(samples)]}"})
+        start = time.perf_counter()
+        sum(len(message['content']) for message in history)
+        legacy += time.perf_counter() - start
+        start = time.perf_counter()
+        sum(heuristic_count(message['content']) for message in history)
+        uncached += time.perf_counter() - start
+        start = time.perf_counter()
+        estimate_tokens(history)
+        cached += time.perf_counter() - start
+    turns = args.turns
+    print(f"每轮估算{len(history)}条以内的历史: len() {legacy / turns * 1e6:.1f} us, "
+          f"不缓存 {uncached / turns * 1e6:.1f} us, 按消息缓存 {cached / turns * 1e6:.1f} us")
+
+
+def bench_storage(args):
+    """在临时文件上使用SQLite存储后端测量聊天记录的写入、翻页和检索（不需要MySQL）"""
+    from src.database import DatabaseManager, cursor_arguments
+    from src.db_pool import reset_pool
+
+    with tempfile.TemporaryDirectory() as directory:
+        CONFIG['storage'] = {'backend': 'sqlite', 'sqlite_path': os.path.join(directory, 'chat_history.db')}
+        CONFIG['write_behind']['enabled'] = False
+        reset_pool()
+        db = DatabaseManager()
+        words = ["今天天气", "小鱼干", "哥哥", "python", "晚安", "数据库", "猫娘", "散步"]
+        rows = [(f"{words[i % 8]}和{words[i * 7 % 8]} #{i}", f"好的喵~ 第{i}条回复", None) for i in range(args.rows)]
+
+        single = min(1000, args.rows)
+        start = time.perf_counter()
+        # 屏蔽每次保存时打印的日志
+        with contextlib.redirect_stdout(io.StringIO()):
+            for row in rows[:single]:
+                db._insert_chat(*row)
+        elapsed = time.perf_counter() - start
+        print(f"逐条提交: {single} 条 {elapsed:.2f}s ({single / elapsed:.0f} 条/秒)")
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(single, args.rows, args.batch):
+                db.save_chats(rows[i:i + args.batch])
+        elapsed = time.perf_counter() - start
+        batched = args.rows - single
+        if batched:
+            print(f"批量提交（每批{args.batch}条）: {batched} 条 {elapsed:.2f}s ({batched / elapsed:.0f} 条/秒)")
+
+        pages = 0
+        start = time.perf_counter()
+        page, cursor = db.get_chat_history_page(limit=100)
+        while cursor:
+            pages += 1
+            page, cursor = db.get_chat_history_page(**cursor_arguments(cursor))
+        elapsed = time.perf_counter() - start
+        print(f"游标翻页: {pages + 1} 页 {elapsed * 1000:.1f}ms (每页 {elapsed / (pages + 1) * 1000:.2f}ms)")
+
+        db.search_chat_history("小鱼干 散步")
+        start = time.perf_counter()
+        for _ in range(100):
+            found, _ = db.search_chat_history("小鱼干 散步", limit=20)
+        print(f"关键词检索: {len(found)} 条/页 {(time.perf_counter() - start) * 10:.2f}ms/次")
+        db.close()
+        reset_pool()
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="ShizukuNyaBot 性能基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("concurrency", help="异步上游客户端并发吞吐量")
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--delay", type=float, default=0.2, help="模拟上游的生成耗时（秒）")
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser("workers", help="Koishi服务多工作进程吞吐量")
+    p.add_argument("--requests", type=int, default=256)
+    p.add_argument("--concurrency", type=int, default=64)
+    p.add_argument("--delay", type=float, default=0.2, help="模拟上游的生成耗时（秒）")
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("http", help="上游HTTP长连接复用")
+    p.add_argument("--requests", type=int, default=200)
+    p.set_defaults(func=bench_http)
+
+    p = sub.add_parser("image", help="图片预处理")
+    p.add_argument("--size", type=int, default=4000, help="测试图片的宽度（像素）")
+    p.set_defaults(func=bench_image)
+
+    p = sub.add_parser("should_search", help="搜索触发判断")
+    p.add_argument("--rounds", type=int, default=2000)
+    p.set_defaults(func=bench_should_search)
+
+    p = sub.add_parser("tokens", help="token计数")
+    p.add_argument("--turns", type=int, default=200)
+    p.add_argument("--vocab", help="HuggingFace格式的tokenizer.json，用作准确度参照")
+    p.set_defaults(func=bench_tokens)
+
+    p = sub.add_parser("storage", help="SQLite存储后端的写入、翻页和检索")
+    p.add_argument("--rows", type=int, default=20000)
+    p.add_argument("--batch", type=int, default=50, help="批量提交时每批的记录数")
+    p.set_defaults(func=bench_storage)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""缓存模块，提供带过期时间和LRU淘汰的进程内缓存"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from .metrics import METRICS
+
+
+class TTLCache:
+    """线程安全的TTL + LRU缓存
+
+    条目在ttl秒后过期；条目数超过max_entries或总大小超过max_bytes时，
+    按最近最少使用的顺序淘汰。命中和未命中次数会同步到全局指标注册表，
+    指标名以name为前缀。指定store（SharedStateStore）时，本地未命中会再查询
+    多个工作进程共享的存储，写入时同时写入共享存储（值需要可以JSON序列化）。
+    """
+
+    def __init__(self, name: str, max_entries: int = 1024, ttl: float = 300,
+                 max_bytes: Optional[int] = None, size_of: Optional[Callable[[Any], int]] = None,
+                 store=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of or (lambda value: 0)
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        """删除一个条目（调用方需持有self._lock）"""
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        """读取缓存
+
+        Args:
+            key: 缓存键
+            default: 未命中时的返回值
+
+        Returns:
+            缓存值或default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+        if entry is None and self.store is not None:
+            shared = self.store.get_entry(self.name, key)
+            if shared is not None:
+                value, expires_at = shared
+                self._put(key, value, expires_at)
+                with self._lock:
+                    self.hits += 1
+                entry = (expires_at, value, 0)
+
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            METRICS.incr(f'{self.name}_misses')
+            return default
+        METRICS.incr(f'{self.name}_hits')
+        return entry[1]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        """写入缓存
+
+        Args:
+            key: 缓存键
+            value: 缓存值
+            ttl (float): 本条目的过期时间（秒），默认使用缓存的ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if self.store is not None:
+            self.store.set(self.name, key, value, ttl)
+        self._put(key, value, time.time() + ttl)
+
+    async def get_async(self, key, default=None):
+        """读取缓存（异步版本），需要查询共享存储时在线程池中执行"""
+        if self.store is None:
+            return self.get(key, default)
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def set_async(self, key, value, ttl: Optional[float] = None):
+        """写入缓存（异步版本），需要写入共享存储时在线程池中执行"""
+        if self.store is None:
+            self.set(key, value, ttl)
+        else:
+            await asyncio.to_thread(self.set, key, value, ttl)
+
+    def _put(self, key, value, expires_at):
+        """写入本地缓存并按需淘汰"""
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            METRICS.set_gauge(f'{self.name}_entries', len(self._entries))
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
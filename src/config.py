@@ -20,6 +20,25 @@ def load_config():
 # 加载配置
 CONFIG_DATA = load_config()
 
+# 多进程模式下由主进程设置，通知工作进程开启共享状态
+SHARED_STATE_ENV = 'SHIZUKU_SHARED_STATE'
+# 多进程模式下由主进程设置为工作进程数，准入控制据此把限额平分给各个进程
+WORKERS_ENV = 'SHIZUKU_WORKERS'
+
+
+def get_setting(section, key, default):
+    """读取config.json中的可选性能设置，缺省时使用默认值
+
+    Args:
+        section (str): 配置分组名
+        key (str): 配置项名
+        default: 默认值
+
+    Returns:
+        配置值
+    """
+    return CONFIG_DATA.get(section, {}).get(key, default)
+
 
 def generate_system_prompt(character, template):
     """根据模板和角色配置生成系统提示语
@@ -76,6 +95,124 @@ CONFIG = {
     'character': CONFIG_DATA['character'],
     'system_prompt': generate_system_prompt(CONFIG_DATA['character'], 
                                             CONFIG_DATA['system_prompt_template']),
+    'streaming': {
+        'flush_interval': get_setting('streaming', 'flush_interval', 0.05),  # SSE合并帧的最长等待时间（秒）
+        'flush_bytes': get_setting('streaming', 'flush_bytes', 256),  # 缓冲内容达到该字节数时立即发送
+    },
+    'sessions': {
+        'max_sessions': get_setting('sessions', 'max_sessions', 1000),  # 同时保留的会话数上限
+        'ttl': get_setting('sessions', 'ttl', 3600),  # 会话空闲多久后被淘汰（秒）
+        'max_messages': get_setting('sessions', 'max_messages', 40),  # 每个会话保留的对话消息数
+        'max_bytes': get_setting('sessions', 'max_bytes', 64 * 1024 * 1024),  # 所有会话历史的内存上限
+    },
+    'context': {
+        'max_prompt_tokens': get_setting('context', 'max_prompt_tokens', 8000),  # 每次请求发送给上游的历史token预算
+    },
+    'tokenizer': {
+        # 字节级BPE词表（HuggingFace tokenizers格式），不存在时按字符比例估算token数
+        'vocab_path': get_setting('tokenizer', 'vocab_path', os.path.join(PROJECT_ROOT, 'data', 'tokenizer.json')),
+    },
+    'response_cache': {
+        'enabled': get_setting('response_cache', 'enabled', False),  # 是否缓存重复问题的回复（默认关闭）
+        'ttl': get_setting('response_cache', 'ttl', 300),  # 缓存有效期（秒）
+        'max_entries': get_setting('response_cache', 'max_entries', 1000),  # 缓存条目上限
+        'context_messages': get_setting('response_cache', 'context_messages', 2),  # 参与缓存键计算的最近消息数
+    },
+    'search_cache': {
+        'enabled': get_setting('search_cache', 'enabled', True),  # 是否缓存联网搜索结果
+        'max_entries': get_setting('search_cache', 'max_entries', 2000),  # 内存中的缓存条目上限
+        'ttl': {
+            'realtime': get_setting('search_cache', 'realtime_ttl', 600),  # 天气、新闻等时效性问题（秒）
+            'general': get_setting('search_cache', 'general_ttl', 3600),  # 其他问题（秒）
+            'reference': get_setting('search_cache', 'reference_ttl', 86400),  # 定义、教程等知识性问题（秒）
+        },
+        'disk_enabled': get_setting('search_cache', 'disk_enabled', False),  # 是否把缓存保存到磁盘，重启后仍然有效
+        'disk_path': get_setting('search_cache', 'disk_path', os.path.join(PROJECT_ROOT, 'data', 'search_cache.db')),
+        'disk_max_entries': get_setting('search_cache', 'disk_max_entries', 20000),  # 磁盘缓存的条目上限，超出时淘汰最久未使用的
+    },
+    'image_cache': {
+        'enabled': get_setting('image_cache', 'enabled', True),  # 是否缓存图片描述
+        'max_entries': get_setting('image_cache', 'max_entries', 5000),  # 缓存条目上限
+        'max_bytes': get_setting('image_cache', 'max_bytes', 16 * 1024 * 1024),  # 缓存的图片描述总大小上限
+        'ttl': get_setting('image_cache', 'ttl', 7 * 24 * 3600),  # 缓存有效期（秒）
+        'disk_enabled': get_setting('image_cache', 'disk_enabled', False),  # 是否把缓存保存到磁盘，重启后仍然有效
+        'disk_path': get_setting('image_cache', 'disk_path', os.path.join(PROJECT_ROOT, 'data', 'image_cache.db')),
+        'disk_max_entries': get_setting('image_cache', 'disk_max_entries', 50000),  # 磁盘缓存的条目上限，超出时淘汰最久未使用的
+    },
+    'image_pipeline': {
+        'enabled': get_setting('image_pipeline', 'enabled', True),  # 上传给视觉模型之前是否压缩图片
+        'max_edge': get_setting('image_pipeline', 'max_edge', 1280),  # 图片最长边像素数
+        'target_bytes': get_setting('image_pipeline', 'target_bytes', 300 * 1024),  # 压缩后的目标大小（字节）
+        'quality_ladder': get_setting('image_pipeline', 'quality_ladder', [85, 75, 65, 50]),  # 依次尝试的JPEG质量
+        'executor': get_setting('image_pipeline', 'executor', 'thread'),  # 异步路径使用的执行器：thread或process
+        'max_workers': get_setting('image_pipeline', 'max_workers', 2),
+    },
+    'write_behind': {
+        'enabled': get_setting('write_behind', 'enabled', False),  # 聊天记录是否放入队列由后台线程批量写入
+        'batch_size': get_setting('write_behind', 'batch_size', 50),  # 攒够多少条写入一次
+        'flush_interval': get_setting('write_behind', 'flush_interval', 0.5),  # 最长等待多久写入一次（秒）
+        'max_pending': get_setting('write_behind', 'max_pending', 10000),  # 队列中最多保存的记录数
+        'put_timeout': get_setting('write_behind', 'put_timeout', 5),  # 队列满时最多等待多久，超时后同步写入（秒）
+        'max_retries': get_setting('write_behind', 'max_retries', 3),  # 批量写入失败后的重试次数，仍然失败时逐行写入
+        'retry_backoff': get_setting('write_behind', 'retry_backoff', 0.5),  # 第一次重试前的等待时间，之后每次翻倍（秒）
+    },
+    'retention': {
+        'max_records': get_setting('retention', 'max_records', 200),  # 数据库中保留的最多记录数，0表示不按数量归档
+        'max_age_days': get_setting('retention', 'max_age_days', 0),  # 超过多少天的记录归档，0表示不按时间归档
+        'chunk_size': get_setting('retention', 'chunk_size', 100),  # 每次归档和删除的最多记录数
+        'check_interval': get_setting('retention', 'check_interval', 60),  # 检查间隔（秒）
+        'recount_interval': get_setting('retention', 'recount_interval', 3600),  # 重新执行COUNT(*)校准记录数的间隔（秒）
+        'archive_dir': get_setting('retention', 'archive_dir', os.path.join(PROJECT_ROOT, 'data', 'archive')),
+        'segment_rows': get_setting('retention', 'segment_rows', 50000),  # 每个归档分段最多保存的记录数
+    },
+    'system_sampler': {
+        'interval': get_setting('system_sampler', 'interval', 1.0),  # 系统指标的采样间隔（秒）
+        'capacity': get_setting('system_sampler', 'capacity', 600),  # 内存中保留的最近采样数
+    },
+    'timeseries': {
+        # 监控历史的分辨率：[每格秒数, 格数]，默认1秒一格保留10分钟、1分钟一格保留24小时
+        'resolutions': get_setting('timeseries', 'resolutions', [[1, 600], [60, 1440]]),
+    },
+    'storage': {
+        'backend': get_setting('storage', 'backend', 'mysql'),  # 聊天记录存储后端：mysql或sqlite（单机部署，不需要数据库服务）
+        'sqlite_path': get_setting('storage', 'sqlite_path', os.path.join(PROJECT_ROOT, 'data', 'chat_history.db')),
+    },
+    'db_pool': {
+        'size': get_setting('db_pool', 'size', 5),  # 每个进程最多保持的MySQL连接数
+        'checkout_timeout': get_setting('db_pool', 'checkout_timeout', 10),  # 连接都被占用时最多等待多久（秒）
+        'health_check_idle': get_setting('db_pool', 'health_check_idle', 30),  # 空闲超过多久的连接借出前先ping（秒）
+    },
+    'koishi': {
+        'host': get_setting('koishi', 'host', '127.0.0.1'),  # 监听地址
+        'workers': get_setting('koishi', 'workers', 1),  # 工作进程数，大于1时自动开启共享状态
+    },
+    'http': {
+        'pool_maxsize': get_setting('http', 'pool_maxsize', 16),  # 每个上游服务商保持的长连接数
+        'connect_timeout': get_setting('http', 'connect_timeout', 5),  # 建立连接的超时时间（秒）
+        'read_timeout': get_setting('http', 'read_timeout', 30),  # 等待响应的超时时间（秒）
+        'keepalive_expiry': get_setting('http', 'keepalive_expiry', 60),  # 空闲连接保留时间（秒）
+    },
+    'admission': {
+        # 每个上游服务商的并发上限和排队上限，超出排队上限的请求直接返回繁忙
+        # 上限是所有工作进程合计的值：koishi.workers大于1时每个进程分得上限除以进程数（至少为1）
+        'deepseek': {
+            'max_concurrency': get_setting('admission', 'deepseek_max_concurrency', 16),
+            'max_queue': get_setting('admission', 'deepseek_max_queue', 64),
+        },
+        'kimi': {
+            'max_concurrency': get_setting('admission', 'kimi_max_concurrency', 4),
+            'max_queue': get_setting('admission', 'kimi_max_queue', 16),
+        },
+        'dashscope': {
+            'max_concurrency': get_setting('admission', 'dashscope_max_concurrency', 4),
+            'max_queue': get_setting('admission', 'dashscope_max_queue', 16),
+        },
+        'queue_timeout': get_setting('admission', 'queue_timeout', 10),  # 排队等待的最长时间（秒）
+    },
+    'shared_state': {
+        'enabled': bool(get_setting('shared_state', 'enabled', False) or os.environ.get(SHARED_STATE_ENV) == '1'),
+        'path': get_setting('shared_state', 'path', os.path.join(PROJECT_ROOT, 'data', 'shared_state.db')),
+    },
     'database': {
         'host': 'localhost',
         'user': 'root',
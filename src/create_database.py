@@ -46,9 +46,14 @@ def execute_sql_file(sql_file_path):
                     cursor.execute(statement)
                 except Error as e:
                     print("执行语句时出错 (可能会忽略某些非关键错误): %s", str(e))
-                    # 对于索引已存在的错误，我们可以忽略
+                    # 对于索引已存在或要删除的旧索引不存在的错误，我们可以忽略
                     if "Duplicate key name" in str(e):
                         print("  忽略重复索引错误")
+                    elif "check that column/key exists" in str(e):
+                        print("  忽略不存在的旧索引")
+                    elif "FULLTEXT" in statement:
+                        # 服务器不支持ngram全文索引时，检索会改用进程内倒排索引
+                        print("  跳过全文索引，关键词检索将使用进程内索引")
                     else:
                         # 如果是其他错误，重新抛出
                         raise e
@@ -67,6 +72,34 @@ def execute_sql_file(sql_file_path):
     return True
 
 
+def report_fulltext_index():
+    """检查chat_history上的全文索引是否已添加
+
+    全文索引只由init_database.sql添加，服务运行时不会再执行ALTER TABLE；
+    旧版本创建的数据库重新运行本脚本即可完成迁移。
+    """
+    connection = None
+    try:
+        connection = mysql.connector.connect(
+            host=CONFIG['database']['host'],
+            user=CONFIG['database']['user'],
+            password=CONFIG['database']['password'],
+            database=CONFIG['database']['database']
+        )
+        cursor = connection.cursor()
+        cursor.execute("SHOW INDEX FROM chat_history WHERE Key_name = 'ft_chat_history'")
+        if cursor.fetchall():
+            print("全文索引 ft_chat_history 已就绪，关键词检索由MySQL完成")
+        else:
+            print("未能添加全文索引 ft_chat_history，关键词检索将使用进程内倒排索引")
+        cursor.close()
+    except Error as e:
+        print("检查全文索引时出错: %s", str(e))
+    finally:
+        if connection and connection.is_connected():
+            connection.close()
+
+
 def main():
     """主函数"""
     print("开始创建数据库和表...")
@@ -82,6 +115,7 @@ def main():
         print("执行SQL文件失败")
         return
 
+    report_fulltext_index()
     print("数据库和表创建完成!")
 
 
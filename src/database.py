@@ -1,43 +1,46 @@
 """数据库操作封装模块"""
 
+import base64
+import json
+import logging
 import os
+import threading
 import traceback
-import mysql.connector
+from datetime import datetime
 from mysql.connector import Error
 from colorama import Fore, init
 
 from .config import CONFIG
+from .db_pool import get_pool
+from .metrics import METRICS
+from .schema import get_schema
+from .search_index import NGRAM_SIZE, get_history_index, matches, query_words
+from .write_behind import WriteBehindWriter
 
 # 获取项目根目录
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-# 数据库文件路径
-DB_PATH = os.path.join(PROJECT_ROOT, 'data', 'chat_history.db')
+# SQLite存储后端的数据库文件路径（CONFIG['storage']['backend']为sqlite时使用）
+DB_PATH = CONFIG['storage']['sqlite_path']
 
 
 def get_connection():
-    """获取数据库连接
+    """从连接池借出一个数据库连接，使用完毕后调用close()归还
     
     Returns:
-        mysql.connector.connection.MySQLConnection: 数据库连接对象
+        PooledConnection: 数据库连接对象，连接失败时返回None
     """
     try:
-        connection = mysql.connector.connect(
-            host=CONFIG['database']['host'],
-            user=CONFIG['database']['user'],
-            password=CONFIG['database']['password'],
-            database=CONFIG['database']['database'],
-            charset='utf8mb4',
-            collation='utf8mb4_unicode_ci'
-        )
-        return connection
+        return get_pool().acquire()
     except Error as e:
         print(Fore.RED + f"数据库连接错误: {e}")
         return None
 
 
 def table_exists(cursor, table_name):
-    """检查表是否存在
+    """检查表是否存在，不存在时按登记的建表语句创建
+    
+    结果由SchemaRegistry缓存，同一张表只在第一次调用时访问数据库。
     
     Args:
         cursor: 数据库游标
@@ -46,40 +49,107 @@ def table_exists(cursor, table_name):
     Returns:
         bool: 表存在返回True，否则返回False
     """
-    cursor.execute("SHOW TABLES LIKE %s", (table_name,))
-    return cursor.fetchone() is not None
+    return get_schema().ensure(cursor, table_name)
+
+
+# 聊天记录表的字段（与SELECT *的顺序一致），分页查询只允许选择这些字段
+HISTORY_COLUMNS = ('id', 'user_input', 'ai_response', 'image_description', 'created_at')
+
+# chat_history上的全文索引名（见data/init_database.sql）
+FULLTEXT_INDEX = 'ft_chat_history'
+
+# 倒排索引每次从数据库补充的记录数
+INDEX_BATCH = 2000
+
+
+def encode_cursor(state):
+    """把分页状态编码为不透明的游标字符串"""
+    raw = json.dumps(state, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解码encode_cursor生成的游标
+
+    Raises:
+        ValueError: 游标格式不正确
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+    if not isinstance(state, dict):
+        raise ValueError(f"无效的游标: {cursor}")
+    return state
+
+
+def cursor_arguments(cursor):
+    """把游标转换为get_chat_history_page的参数
+
+    Raises:
+        ValueError: 游标格式不正确
+    """
+    state = decode_cursor(cursor)
+    try:
+        arguments = {
+            'limit': int(state['limit']),
+            'columns': list(state['columns']),
+            'ascending': bool(state['asc']),
+        }
+        for key in ('after_id', 'before_id'):
+            if key in state:
+                arguments[key] = int(state[key])
+        for key in ('since', 'until'):
+            if key in state:
+                arguments[key] = datetime.fromisoformat(state[key])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+    return arguments
 
 
 class DatabaseManager:
-    """数据库管理器类，用于处理与MySQL数据库的连接和操作"""
+    """数据库管理器类，用于处理聊天记录和角色信息的读写
+
+    存储后端由CONFIG['storage']['backend']决定：mysql（默认）或sqlite（WAL模式的本地文件），
+    两种后端的连接用法相同，语法不同的语句由连接池的方言（dialects模块）提供。
+    """
 
     def __init__(self):
         """初始化数据库连接"""
         # 初始化 colorama
         init(autoreset=True)
+        # 每次操作从共享连接池借用连接，多个线程可以同时访问数据库
+        self._pool = get_pool()
+        self._lock = threading.Lock()
 
         try:
-            self.connection = mysql.connector.connect(
-                host=CONFIG['database']['host'],
-                user=CONFIG['database']['user'],
-                password=CONFIG['database']['password'],
-                database=CONFIG['database']['database'],
-                charset='utf8mb4',
-                collation='utf8mb4_unicode_ci'
-            )
+            # 借出一次连接，确认数据库可用，同时检查并创建数据表
+            with self._pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    get_schema().ensure_all(cursor)
+                finally:
+                    cursor.close()
             print(Fore.GREEN + "数据库连接成功")
         except Error as e:
             print(Fore.RED + f"数据库连接错误: {e}")
             raise
 
+        # 开启延迟写入时，save_chat只把记录放入队列，由后台线程批量写入（首次保存时创建）
+        self._writer = None
+
     def get_character_info(self):
         """获取角色信息
         
         Returns:
             dict: 包含角色信息的字典
         """
+        connection = None
+        cursor = None
         try:
-            cursor = self.connection.cursor(dictionary=True)
+            connection = self._pool.acquire()
+            cursor = connection.cursor(dictionary=True)
             if table_exists(cursor, 'character_info'):
                 # 获取第一条记录，而不是特定名称的记录
                 cursor.execute("SELECT * FROM character_info LIMIT 1")
@@ -91,24 +161,79 @@ class DatabaseManager:
                 return CONFIG['character']
         except Error as e:
             print(Fore.RED + f"获取角色信息错误: {e}")
+            get_schema().handle_error(e)
             # 出现异常时使用配置文件中的默认值
             return CONFIG['character']
         finally:
-            if 'cursor' in locals():
+            if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
 
     def save_chat(self, user_input, ai_response, image_description=None):
         """保存对话记录，包括图片描述
 
+        开启延迟写入时立即返回，记录会在flush_interval秒内写入数据库。
+
         Args:
             user_input (str): 用户输入
             ai_response (str): AI回复
             image_description (str, optional): 图片描述
         """
+        settings = CONFIG['write_behind']
+        if not settings['enabled']:
+            self._insert_chat(user_input, ai_response, image_description)
+            return
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = WriteBehindWriter(
+                        self.save_chats,
+                        batch_size=settings['batch_size'],
+                        flush_interval=settings['flush_interval'],
+                        max_pending=settings['max_pending'],
+                        put_timeout=settings['put_timeout'],
+                        max_retries=settings['max_retries'],
+                        retry_backoff=settings['retry_backoff']
+                    )
+        self._writer.submit((user_input, ai_response, image_description))
+
+    def save_chats(self, rows):
+        """批量保存对话记录（一次executemany和一次提交）
+
+        Args:
+            rows (list): (用户输入, AI回复, 图片描述)元组的列表
+        """
+        connection = None
         cursor = None
         try:
-            print(f"开始保存聊天记录: {user_input[:20]}... -> {ai_response[:20]}...")
-            cursor = self.connection.cursor()
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
+            if table_exists(cursor, 'chat_history'):
+                cursor.executemany(
+                    "INSERT INTO chat_history (user_input, ai_response, image_description) VALUES (%s, %s, %s)",
+                    rows
+                )
+                connection.commit()
+                logging.debug("已批量保存 %d 条聊天记录", len(rows))
+        except Error as e:
+            get_schema().handle_error(e)
+            raise
+        finally:
+            # 写入失败时未提交的事务在归还连接时回滚
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def _insert_chat(self, user_input, ai_response, image_description=None):
+        """立即保存一条对话记录"""
+        connection = None
+        cursor = None
+        try:
+            logging.debug("开始保存聊天记录: %s... -> %s...", user_input[:20], ai_response[:20])
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
             if table_exists(cursor, 'chat_history'):
                 query = """
                 INSERT INTO chat_history 
@@ -116,15 +241,18 @@ class DatabaseManager:
                 VALUES (%s, %s, %s)
                 """
                 cursor.execute(query, (user_input, ai_response, image_description))
-                self.connection.commit()
-                print(f"聊天记录已成功保存！ID: {cursor.lastrowid}")
+                connection.commit()
+                logging.debug("聊天记录已成功保存！ID: %s", cursor.lastrowid)
         except Error as e:
             print(f"保存对话记录错误 [详细]: {e}")
+            get_schema().handle_error(e)
             # 打印堆栈跟踪以获取更多信息
             traceback.print_exc()
         finally:
             if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
 
     def get_chat_history(self, limit=50):
         """获取聊天历史记录
@@ -135,20 +263,204 @@ class DatabaseManager:
         Returns:
             list: 聊天记录列表
         """
+        rows, _ = self.get_chat_history_page(limit=limit)
+        return rows
+
+    def get_chat_history_page(self, limit=50, after_id=None, before_id=None, since=None, until=None,
+                              columns=None, ascending=False):
+        """按主键游标分页获取聊天记录
+
+        使用WHERE id < before_id（或id > after_id）定位页面而不是OFFSET，
+        无论翻到第几页都只读取limit+1行。
+
+        Args:
+            limit (int): 每页记录数
+            after_id (int, optional): 只返回ID大于该值的记录
+            before_id (int, optional): 只返回ID小于该值的记录
+            since (datetime, optional): 只返回created_at不早于该时间的记录
+            until (datetime, optional): 只返回created_at早于该时间的记录
+            columns (list, optional): 返回的字段，必须在HISTORY_COLUMNS中，默认全部字段；
+                id总是作为第一个字段返回
+            ascending (bool): 按ID升序返回，默认降序（最新记录在前）
+
+        Returns:
+            tuple: (记录列表, 下一页的游标)，没有下一页时游标为None
+
+        Raises:
+            ValueError: columns中包含未知字段
+        """
+        columns = list(columns or HISTORY_COLUMNS)
+        unknown = [column for column in columns if column not in HISTORY_COLUMNS]
+        if unknown:
+            raise ValueError(f"未知字段: {', '.join(unknown)}")
+        if 'id' in columns:
+            columns.remove('id')
+        columns.insert(0, 'id')
+
+        conditions, params = [], []
+        if after_id is not None:
+            conditions.append("id > %s")
+            params.append(int(after_id))
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(int(before_id))
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < %s")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "ASC" if ascending else "DESC"
+        # 多取一行，用来判断是否还有下一页
+        query = f"SELECT {', '.join(columns)} FROM chat_history {where} ORDER BY id {order} LIMIT %s"
+        params.append(int(limit) + 1)
+
+        connection = None
         cursor = None
         try:
-            cursor = self.connection.cursor()
-            if table_exists(cursor, 'chat_history'):
-                # 改为降序，优先显示最新记录
-                cursor.execute("SELECT * FROM chat_history ORDER BY id DESC LIMIT %s", (limit,))
-                return cursor.fetchall()
-            return []
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
+            if not table_exists(cursor, 'chat_history'):
+                return [], None
+            cursor.execute(query, tuple(params))
+            rows = cursor.fetchall()
         except Error as e:
             print(f"获取聊天记录错误: {e}")
-            return []
+            get_schema().handle_error(e)
+            return [], None
         finally:
             if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
+
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        state = {'limit': int(limit), 'columns': columns, 'asc': ascending}
+        # 下一页从本页最后一条记录之后继续，另一侧的边界和时间范围保持不变
+        if ascending:
+            state['after_id'] = rows[-1][0]
+            if before_id is not None:
+                state['before_id'] = int(before_id)
+        else:
+            state['before_id'] = rows[-1][0]
+            if after_id is not None:
+                state['after_id'] = int(after_id)
+        if since is not None:
+            state['since'] = since.isoformat()
+        if until is not None:
+            state['until'] = until.isoformat()
+        return rows, encode_cursor(state)
+
+    def search_chat_history(self, query, limit=50, before_id=None):
+        """按关键词检索聊天记录（用户输入、AI回复和图片描述）
+
+        表上有FULLTEXT（ngram）索引时使用MATCH ... AGAINST检索，ngram解析器不会为短于
+        NGRAM_SIZE的关键词（例如单个汉字）建立索引，这些关键词用LIKE过滤；全部关键词都太短或者
+        没有全文索引时使用进程内倒排索引，每次检索前只为新增的记录补充索引。
+        多个关键词用空格分隔，需要全部出现。结果按ID降序排列，使用游标翻页。
+
+        Args:
+            query (str): 检索语句
+            limit (int): 每页记录数
+            before_id (int, optional): 只返回ID小于该值的记录（翻页用）
+
+        Returns:
+            tuple: (记录列表, 下一页的游标)，没有下一页时游标为None
+        """
+        words = query_words(query)
+        if not words:
+            return [], None
+        METRICS.incr('history_search_queries')
+        connection = None
+        cursor = None
+        try:
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
+            if not table_exists(cursor, 'chat_history'):
+                return [], None
+            if (any(len(word) >= NGRAM_SIZE for word in words)
+                    and get_schema().has_index(cursor, 'chat_history', FULLTEXT_INDEX)):
+                rows = self._search_fulltext(cursor, words, limit + 1, before_id)
+            else:
+                rows = self._search_index(cursor, query, words, limit + 1, before_id)
+        except Error as e:
+            print(f"检索聊天记录错误: {e}")
+            get_schema().handle_error(e)
+            return [], None
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor({'q': query, 'limit': int(limit), 'before_id': rows[-1][0]})
+
+    @staticmethod
+    def _search_fulltext(cursor, words, limit, before_id):
+        """使用MySQL全文索引检索（words中至少有一个关键词不短于NGRAM_SIZE）"""
+        # 布尔模式下每个关键词作为必须出现的短语
+        against = ' '.join(f'+"{word}"' for word in words if len(word) >= NGRAM_SIZE)
+        query = ("SELECT * FROM chat_history "
+                 "WHERE MATCH(user_input, ai_response, image_description) AGAINST (%s IN BOOLEAN MODE)")
+        params = [against]
+        for word in words:
+            if len(word) < NGRAM_SIZE:
+                # 全文索引中没有的短关键词在MATCH筛选出的记录中用LIKE确认
+                query += " AND CONCAT_WS(' ', user_input, ai_response, image_description) LIKE %s"
+                escaped = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append(f"%{escaped}%")
+        if before_id is not None:
+            query += " AND id < %s"
+            params.append(int(before_id))
+        query += " ORDER BY id DESC LIMIT %s"
+        params.append(int(limit))
+        cursor.execute(query, tuple(params))
+        return cursor.fetchall()
+
+    @staticmethod
+    def _search_index(cursor, query, words, limit, before_id):
+        """使用进程内倒排索引检索，候选记录取出原文后再确认"""
+        index = get_history_index()
+        # 为上次建立索引之后新增的记录补充索引
+        while True:
+            cursor.execute(
+                "SELECT id, user_input, ai_response, image_description FROM chat_history "
+                "WHERE id > %s ORDER BY id ASC LIMIT %s",
+                (index.last_id, INDEX_BATCH)
+            )
+            batch = cursor.fetchall()
+            for record_id, user_input, ai_response, image_description in batch:
+                index.add(record_id, user_input, ai_response, image_description)
+            if len(batch) < INDEX_BATCH:
+                break
+        METRICS.set_gauge('history_search_index_documents', index.documents)
+
+        candidates = index.search(query, before_id)
+        rows, deleted = [], []
+        for start in range(0, len(candidates), limit * 2):
+            chunk = candidates[start:start + limit * 2]
+            placeholders = ','.join(['%s'] * len(chunk))
+            cursor.execute(f"SELECT * FROM chat_history WHERE id IN ({placeholders})", tuple(chunk))
+            found = {row[0]: row for row in cursor.fetchall()}
+            for record_id in chunk:
+                row = found.get(record_id)
+                if row is None:
+                    deleted.append(record_id)
+                elif matches(words, row[1], row[2], row[3]):
+                    rows.append(row)
+                    if len(rows) >= limit:
+                        break
+            if len(rows) >= limit:
+                break
+        # 已经被删除的记录从索引中移除
+        index.discard(deleted)
+        return rows
 
     def delete_chat_record(self, record_id):
         """删除指定聊天记录
@@ -156,31 +468,42 @@ class DatabaseManager:
         Args:
             record_id (int): 要删除的记录ID
         """
+        connection = None
         cursor = None
         try:
-            cursor = self.connection.cursor()
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
             if table_exists(cursor, 'chat_history'):
                 cursor.execute("DELETE FROM chat_history WHERE id = %s", (record_id,))
-                self.connection.commit()
+                connection.commit()
         except Error as e:
             print(f"删除聊天记录错误: {e}")
+            get_schema().handle_error(e)
         finally:
             if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
 
     def clear_chat_history(self):
         """清空所有聊天记录"""
+        connection = None
         cursor = None
         try:
-            cursor = self.connection.cursor()
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
             if table_exists(cursor, 'chat_history'):
                 cursor.execute("DELETE FROM chat_history")
-                self.connection.commit()
+                connection.commit()
+                get_history_index().clear()
         except Error as e:
             print(f"清空聊天记录错误: {e}")
+            get_schema().handle_error(e)
         finally:
             if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
 
     def delete_first_n_records(self, n):
         """删除前N条记录
@@ -188,26 +511,32 @@ class DatabaseManager:
         Args:
             n (int): 要删除的记录数
         """
+        connection = None
         cursor = None
         try:
-            cursor = self.connection.cursor()
+            connection = self._pool.acquire()
+            cursor = connection.cursor()
             if table_exists(cursor, 'chat_history'):
-                cursor.execute("SELECT id FROM chat_history ORDER BY id ASC LIMIT %s", (n,))
-                ids = [r[0] for r in cursor.fetchall()]
-                if ids:
-                    # 使用参数化查询避免SQL注入
-                    format_strings = ','.join(['%s'] * len(ids))
-                    query = f"DELETE FROM chat_history WHERE id IN ({format_strings})"
-                    cursor.execute(query, tuple(ids))
-                    self.connection.commit()
+                self._pool.dialect.delete_oldest(cursor, 'chat_history', n)
+                connection.commit()
         except Error as e:
             print(f"删除前N条记录错误: {e}")
+            get_schema().handle_error(e)
         finally:
             if cursor:
                 cursor.close()
+            if connection:
+                connection.close()
+
+    def flush(self):
+        """等待延迟写入队列中的记录全部写入"""
+        if self._writer is not None:
+            self._writer.flush()
 
     def close(self):
-        """关闭数据库连接"""
-        if self.connection.is_connected():
-            self.connection.close()
-            print(Fore.YELLOW + "数据库连接已关闭")
+        """写完延迟写入队列中的记录
+
+        连接由进程内共享的连接池管理，这里不会断开数据库连接。
+        """
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,252 @@
+"""数据库连接池模块，DatabaseManager、Web管理接口和命令行工具共用同一组数据库连接
+
+CONFIG['storage']['backend']为sqlite时使用sqlite_backend.SQLitePool，接口相同。
+"""
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+from .config import CONFIG
+from .dialects import MYSQL
+from .metrics import METRICS
+
+
+def _connect():
+    """按CONFIG['database']建立一个新的MySQL连接"""
+    METRICS.incr('db_pool_connections_opened')
+    return mysql.connector.connect(
+        host=CONFIG['database']['host'],
+        user=CONFIG['database']['user'],
+        password=CONFIG['database']['password'],
+        database=CONFIG['database']['database'],
+        charset='utf8mb4',
+        collation='utf8mb4_unicode_ci'
+    )
+
+
+class PooledConnection:
+    """从连接池借出的连接
+
+    用法与MySQLConnection相同，close()不会断开连接，而是把连接还给连接池。
+    """
+
+    def __init__(self, pool: "ConnectionPool", connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            raise PoolError("连接已归还给连接池")
+        return getattr(self._connection, name)
+
+    def close(self):
+        """归还连接（可以重复调用）"""
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """固定大小的MySQL连接池
+
+    连接按需创建，最多size个；连接都被占用时借用方最多等待checkout_timeout秒，
+    超时抛出PoolError（Error的子类，原有的except Error同样能捕获）。
+    空闲超过health_check_idle秒的连接在借出前先ping一次，服务端因wait_timeout
+    断开的连接会被替换为新连接。指标名以db_pool为前缀。
+    连接池关闭后，仍在借用中的连接归还时直接断开，不再放回连接池。
+    """
+
+    dialect = MYSQL
+
+    def __init__(self, size: int, checkout_timeout: float, health_check_idle: float):
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_idle = health_check_idle
+        # 后进先出，优先复用刚归还的连接，长时间空闲的连接留在队尾
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.in_use = 0
+
+    def _open(self):
+        """在名额内新建一个连接，名额已满时返回None"""
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            return _connect()
+        except Error:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, connection):
+        """关闭一个连接并释放它占用的名额"""
+        with self._lock:
+            self._created -= 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def _check(self, connection, idle_since):
+        """检查空闲连接是否仍然可用，不可用时换成新连接"""
+        if time.monotonic() - idle_since < self.health_check_idle:
+            return connection
+        METRICS.incr('db_pool_health_checks')
+        try:
+            connection.ping(reconnect=False)
+            return connection
+        except Error:
+            METRICS.incr('db_pool_reconnects')
+            try:
+                connection.close()
+            except Error:
+                pass
+            return _connect()
+
+    def _checkout(self):
+        if self._closed:
+            raise PoolError("连接池已关闭")
+        start = time.monotonic()
+        try:
+            connection, idle_since = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._open()
+            idle_since = None
+            if connection is None:
+                try:
+                    connection, idle_since = self._idle.get(timeout=self.checkout_timeout)
+                except queue.Empty:
+                    METRICS.incr('db_pool_timeouts')
+                    raise PoolError(f"等待数据库连接超时（{self.checkout_timeout}秒，连接池大小{self.size}）")
+
+        if idle_since is not None:
+            try:
+                connection = self._check(connection, idle_since)
+            except Error:
+                self._discard(connection)
+                raise
+
+        METRICS.incr('db_pool_checkouts')
+        METRICS.incr('db_pool_wait_seconds', time.monotonic() - start)
+        with self._lock:
+            self.in_use += 1
+            METRICS.set_gauge('db_pool_in_use', self.in_use)
+        return connection
+
+    def acquire(self) -> PooledConnection:
+        """借出一个连接，使用完毕后调用close()归还
+
+        Raises:
+            mysql.connector.Error: 无法连接数据库或等待超时
+        """
+        return PooledConnection(self, self._checkout())
+
+    def release(self, connection):
+        """归还连接，未提交的事务会被回滚"""
+        with self._lock:
+            self.in_use -= 1
+            METRICS.set_gauge('db_pool_in_use', self.in_use)
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except Error:
+            # 连接已经断开，不再放回连接池
+            self._discard(connection)
+            return
+        with self._lock:
+            # 与close()共用锁，关闭后不会再有连接放回空闲队列
+            if not self._closed:
+                self._idle.put((connection, time.monotonic()))
+                return
+        self._discard(connection)
+
+    @contextmanager
+    def connection(self):
+        """借用一个连接，退出with块时自动归还"""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def close(self):
+        """关闭连接池：断开所有空闲连接，借用中的连接在归还时断开"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回连接池大小、占用情况和平均等待时间"""
+        checkouts = METRICS.get('db_pool_checkouts')
+        wait_seconds = METRICS.get('db_pool_wait_seconds')
+        return {
+            'backend': self.dialect.name,
+            'size': self.size,
+            'created': self._created,
+            'in_use': self.in_use,
+            'idle': self._idle.qsize(),
+            'utilization': round(self.in_use / self.size, 4) if self.size else 0.0,
+            'checkouts': checkouts,
+            'timeouts': METRICS.get('db_pool_timeouts'),
+            'reconnects': METRICS.get('db_pool_reconnects'),
+            'connections_opened': METRICS.get('db_pool_connections_opened'),
+            'avg_wait_ms': round(wait_seconds / checkouts * 1000, 2) if checkouts else 0.0
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """获取进程内共享的连接池（首次使用时按存储后端创建）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None and CONFIG['storage']['backend'] == 'sqlite':
+                from .sqlite_backend import SQLitePool
+                _pool = SQLitePool(CONFIG['storage']['sqlite_path'])
+            elif _pool is None:
+                settings = CONFIG['db_pool']
+                _pool = ConnectionPool(
+                    size=settings['size'],
+                    checkout_timeout=settings['checkout_timeout'],
+                    health_check_idle=settings['health_check_idle']
+                )
+    return _pool
+
+
+def reset_pool():
+    """关闭并丢弃当前连接池，数据库配置修改后调用，下次使用时按新配置重建"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def db_pool_stats() -> Dict[str, Any]:
+    """返回连接池统计信息，连接池尚未创建时返回空字典"""
+    return _pool.stats() if _pool is not None else {}
@@ -0,0 +1,64 @@
+"""SQL方言模块，把两种存储后端语法不同的语句集中在各自的方言类中
+
+DatabaseManager、SchemaRegistry等调用方只使用这里的方法，不需要判断存储后端，
+也不需要改写SQL文本。语句统一使用%s占位符，SQLite游标执行前换成?。
+"""
+
+from .config import CONFIG
+
+
+class MySQLDialect:
+    """MySQL语法"""
+
+    name = 'mysql'
+
+    def table_exists(self, cursor, table_name: str) -> bool:
+        """检查表是否存在"""
+        cursor.execute("SHOW TABLES LIKE %s", (table_name,))
+        return cursor.fetchone() is not None
+
+    def index_exists(self, cursor, table_name: str, index_name: str) -> bool:
+        """检查表上是否有指定的索引"""
+        cursor.execute(f"SHOW INDEX FROM {table_name} WHERE Key_name = %s", (index_name,))
+        return bool(cursor.fetchall())
+
+    def delete_oldest(self, cursor, table_name: str, count: int):
+        """删除ID最小的count条记录"""
+        # 单表DELETE支持ORDER BY和LIMIT，一条语句完成
+        cursor.execute(f"DELETE FROM {table_name} ORDER BY id ASC LIMIT %s", (count,))
+
+
+class SQLiteDialect:
+    """SQLite语法：表和索引信息从sqlite_master读取，DELETE不支持LIMIT"""
+
+    name = 'sqlite'
+
+    def table_exists(self, cursor, table_name: str) -> bool:
+        """检查表是否存在"""
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", (table_name,))
+        return cursor.fetchone() is not None
+
+    def index_exists(self, cursor, table_name: str, index_name: str) -> bool:
+        """检查表上是否有指定的索引"""
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+            (table_name, index_name)
+        )
+        return bool(cursor.fetchall())
+
+    def delete_oldest(self, cursor, table_name: str, count: int):
+        """删除ID最小的count条记录"""
+        cursor.execute(
+            f"DELETE FROM {table_name} WHERE id IN (SELECT id FROM {table_name} ORDER BY id ASC LIMIT %s)",
+            (count,)
+        )
+
+
+MYSQL = MySQLDialect()
+SQLITE = SQLiteDialect()
+DIALECTS = {dialect.name: dialect for dialect in (MYSQL, SQLITE)}
+
+
+def get_dialect():
+    """返回CONFIG['storage']['backend']对应的方言（与get_pool()一致，未知的值按MySQL处理）"""
+    return DIALECTS.get(CONFIG['storage']['backend'], MYSQL)
@@ -0,0 +1,132 @@
+"""HTTP客户端模块，为每个上游服务商维护带连接池的长连接会话"""
+
+import threading
+from typing import Any, Dict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .config import CONFIG
+from .metrics import METRICS
+
+# 已知的上游服务商：DeepSeek对话、Kimi搜索、阿里云通义图片识别、下载用户发送的图片
+PROVIDERS = ("deepseek", "kimi", "dashscope", "images")
+
+
+def _counting_pool(base, provider):
+    """创建会统计新建连接数的urllib3连接池类"""
+
+    class CountingPool(base):
+        def _new_conn(self):
+            METRICS.incr(f'http_{provider}_connections_opened')
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class _PooledAdapter(HTTPAdapter):
+    """为连接池加上新建连接计数的HTTPAdapter"""
+
+    def __init__(self, provider, **kwargs):
+        self.provider = provider
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self.provider),
+            'https': _counting_pool(HTTPSConnectionPool, self.provider),
+        }
+
+
+class ProviderSession(requests.Session):
+    """单个上游服务商的requests会话，复用TCP/TLS连接并带有默认超时"""
+
+    def __init__(self, provider: str, pool_maxsize: int, timeout):
+        super().__init__()
+        self.provider = provider
+        self.timeout = timeout
+        adapter = _PooledAdapter(provider, pool_connections=4, pool_maxsize=pool_maxsize, pool_block=False)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        METRICS.incr(f'http_{self.provider}_requests')
+        return super().request(method, url, **kwargs)
+
+
+_sessions = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_session(provider: str) -> ProviderSession:
+    """获取上游服务商的同步会话（进程内共享，线程安全）
+
+    Args:
+        provider (str): 服务商名称，见PROVIDERS
+    """
+    session = _sessions.get(provider)
+    if session is None:
+        with _clients_lock:
+            session = _sessions.get(provider)
+            if session is None:
+                settings = CONFIG['http']
+                session = ProviderSession(
+                    provider,
+                    pool_maxsize=settings['pool_maxsize'],
+                    timeout=(settings['connect_timeout'], settings['read_timeout'])
+                )
+                _sessions[provider] = session
+    return session
+
+
+def get_async_client(provider: str) -> httpx.AsyncClient:
+    """获取上游服务商的异步客户端（进程内共享）
+
+    Args:
+        provider (str): 服务商名称，见PROVIDERS
+    """
+    client = _async_clients.get(provider)
+    if client is None or client.is_closed:
+        settings = CONFIG['http']
+
+        async def trace(event_name, info):
+            # httpcore在建立新的TCP连接时触发该事件，复用连接时不会触发
+            if event_name == 'connection.connect_tcp.complete':
+                METRICS.incr(f'http_{provider}_connections_opened')
+
+        async def on_request(request):
+            METRICS.incr(f'http_{provider}_requests')
+            request.extensions['trace'] = trace
+
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+            limits=httpx.Limits(
+                max_connections=settings['pool_maxsize'],
+                max_keepalive_connections=settings['pool_maxsize'],
+                keepalive_expiry=settings['keepalive_expiry']
+            ),
+            event_hooks={'request': [on_request]}
+        )
+        _async_clients[provider] = client
+    return client
+
+
+def http_client_stats() -> Dict[str, Any]:
+    """返回每个服务商的请求数、新建连接数和连接复用率"""
+    stats = {}
+    for provider in PROVIDERS:
+        total = METRICS.get(f'http_{provider}_requests')
+        opened = METRICS.get(f'http_{provider}_connections_opened')
+        if not total:
+            continue
+        stats[provider] = {
+            'requests': total,
+            'connections_opened': opened,
+            'reuse_ratio': round(max(total - opened, 0) / total, 4)
+        }
+    return stats
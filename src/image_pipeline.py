@@ -0,0 +1,123 @@
+"""图片预处理模块，在上传给视觉模型之前缩小和重新压缩图片"""
+
+import asyncio
+import base64
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from .config import CONFIG
+from .metrics import METRICS
+
+_executor = None
+
+
+def _get_executor():
+    """获取执行图片处理的线程池或进程池（首次使用时创建）"""
+    global _executor
+    if _executor is None:
+        settings = CONFIG['image_pipeline']
+        if settings['executor'] == 'process':
+            _executor = ProcessPoolExecutor(max_workers=settings['max_workers'])
+        else:
+            _executor = ThreadPoolExecutor(max_workers=settings['max_workers'], thread_name_prefix="image")
+    return _executor
+
+
+def _to_rgb(img):
+    """转换为RGB，透明背景填充为白色"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _encode(img, target_bytes, quality_ladder):
+    """按质量阶梯依次编码为JPEG，直到大小不超过target_bytes
+
+    Returns:
+        bytes: 编码结果（所有质量都超出时返回最低质量的结果）
+    """
+    data = b''
+    for quality in quality_ladder:
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if len(data) <= target_bytes:
+            break
+    return data
+
+
+def _process(image_data, max_edge, target_bytes, quality_ladder):
+    """处理一张图片，返回结果和统计信息（可以在子进程中执行）"""
+    base64_data = image_data.split(',', 1)[1] if ',' in image_data else image_data
+    start = time.perf_counter()
+    raw = base64.b64decode(base64_data)
+    stats = {'input_bytes': len(raw), 'output_bytes': len(raw), 'passthrough': 0,
+             'decode_seconds': 0.0, 'encode_seconds': 0.0}
+
+    img = Image.open(BytesIO(raw))
+    if img.format == 'JPEG' and max(img.size) <= max_edge and len(raw) <= target_bytes:
+        stats['passthrough'] = 1
+        return base64_data, stats
+
+    if img.format == 'JPEG':
+        # 让解码器以1/2、1/4、1/8的比例直接输出，避免解码完整分辨率
+        img.draft('RGB', (max_edge, max_edge))
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge))
+    img = _to_rgb(img)
+    decoded = time.perf_counter()
+    stats['decode_seconds'] = decoded - start
+
+    data = _encode(img, target_bytes, quality_ladder)
+    stats['encode_seconds'] = time.perf_counter() - decoded
+    if len(data) >= len(raw):
+        return base64_data, stats
+    stats['output_bytes'] = len(data)
+    return base64.b64encode(data).decode('utf-8'), stats
+
+
+def _record(stats):
+    """把一次处理的统计信息写入指标"""
+    METRICS.incr('image_pipeline_images')
+    for name, value in stats.items():
+        METRICS.incr(f'image_pipeline_{name}', value)
+
+
+def _arguments(image_data, max_edge=None, target_bytes=None):
+    settings = CONFIG['image_pipeline']
+    return (image_data, max_edge or settings['max_edge'], target_bytes or settings['target_bytes'],
+            tuple(settings['quality_ladder']))
+
+
+def prepare_image(image_data: str, max_edge: int = None, target_bytes: int = None) -> str:
+    """缩小并重新压缩一张图片
+
+    只读取图片头判断尺寸和格式，已经足够小的JPEG原样返回，不解码像素；
+    需要处理的JPEG使用draft模式在解码时直接按比例缩小，然后缩放到max_edge以内，
+    再按质量阶梯编码，选用第一个不超过target_bytes的结果。
+
+    Args:
+        image_data (str): Base64图片数据（可带data URI前缀）
+        max_edge (int): 最长边像素数，默认使用配置
+        target_bytes (int): 目标大小（字节），默认使用配置
+
+    Returns:
+        str: 处理后的Base64数据（不带前缀），没有变小时返回原始数据
+    """
+    result, stats = _process(*_arguments(image_data, max_edge, target_bytes))
+    _record(stats)
+    return result
+
+
+async def prepare_image_async(image_data: str) -> str:
+    """在线程池或进程池中处理图片，事件循环中不执行任何PIL操作"""
+    loop = asyncio.get_running_loop()
+    result, stats = await loop.run_in_executor(_get_executor(), _process, *_arguments(image_data))
+    _record(stats)
+    return result
@@ -1,168 +1,30 @@
 # koishi_service.py
+import asyncio
+import os
 import socket
+from contextlib import asynccontextmanager
 import uvicorn
 from fastapi import FastAPI, Request
+from .admission import AdmissionRejected, admission_stats, get_admission
 from .ai_chat_system import AIChatSystem
 import time
 import json
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 # 确保正确导入 colorama
 from colorama import Fore, init
+from .config import CONFIG, SHARED_STATE_ENV, WORKERS_ENV
 from .database import DatabaseManager
-from .shared_utils import create_chat_completion_response, create_error_response, create_streaming_response_chunk, extract_user_input
+from .http_clients import http_client_stats
+from .db_pool import db_pool_stats
+from .metrics import METRICS, record_token_usage_async
+from .shared_state import get_shared_state
+from .session_store import resolve_session_id
+from .shared_utils import create_chat_completion_response, create_error_response, extract_user_input
+from .single_flight import SingleFlight, request_flight_key
+from .sse_writer import sse_event_stream
 
 init(autoreset=True)
 
-app = FastAPI()
-
-chat_system = AIChatSystem()
-chat_system.db = DatabaseManager()
-
-
-@app.post("/v1/chat/completions")
-async def chat_completions(request: Request):
-    try:
-        data = await request.json()
-        print(Fore.CYAN + f"收到请求: {data}")
-
-        # 动态选择模型，后端支持 deepseek-chat / deepseek-vl / o4-mini-preview
-        selected_model = data.get("model", "deepseek-chat")
-
-        # 新增：neko 模型专属处理
-        if selected_model == "neko":
-            user_input = ""
-            image_data = None
-            for msg in reversed(data.get("messages", [])):
-                if msg.get("role") == "user":
-                    content = msg.get("content", "")
-                    if isinstance(content, list):
-                        for item in content:
-                            if isinstance(item, dict) and item.get("type") == "text":
-                                user_input += item.get("text", "")
-                            elif isinstance(item, dict) and item.get("type") == "image_url":
-                                image_data = item.get("image_url", {}).get("url")
-                    else:
-                        user_input = content
-                    break
-
-            response_text = chat_system.chat(user_input, image=image_data)
-            return create_chat_completion_response(response_text, "neko")
-
-        # 提取用户消息
-        user_input = ""
-        messages = data.get('messages', [])
-        for msg in reversed(messages):
-            if msg.get('role') == 'user':
-                user_input = msg.get('content', "")
-                break
-
-        print(Fore.GREEN + f"用户输入: {user_input}")
-
-        stream_mode = data.get("stream", False)
-        if stream_mode:
-            async def event_generator():
-                content_accum = ""
-                # 逐块请求 API 并推送
-                for chunk in chat_system.client.chat.completions.create(
-                        model=selected_model,
-                        messages=chat_system.messages + [{"role": "user", "content": user_input}],
-                        temperature=0.7, max_tokens=200, timeout=30, stream=True
-                ):
-                    # 修改这里，从属性读取 content
-                    delta = getattr(chunk.choices[0].delta, "content", "")
-                    if delta:
-                        content_accum += delta
-                        payload = {
-                            "choices": [{
-                                "delta": {"content": delta},
-                                "index": 0,
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(payload)}\n\n"
-                chat_system.db.save_chat(user_input, content_accum)
-                yield "data: [DONE]\n\n"
-
-            return StreamingResponse(event_generator(), media_type="text/event-stream")
-
-        # 调用 DeepSeek 接口，使用动态模型
-        response = chat_system.client.chat.completions.create(
-            model=selected_model,
-            messages=chat_system.messages + [{"role": "user", "content": user_input}],
-            temperature=0.7,
-            max_tokens=200,
-            timeout=30
-        )
-        ai_response = response.choices[0].message.content
-        chat_system.messages.append({"role": "assistant", "content": ai_response})
-        chat_system.db.save_chat(user_input, ai_response)
-
-        # 提取 usage 信息
-        usage_info = getattr(response, "usage", None)
-        result = {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": selected_model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": ai_response
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": usage_info.prompt_tokens if usage_info else 0,
-                "completion_tokens": usage_info.completion_tokens if usage_info else 0,
-                "total_tokens": usage_info.total_tokens if usage_info else 0
-            }
-        }
-
-        print(Fore.CYAN + f"发送响应: {result}")
-        return result
-
-    except Exception as e:
-        # 确保data变量在异常处理中可用
-        model_name = "deepseek-chat"
-        if 'data' in locals() and data is not None:
-            model_name = data.get("model", "deepseek-chat")
-        return create_error_response(e, model_name, data if 'data' in locals() else None)
-
-
-@app.get("/")
-async def root():
-    """根路径返回服务信息"""
-    return {
-        "service": "Koishi API Service",
-        "endpoints": [
-            "/v1/chat/completions (POST)",
-            "/v1/models (GET)",
-            "/health (GET)"
-        ]
-    }
-
-
-@app.get("/v1/models")
-async def model_list():
-    """返回支持的模型列表"""
-    return {
-        "object": "list",
-        "data": [
-            {"id": "deepseek-chat", "object": "model", "created": int(time.time()), "owned_by": "local"},
-            {"id": "deepseek-v1", "object": "model", "created": int(time.time()), "owned_by": "local"},
-            {"id": "neko", "object": "model", "created": int(time.time()), "owned_by": "neko"}  # 添加neko模型
-        ]
-    }
-
-
-@app.get("/health")
-async def health_check():
-    """服务健康检查"""
-    return {"status": "ok", "service": "Koishi API"}
-
 
 def is_port_in_use(port: int) -> bool:
     """检查端口是否被占用"""
@@ -188,9 +50,13 @@ def find_available_port(start_port=5000, end_port=5100):
 
 def create_error_response(e, model_name, data=None):
     """创建统一的错误响应"""
-    import traceback
-    error_trace = traceback.format_exc()
-    print(Fore.RED + f"完整错误信息:\n{error_trace}")
+    if isinstance(e, AdmissionRejected):
+        # 过载时会有大量拒绝，不打印堆栈
+        print(Fore.YELLOW + f"请求被拒绝: {e}")
+    else:
+        import traceback
+        error_trace = traceback.format_exc()
+        print(Fore.RED + f"完整错误信息:\n{error_trace}")
     
     # 即使出现错误，也返回有效的JSON格式
     return {
@@ -212,10 +78,39 @@ def create_error_response(e, model_name, data=None):
     }
 
 
-def run_koishi_service():
-    """Koishi映射模式 (FastAPI服务)"""
+def create_busy_response(e, model_name):
+    """上游繁忙时返回429，响应体仍保持OpenAI格式"""
+    return JSONResponse(
+        status_code=429,
+        content=create_error_response(e, model_name),
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def create_app(chat_system=None):
+    """创建Koishi服务的FastAPI应用
+
+    这是uvicorn的应用工厂，多进程模式下每个工作进程各调用一次。
+    开启共享状态后，会话历史、Token计数和缓存保存在所有进程共用的SQLite中。
+
+    Args:
+        chat_system (AIChatSystem): 聊天系统实例，默认创建进程内的单例
+
+    Returns:
+        FastAPI: 应用实例
+    """
+    if chat_system is None:
+        chat_system = AIChatSystem()
+        chat_system.db = DatabaseManager()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        # 工作进程退出前写完延迟写入队列中的聊天记录
+        await asyncio.to_thread(chat_system.db.close)
+
     # 创建FastAPI应用
-    fastapi_app = FastAPI()
+    fastapi_app = FastAPI(lifespan=lifespan)
 
     # 添加CORS中间件
     from fastapi.middleware.cors import CORSMiddleware
@@ -227,14 +122,16 @@ def run_koishi_service():
         allow_headers=["*"],
     )
 
-    chat_system = AIChatSystem()
-    chat_system.db = DatabaseManager()
+    # 合并同时到达的相同请求（多实例广播、Koishi超时重试等）
+    flights = SingleFlight()
 
     @fastapi_app.post("/v1/chat/completions")
     async def openai_api(request: Request):
         try:
             data = await request.json()
             print(Fore.CYAN + f"收到请求: {data}")
+            session_id = resolve_session_id(data, request.headers)
+            flight_key = request_flight_key(request.url.path, data, request.headers, session_id)
 
             # 动态选择模型，后端支持 deepseek-chat / deepseek-vl / o4-mini-preview
             selected_model = data.get("model", "deepseek-chat")
@@ -256,7 +153,9 @@ def run_koishi_service():
                             user_input = content
                         break
 
-                response_text = chat_system.chat(user_input, image=image_data)
+                response_text = await flights.do(
+                    flight_key, lambda: chat_system.chat_async(user_input, image=image_data, session_id=session_id)
+                )
                 return {
                     "id": f"chatcmpl-{int(time.time())}",
                     "object": "chat.completion",
@@ -278,47 +177,72 @@ def run_koishi_service():
                     user_input = msg.get('content', "")
                     break
             print(Fore.GREEN + f"用户输入: {user_input}")
+            session = await chat_system.sessions.get_async(session_id)
+            user_message = {"role": "user", "content": user_input}
 
             stream_mode = data.get("stream", False)
             if stream_mode:
-                async def event_generator():
+                async def upstream_deltas():
                     content_accum = ""
-                    # 逐块请求 API 并推送
-                    for chunk in chat_system.client.chat.completions.create(
-                            model=selected_model,
-                            messages=chat_system.messages + [{"role": "user", "content": user_input}],
-                            temperature=0.7, max_tokens=200, timeout=30, stream=True
-                    ):
-                        # 修改这里，从属性读取 content
-                        delta = getattr(chunk.choices[0].delta, "content", "")
-                        if delta:
-                            content_accum += delta
-                            payload = {
-                                "choices": [{
-                                    "delta": {"content": delta},
-                                    "index": 0,
-                                    "finish_reason": None
-                                }]
-                            }
-                            yield f"data: {json.dumps(payload)}\n\n"
-                    chat_system.db.save_chat(user_input, content_accum)
-                    yield "data: [DONE]\n\n"
-
-                return StreamingResponse(event_generator(), media_type="text/event-stream")
-
-            # 调用 DeepSeek 接口，使用动态模型
-            response = chat_system.client.chat.completions.create(
-                model=selected_model,
-                messages=chat_system.messages + [{"role": "user", "content": user_input}],
-                temperature=0.7,
-                max_tokens=200,
-                timeout=30
-            )
-            ai_response = response.choices[0].message.content
-            chat_system.messages.append({"role": "assistant", "content": ai_response})
-            chat_system.db.save_chat(user_input, ai_response)
-
-            usage_info = getattr(response, "usage", None)
+                    async with session.async_lock:
+                        try:
+                            async with get_admission('deepseek').slot():
+                                # 逐块请求 API 并推送
+                                stream = await chat_system.async_client.chat.completions.create(
+                                    model=selected_model,
+                                    messages=chat_system.build_context(session, [user_message]),
+                                    temperature=0.7, max_tokens=200, timeout=30, stream=True
+                                )
+                                async for chunk in stream:
+                                    # 修改这里，从属性读取 content
+                                    delta = getattr(chunk.choices[0].delta, "content", "")
+                                    if delta:
+                                        content_accum += delta
+                                        yield delta
+                        except AdmissionRejected as e:
+                            # 响应头已经发出，只能把繁忙提示作为内容返回
+                            yield f"出错了喵({str(e)})"
+                            return
+                        await session.extend_async([user_message, {"role": "assistant", "content": content_accum}])
+                    await asyncio.to_thread(chat_system.db.save_chat, user_input, content_accum)
+
+                # 排队已满时在发出响应头之前直接返回429
+                get_admission('deepseek').check()
+                # 相同的请求共享同一个上游流，增量内容按时间和大小合并成帧后再推送
+                deltas = flights.stream(flight_key, upstream_deltas)
+                return StreamingResponse(sse_event_stream(deltas), media_type="text/event-stream")
+
+            async def complete():
+                # 调用 DeepSeek 接口，使用动态模型
+                async with session.async_lock:
+                    # 重复问题直接使用缓存的回复（需要在配置中开启）
+                    cache_key, ai_response = await chat_system.lookup_response_cache_async(
+                        session, user_input, model=selected_model
+                    )
+                    usage_info = None
+                    if ai_response is None:
+                        async with get_admission('deepseek').slot():
+                            response = await chat_system.async_client.chat.completions.create(
+                                model=selected_model,
+                                messages=chat_system.build_context(session, [user_message]),
+                                temperature=0.7,
+                                max_tokens=200,
+                                timeout=30
+                            )
+                        ai_response = response.choices[0].message.content
+                        # 提取 usage 信息
+                        usage_info = getattr(response, "usage", None)
+                        if usage_info:
+                            await record_token_usage_async(usage_info.prompt_tokens, usage_info.completion_tokens)
+                        if cache_key:
+                            await chat_system.response_cache.set_async(cache_key, ai_response)
+                    await session.extend_async([user_message, {"role": "assistant", "content": ai_response}])
+                await asyncio.to_thread(chat_system.db.save_chat, user_input, ai_response)
+                return ai_response, usage_info
+
+            # 相同的请求只调用一次上游、只保存一条记录
+            ai_response, usage_info = await flights.do(flight_key, complete)
+
             result = {
                 "id": f"chatcmpl-{int(time.time())}",
                 "object": "chat.completion",
@@ -343,6 +267,8 @@ def run_koishi_service():
             print(Fore.CYAN + f"发送响应: {result}")
             return result
 
+        except AdmissionRejected as e:
+            return create_busy_response(e, data.get("model", "deepseek-chat"))
         except Exception as e:
             # 确保data变量在异常处理中可用
             model_name = "deepseek-chat"
@@ -358,7 +284,8 @@ def run_koishi_service():
             "endpoints": [
                 "/v1/chat/completions (POST)",
                 "/v1/models (GET)",
-                "/health (GET)"
+                "/health (GET)",
+                "/metrics (GET)"
             ]
         }
 
@@ -379,6 +306,22 @@ def run_koishi_service():
         """服务健康检查"""
         return {"status": "ok", "service": "Koishi API"}
 
+    @fastapi_app.get("/metrics")
+    async def inner_metrics():
+        """返回运行指标（SSE帧率、字节速率、上游排队情况、连接复用率等）
+
+        多进程模式下METRICS只包含当前工作进程的数据，所有进程累计的Token数等
+        计数器在shared_counters中。
+        """
+        snapshot = METRICS.snapshot()
+        snapshot['admission'] = admission_stats()
+        snapshot['http_clients'] = http_client_stats()
+        snapshot['db_pool'] = db_pool_stats()
+        store = get_shared_state()
+        if store is not None:
+            snapshot['shared_counters'] = await asyncio.to_thread(store.counters)
+        return snapshot
+
     # 统一API接口，隐藏后端多个API的复杂性
     @fastapi_app.post("/v1/unified/chat/completions")
     async def unified_chat_completions(request: Request):
@@ -390,6 +333,8 @@ def run_koishi_service():
         try:
             data = await request.json()
             print(Fore.CYAN + f"收到统一API请求: {data}")
+            session_id = resolve_session_id(data, request.headers)
+            flight_key = request_flight_key(request.url.path, data, request.headers, session_id)
 
             # 提取用户消息
             messages = data.get('messages', [])
@@ -400,33 +345,27 @@ def run_koishi_service():
 
             stream_mode = data.get("stream", False)
             if stream_mode:
-                async def event_generator():
-                    # 调用AI聊天系统处理（会自动处理图片和搜索等）
-                    # 对于流式响应，我们先生成一个完整的回复，然后逐字发送
-                    if image_urls:
-                        # 如果有图片URL，传递第一张图片
-                        full_response = chat_system.chat(user_input, image=image_urls[0])
-                    else:
-                        # 否则只处理文本
-                        full_response = chat_system.chat(user_input)
-                    
-                    # 逐字发送响应
-                    for i, char in enumerate(full_response):
-                        payload = create_streaming_response_chunk(char)
-                        yield f"data: {json.dumps(payload)}\n\n"
-                    
-                    # 发送结束标记
-                    yield "data: [DONE]\n\n"
-
-                return StreamingResponse(event_generator(), media_type="text/event-stream")
+                # 调用AI聊天系统处理（会先完成图片和搜索等增强）
+                # 然后把上游生成的增量内容合并成帧推送，结束时发送[DONE]标记
+                image = image_urls[0] if image_urls else None
+                get_admission('deepseek').check()
+                deltas = flights.stream(
+                    flight_key, lambda: chat_system.chat_stream_async(user_input, image=image, session_id=session_id)
+                )
+                return StreamingResponse(sse_event_stream(deltas), media_type="text/event-stream")
 
             # 调用AI聊天系统处理（会自动处理图片和搜索等）
+            # 相同的请求共享同一次处理结果
             if image_urls:
                 # 如果有图片URL，传递第一张图片
-                response_text = chat_system.chat(user_input, image=image_urls[0])
+                response_text = await flights.do(
+                    flight_key, lambda: chat_system.chat_async(user_input, image=image_urls[0], session_id=session_id)
+                )
             else:
                 # 否则只处理文本
-                response_text = chat_system.chat(user_input)
+                response_text = await flights.do(
+                    flight_key, lambda: chat_system.chat_async(user_input, session_id=session_id)
+                )
 
             # 构造符合OpenAI格式的响应
             result = create_chat_completion_response(response_text, "neko")
@@ -434,6 +373,8 @@ def run_koishi_service():
             print(Fore.CYAN + f"发送统一API响应: {result}")
             return result
 
+        except AdmissionRejected as e:
+            return create_busy_response(e, "neko")
         except Exception as e:
             import traceback
             error_trace = traceback.format_exc()
@@ -442,6 +383,17 @@ def run_koishi_service():
             # 返回错误信息但仍保持OpenAI格式
             return create_error_response(e, "neko")
 
+    return fastapi_app
+
+
+def run_koishi_service(workers=None):
+    """Koishi映射模式 (FastAPI服务)
+
+    Args:
+        workers (int): 工作进程数，默认使用配置中的koishi.workers
+    """
+    workers = workers or CONFIG['koishi']['workers']
+
     # 查找可用端口
     port = find_available_port()
     if port is None:
@@ -450,10 +402,25 @@ def run_koishi_service():
 
     print(Fore.CYAN + f"\n🚀 Koishi映射模式已启动: http://localhost:{port}/v1")
     print(Fore.YELLOW + f"请在 AstrBot 中将 API 地址设置为: http://localhost:{port}/v1")
+    if workers > 1:
+        # 多进程模式：工作进程通过应用工厂各自创建应用，状态保存在共享的SQLite中
+        os.environ[SHARED_STATE_ENV] = "1"
+        os.environ[WORKERS_ENV] = str(workers)
+        print(Fore.CYAN + f"多进程模式: {workers} 个工作进程，共享状态: {CONFIG['shared_state']['path']}")
+        uvicorn.run(
+            "src.koishi_service:create_app",
+            factory=True,
+            workers=workers,
+            host=CONFIG['koishi']['host'],
+            port=port,
+            timeout_keep_alive=120
+        )
+        return
+
     # 增加超时设置和响应头配置
     uvicorn.run(
-        fastapi_app,
-        host="127.0.0.1",  # 使用127.0.0.1而不是0.0.0.0更安全
+        create_app(),
+        host=CONFIG['koishi']['host'],  # 默认使用127.0.0.1而不是0.0.0.0更安全
         port=port,  # 使用找到的可用端口
         timeout_keep_alive=120  # 增加保持连接超时
     )
@@ -0,0 +1,124 @@
+"""运行指标模块，提供进程内的计数器、仪表值和速率统计"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Any
+
+
+class _RateWindow:
+    """按秒分桶的滑动窗口，用于计算最近一段时间内的平均速率"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.buckets = [0.0] * window
+        self.stamps = [0] * window
+
+    def add(self, value, now):
+        second = int(now)
+        index = second % self.window
+        if self.stamps[index] != second:
+            self.stamps[index] = second
+            self.buckets[index] = 0.0
+        self.buckets[index] += value
+
+    def rate(self, now):
+        second = int(now)
+        total = 0.0
+        for stamp, value in zip(self.stamps, self.buckets):
+            if second - stamp < self.window:
+                total += value
+        return total / self.window
+
+
+class MetricsRegistry:
+    """线程安全的指标注册表"""
+
+    def __init__(self, window=60):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = {}
+        self._gauges = {}
+        self._rates = {}
+
+    def incr(self, name, value=1):
+        """增加计数器，同时记录到速率窗口中
+
+        Args:
+            name (str): 指标名
+            value (int|float): 增量
+        """
+        now = time.time()
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            window = self._rates.get(name)
+            if window is None:
+                window = self._rates[name] = _RateWindow(self._window)
+            window.add(value, now)
+
+    def set_gauge(self, name, value):
+        """设置仪表值（当前队列长度、缓存条目数等）"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def get(self, name, default=0):
+        """读取计数器或仪表值"""
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出所有指标
+
+        Returns:
+            dict: 包含counters、gauges和最近窗口内每秒速率的字典
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'rates_per_second': {
+                    name: round(window.rate(now), 3) for name, window in self._rates.items()
+                }
+            }
+
+
+# 进程级的全局指标注册表
+METRICS = MetricsRegistry()
+
+
+def record_token_usage(prompt_tokens, completion_tokens):
+    """记录一次上游调用的Token用量
+
+    写入进程内指标；开启共享状态时同时累加到跨进程计数器，
+    多工作进程模式下/metrics可以看到所有进程的总量。
+    """
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+    METRICS.incr('input_tokens', prompt_tokens)
+    METRICS.incr('output_tokens', completion_tokens)
+
+    from .shared_state import get_shared_state
+    store = get_shared_state()
+    if store is not None:
+        _record_shared_tokens(store, prompt_tokens, completion_tokens)
+
+
+def _record_shared_tokens(store, prompt_tokens, completion_tokens):
+    store.incr('input_tokens', prompt_tokens)
+    store.incr('output_tokens', completion_tokens)
+
+
+async def record_token_usage_async(prompt_tokens, completion_tokens):
+    """记录一次上游调用的Token用量（异步版本），跨进程计数器在线程池中写入，不阻塞事件循环"""
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+    METRICS.incr('input_tokens', prompt_tokens)
+    METRICS.incr('output_tokens', completion_tokens)
+
+    from .shared_state import get_shared_state
+    store = get_shared_state()
+    if store is not None:
+        await asyncio.to_thread(_record_shared_tokens, store, prompt_tokens, completion_tokens)
@@ -5,36 +5,13 @@ import os
 import subprocess
 import sys
 
-import mysql.connector
 from mysql.connector import Error
 
 # 添加项目根目录到 sys.path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from src.config import CONFIG
 from src.logging_config import setup_logging
-from src.database import table_exists
-
-
-def get_connection():
-    """获取数据库连接
-    
-    Returns:
-        mysql.connector.connection.MySQLConnection: 数据库连接对象，连接失败时返回None
-    """
-    try:
-        connection = mysql.connector.connect(
-            host=CONFIG['database']['host'],
-            user=CONFIG['database']['user'],
-            password=CONFIG['database']['password'],
-            database=CONFIG['database']['database'],
-            charset='utf8mb4',
-            collation='utf8mb4_unicode_ci'
-        )
-        return connection
-    except Error as e:
-        logging.error("数据库连接失败: %s", e)
-        return None
+from src.database import get_connection, table_exists
 
 
 def reset_chat_history(connection):
@@ -53,13 +30,13 @@ def reset_chat_history(connection):
         logging.error("清空 chat_history 表失败: %s", e)
 
 
-def list_records(connection, limit, offset):
+def list_records(connection, limit, after_id=0):
     """列出记录
     
     Args:
         connection (mysql.connector.connection.MySQLConnection): 数据库连接对象
         limit (int): 限制记录数
-        offset (int): 偏移量
+        after_id (int): 只列出ID大于该值的记录（上一页最后一条记录的ID）
         
     Returns:
         list: 记录列表
@@ -67,7 +44,8 @@ def list_records(connection, limit, offset):
     try:
         cursor = connection.cursor()
         if table_exists(cursor, 'chat_history'):
-            cursor.execute("SELECT * FROM chat_history ORDER BY id ASC LIMIT %s OFFSET %s", (limit, offset))
+            # 按主键定位页面，翻到后面的页时不需要扫描并丢弃前面的记录
+            cursor.execute("SELECT * FROM chat_history WHERE id > %s ORDER BY id ASC LIMIT %s", (after_id, limit))
             return cursor.fetchall()
         return []
     except Error as e:
@@ -113,9 +91,11 @@ def paginate_and_manage_records(connection, page_size=200):
         page_size (int): 每页记录数，默认为200
     """
     page = 0
+    # 每一页第一条记录之前的ID，用于返回上一页
+    page_starts = [0]
     while True:
         os.system('cls')  # 清屏
-        records = list_records(connection, page_size, page * page_size)
+        records = list_records(connection, page_size, page_starts[page])
         if not records:
             print("无更多记录。")
             break
@@ -124,6 +104,8 @@ def paginate_and_manage_records(connection, page_size=200):
         cmd = input("[N] 下一页  [P] 上一页  [R] 刷新  [Q] 返回菜单: ").strip().lower()
         if cmd == 'n':
             page += 1
+            del page_starts[page:]
+            page_starts.append(records[-1][0])
         elif cmd == 'p' and page > 0:
             page -= 1
         elif cmd == 'r':
@@ -0,0 +1,258 @@
+"""聊天记录保留策略模块，把过期的记录归档到压缩文件后再从数据库删除
+
+归档文件保存在archive_dir中：
+- chat_history-<首条ID>.jsonl.gz：归档分段，每次归档追加一个gzip成员，每行一条JSON记录，只追加不修改
+- chat_history.index.jsonl：索引，每次归档追加一行，记录分段文件名、字节偏移、长度、
+  ID范围和时间范围，读取时可以直接定位到对应的gzip成员
+"""
+
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from mysql.connector import Error
+
+from .config import CONFIG
+from .database import HISTORY_COLUMNS
+from .metrics import METRICS
+
+INDEX_FILE = 'chat_history.index.jsonl'
+
+
+def _timestamp(value):
+    """把created_at转换为datetime（不同数据库驱动可能返回字符串）"""
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return value
+
+
+class ChatArchive:
+    """只追加的聊天记录归档
+
+    先写入分段文件并落盘，再追加索引行；两步之间中断时，分段末尾多出的数据不会被
+    索引引用，下次归档会重新写入这些记录。归档后删除之前中断时，最后一批记录仍在
+    数据库中，is_archived()据此避免重复归档。
+    """
+
+    def __init__(self, directory: str, segment_rows: int = 50000):
+        self.directory = directory
+        self.segment_rows = segment_rows
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.segment = None
+        self.segment_count = 0
+        last_entry = None
+        for entry in self.entries():
+            if entry['segment'] != self.segment:
+                self.segment, self.segment_count = entry['segment'], 0
+            self.segment_count += entry['rows']
+            last_entry = entry
+        # 最后一批归档的记录，可能因为删除前中断而仍在数据库中
+        self._last_batch = {}
+        if last_entry is not None:
+            self._last_batch = {record['id']: record for record in self._read_entry(last_entry)}
+
+    def entries(self) -> Iterator[Dict[str, Any]]:
+        """遍历索引中的所有归档批次"""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # 写到一半中断的索引行，对应的批次会被重新归档
+                        continue
+
+    @staticmethod
+    def _record(row) -> Dict[str, Any]:
+        """把一行记录转换为归档中保存的格式"""
+        return json.loads(json.dumps(dict(zip(HISTORY_COLUMNS, row)), ensure_ascii=False, default=str))
+
+    def is_archived(self, row) -> bool:
+        """记录是否已经在最后一批归档中（内容完全一致）"""
+        archived = self._last_batch.get(row[0])
+        return archived is not None and archived == self._record(row)
+
+    def _read_entry(self, entry) -> List[Dict[str, Any]]:
+        with open(os.path.join(self.directory, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = gzip.decompress(f.read(entry['length']))
+        return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+    def append(self, rows: List[tuple]):
+        """归档一批记录（按ID升序，字段顺序与HISTORY_COLUMNS一致）"""
+        if not rows:
+            return
+        if self.segment is None or self.segment_count >= self.segment_rows:
+            self.segment = f"chat_history-{rows[0][0]:010d}.jsonl.gz"
+            self.segment_count = 0
+
+        records = [self._record(row) for row in rows]
+        lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        member = gzip.compress(lines.encode('utf-8'))
+        path = os.path.join(self.directory, self.segment)
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+
+        first_at, last_at = _timestamp(rows[0][4]), _timestamp(rows[-1][4])
+        entry = {
+            'segment': self.segment,
+            'offset': offset,
+            'length': len(member),
+            'rows': len(rows),
+            'first_id': rows[0][0],
+            'last_id': rows[-1][0],
+            'first_at': first_at.isoformat() if first_at else None,
+            'last_at': last_at.isoformat() if last_at else None,
+        }
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.segment_count += len(rows)
+        self._last_batch = {record['id']: record for record in records}
+        METRICS.incr('retention_archived_rows', len(rows))
+        METRICS.incr('retention_archived_bytes', len(member))
+
+    def read(self, first_id: int = 0, last_id: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """按ID范围读取已归档的记录，只解压包含该范围的批次"""
+        for entry in self.entries():
+            if entry['last_id'] < first_id or (last_id is not None and entry['first_id'] > last_id):
+                continue
+            for record in self._read_entry(entry):
+                if record['id'] >= first_id and (last_id is None or record['id'] <= last_id):
+                    yield record
+
+
+class RetentionEngine:
+    """按数量或时间策略归档聊天记录
+
+    是否超出数量上限由excess_boundary()按表中实际的数据判断，Web管理页面、
+    reset_database等其他程序删除记录后也不会多删。count只用于日志和指标：启动时和
+    每隔recount_interval秒执行一次COUNT(*)，其余时间只统计上次检查之后新增的记录
+    （主键范围查询），再减去本程序删除的记录数；发现与表中数据不一致时重新统计。
+    每批最多处理chunk_size条记录：先写入归档，再用一条按主键范围的DELETE删除。
+    """
+
+    def __init__(self, archive: ChatArchive, max_records: int = 200, max_age_days: float = 0,
+                 chunk_size: int = 100, recount_interval: float = 3600):
+        self.archive = archive
+        self.max_records = max_records
+        self.max_age_days = max_age_days
+        self.chunk_size = chunk_size
+        self.recount_interval = recount_interval
+        self.count = None
+        self.seen_id = 0
+        self._counted_at = 0.0
+
+    @classmethod
+    def from_config(cls) -> "RetentionEngine":
+        settings = CONFIG['retention']
+        return cls(
+            ChatArchive(settings['archive_dir'], settings['segment_rows']),
+            max_records=settings['max_records'],
+            max_age_days=settings['max_age_days'],
+            chunk_size=settings['chunk_size'],
+            recount_interval=settings['recount_interval']
+        )
+
+    def _full_count(self, cursor):
+        cursor.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM chat_history")
+        self.count, self.seen_id = cursor.fetchone()
+        self._counted_at = time.monotonic()
+        METRICS.incr('retention_full_counts')
+
+    def refresh_count(self, cursor):
+        """更新记录数（定期完整统计，其余时间只统计新增的记录）"""
+        if self.count is None or time.monotonic() - self._counted_at >= self.recount_interval:
+            self._full_count(cursor)
+        else:
+            cursor.execute("SELECT COUNT(*), MAX(id) FROM chat_history WHERE id > %s", (self.seen_id,))
+            added, max_id = cursor.fetchone()
+            if added:
+                self.count += added
+                self.seen_id = max_id
+        METRICS.set_gauge('retention_live_rows', self.count)
+        return self.count
+
+    def excess_boundary(self, cursor) -> Optional[int]:
+        """返回超出数量上限的记录中最新一条的ID（ID不大于它的记录都需要归档），未超出时返回None
+
+        按ID倒序跳过max_records条记录，扫描的行数不超过max_records。
+        """
+        if not self.max_records:
+            return None
+        cursor.execute("SELECT id FROM chat_history ORDER BY id DESC LIMIT 1 OFFSET %s", (self.max_records,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _due(self, rows, boundary, cutoff):
+        """返回需要归档的前缀：超出数量上限的最早记录，以及早于cutoff的记录"""
+        due = []
+        for row in rows:
+            created_at = _timestamp(row[4])
+            if (boundary is not None and row[0] <= boundary) or \
+                    (cutoff is not None and created_at is not None and created_at < cutoff):
+                due.append(row)
+            else:
+                break
+        return due
+
+    def run_once(self, connection) -> int:
+        """执行一次检查，返回归档的记录数"""
+        cursor = connection.cursor()
+        try:
+            self.refresh_count(cursor)
+            cutoff = datetime.now() - timedelta(days=self.max_age_days) if self.max_age_days else None
+            archived = 0
+            while True:
+                # 每批都按表中实际的数据重新判断，期间其他程序删除的记录不会导致多删
+                boundary = self.excess_boundary(cursor)
+                if boundary is None and cutoff is None:
+                    break
+                cursor.execute(
+                    f"SELECT {', '.join(HISTORY_COLUMNS)} FROM chat_history ORDER BY id ASC LIMIT %s",
+                    (self.chunk_size,)
+                )
+                rows = self._due(cursor.fetchall(), boundary, cutoff)
+                if not rows:
+                    break
+
+                # 上次中断时已经归档但没有删除的记录不再重复归档
+                self.archive.append([row for row in rows if not self.archive.is_archived(row)])
+                # 这些记录是表中ID最小的记录，按主键范围删除即可
+                cursor.execute("DELETE FROM chat_history WHERE id <= %s", (rows[-1][0],))
+                connection.commit()
+                deleted = cursor.rowcount
+                self.count = max(0, self.count - deleted)
+                archived += len(rows)
+                METRICS.incr('retention_deleted_rows', deleted)
+                logging.info("已归档并删除 %d 条聊天记录（ID %d-%d）", deleted, rows[0][0], rows[-1][0])
+                if len(rows) < self.chunk_size:
+                    break
+            if self.max_records and self.count > self.max_records and self.excess_boundary(cursor) is None:
+                # 其他程序删除过记录，增量统计的记录数偏大，重新完整统计
+                self._full_count(cursor)
+            METRICS.incr('retention_runs')
+            METRICS.set_gauge('retention_live_rows', self.count)
+            return archived
+        except Error:
+            # 数据库出错后重新完整统计
+            self.count = None
+            raise
+        finally:
+            cursor.close()
@@ -0,0 +1,184 @@
+"""表结构登记模块，启动时检查并创建数据表，之后查询不再检查表是否存在"""
+
+import threading
+import time
+
+from mysql.connector import Error, errorcode
+
+from .dialects import get_dialect
+from .metrics import METRICS
+
+# 程序使用的数据表，与data/init_database.sql保持一致
+TABLES = {
+    'character_info': """
+        CREATE TABLE IF NOT EXISTS character_info (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(50) NOT NULL DEFAULT '',
+            personality VARCHAR(500) DEFAULT NULL,
+            brother_qqid VARCHAR(20) DEFAULT '',
+            height VARCHAR(10) DEFAULT '',
+            weight VARCHAR(10) DEFAULT '',
+            catchphrases VARCHAR(100) DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY unique_name (name)
+        )
+    """,
+    'chat_history': """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_input TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            image_description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY unique_id (id)
+        )
+    """,
+}
+
+# SQLite存储后端使用的建表语句，字段与MySQL一致；AUTOINCREMENT保证删除后的ID不会被重新使用
+SQLITE_TABLES = {
+    'character_info': """
+        CREATE TABLE IF NOT EXISTS character_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL DEFAULT '' UNIQUE,
+            personality TEXT DEFAULT NULL,
+            brother_qqid TEXT DEFAULT '',
+            height TEXT DEFAULT '',
+            weight TEXT DEFAULT '',
+            catchphrases TEXT DEFAULT NULL,
+            created_at TEXT DEFAULT (datetime('now', 'localtime')),
+            updated_at TEXT DEFAULT (datetime('now', 'localtime'))
+        )
+    """,
+    'chat_history': (
+        """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_input TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            image_description TEXT,
+            created_at TEXT DEFAULT (datetime('now', 'localtime'))
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_created_at ON chat_history (created_at)",
+    ),
+}
+
+
+# 各存储后端（方言名）使用的建表语句
+DDL = {'mysql': TABLES, 'sqlite': SQLITE_TABLES}
+
+
+def _ddl(table_name):
+    """返回当前存储后端的建表语句列表，没有登记时返回空列表"""
+    statements = DDL[get_dialect().name].get(table_name, ())
+    return [statements] if isinstance(statements, str) else list(statements)
+
+
+# 说明表结构已经和缓存不一致的错误：表不存在、字段不存在
+SCHEMA_ERRORS = (errorcode.ER_NO_SUCH_TABLE, errorcode.ER_BAD_FIELD_ERROR)
+
+
+class SchemaRegistry:
+    """缓存数据表是否可用
+
+    每张表只在第一次使用时检查一次是否存在（语句由dialects中的方言提供），不存在且在TABLES中登记了建表语句时
+    自动创建（MySQL使用TABLES，SQLite存储后端使用SQLITE_TABLES）。确认可用的表一直缓存到出现表结构错误为止；创建失败（例如没有建表权限）
+    的表在retry_interval秒内直接视为不存在，不会每次查询都重试。
+    可选索引（例如全文索引）由create_database.py添加，这里只检查是否存在：存在的结果缓存到
+    表结构缓存失效为止，不存在的结果缓存retry_interval秒，执行迁移后不需要重启服务。
+    """
+
+    def __init__(self, retry_interval: float = 60):
+        self.retry_interval = retry_interval
+        self._available = set()
+        self._missing_until = {}
+        self._indexes = set()
+        self._index_missing_until = {}
+        self._lock = threading.Lock()
+
+    def ensure(self, cursor, table_name: str) -> bool:
+        """确认表存在（必要时创建），结果会被缓存
+
+        Args:
+            cursor: 数据库游标，只在缓存未命中时使用
+            table_name (str): 表名
+
+        Returns:
+            bool: 表可用返回True
+        """
+        if table_name in self._available:
+            return True
+        if self._missing_until.get(table_name, 0) > time.monotonic():
+            return False
+        with self._lock:
+            if table_name in self._available:
+                return True
+            METRICS.incr('schema_checks')
+            exists = get_dialect().table_exists(cursor, table_name)
+            if not exists and _ddl(table_name):
+                try:
+                    for statement in _ddl(table_name):
+                        cursor.execute(statement)
+                    exists = True
+                    print(f"已创建数据表 {table_name}")
+                except Error as e:
+                    print(f"创建数据表 {table_name} 失败: {e}")
+            if exists:
+                self._available.add(table_name)
+                self._missing_until.pop(table_name, None)
+            else:
+                self._missing_until[table_name] = time.monotonic() + self.retry_interval
+            return exists
+
+    def has_index(self, cursor, table_name: str, index_name: str) -> bool:
+        """检查表上是否有指定的索引（只检查，不会添加），结果会被缓存"""
+        key = (table_name, index_name)
+        if key in self._indexes:
+            return True
+        if self._index_missing_until.get(key, 0) > time.monotonic():
+            return False
+        with self._lock:
+            METRICS.incr('schema_checks')
+            exists = get_dialect().index_exists(cursor, table_name, index_name)
+            if exists:
+                self._indexes.add(key)
+                self._index_missing_until.pop(key, None)
+            else:
+                self._index_missing_until[key] = time.monotonic() + self.retry_interval
+            return exists
+
+    def ensure_all(self, cursor):
+        """检查并创建所有登记的表（启动时调用）"""
+        for table_name in TABLES:
+            self.ensure(cursor, table_name)
+
+    def invalidate(self, table_name: str = None):
+        """清除缓存，下次使用时重新检查（不指定表名时清除全部）"""
+        with self._lock:
+            if table_name is None:
+                self._available.clear()
+                self._missing_until.clear()
+                self._indexes.clear()
+                self._index_missing_until.clear()
+            else:
+                self._available.discard(table_name)
+                self._missing_until.pop(table_name, None)
+                self._indexes = {key for key in self._indexes if key[0] != table_name}
+                for key in [key for key in self._index_missing_until if key[0] == table_name]:
+                    del self._index_missing_until[key]
+
+    def handle_error(self, error: Exception):
+        """数据库操作出错时调用，表结构相关的错误会使缓存失效"""
+        if isinstance(error, Error) and error.errno in SCHEMA_ERRORS:
+            METRICS.incr('schema_invalidations')
+            self.invalidate()
+
+
+_registry = SchemaRegistry()
+
+
+def get_schema() -> SchemaRegistry:
+    """获取进程内共享的表结构登记"""
+    return _registry
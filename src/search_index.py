@@ -0,0 +1,125 @@
+"""聊天记录全文检索模块，提供进程内的倒排索引
+
+MySQL表上有FULLTEXT（ngram）索引时由数据库完成检索；没有全文索引时使用这里的倒排索引。
+分词规则与MySQL ngram解析器一致：中日韩文字按相邻两个字切分，其余文字按单词切分并转为小写；
+倒排索引另外保存单字，只有一个字的关键词也能检索。
+"""
+
+import re
+import threading
+from typing import Iterable, List, Optional, Set
+
+# 与MySQL默认的ngram_token_size一致
+NGRAM_SIZE = 2
+
+_CJK_RUN = re.compile(r"[一-鿿㐀-䶿぀-ヿ가-힯]+")
+_WORD = re.compile(r"[^\W_一-鿿㐀-䶿぀-ヿ가-힯]+")
+
+
+def tokenize(text: str) -> Set[str]:
+    """把文本切分为检索词
+
+    Args:
+        text (str): 原始文本
+
+    Returns:
+        set: 检索词集合
+    """
+    if not text:
+        return set()
+    terms = set()
+    for run in _CJK_RUN.findall(text):
+        terms.update(run)
+        terms.update(run[i:i + NGRAM_SIZE] for i in range(len(run) - NGRAM_SIZE + 1))
+    terms.update(word.lower() for word in _WORD.findall(text))
+    return terms
+
+
+def query_words(query: str) -> List[str]:
+    """把检索语句按空白切分为关键词（去掉引号等布尔检索运算符）"""
+    return [word for word in re.sub(r'["+\-<>()~*@]', ' ', query).split() if word]
+
+
+def matches(words: Iterable[str], *texts: Optional[str]) -> bool:
+    """检查每个关键词是否都出现在某一段文本中（不区分大小写）"""
+    haystack = '\n'.join(text for text in texts if text).lower()
+    return all(word.lower() in haystack for word in words)
+
+
+class InvertedIndex:
+    """记录ID的倒排索引（线程安全）
+
+    只保存检索词到记录ID的映射，不保存原文；ngram匹配不保证关键词连续出现，
+    search()返回的是候选ID，调用方需要取出原文用matches()确认。
+    记录按ID递增写入，last_id是已经建立索引的最大ID，用于增量补充新记录。
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._lock = threading.Lock()
+        self.last_id = 0
+        self.documents = 0
+
+    def add(self, record_id: int, *texts: Optional[str]):
+        """为一条记录建立索引"""
+        terms = set()
+        for text in texts:
+            terms |= tokenize(text)
+        with self._lock:
+            for term in terms:
+                self._postings.setdefault(term, set()).add(record_id)
+            self.last_id = max(self.last_id, record_id)
+            self.documents += 1
+
+    def discard(self, record_ids: Iterable[int]):
+        """从索引中移除已经删除的记录"""
+        record_ids = set(record_ids)
+        if not record_ids:
+            return
+        with self._lock:
+            for term in list(self._postings):
+                postings = self._postings[term]
+                postings -= record_ids
+                if not postings:
+                    del self._postings[term]
+            self.documents = max(0, self.documents - len(record_ids))
+
+    def clear(self):
+        """清空索引"""
+        with self._lock:
+            self._postings.clear()
+            self.last_id = 0
+            self.documents = 0
+
+    def search(self, query: str, before_id: Optional[int] = None) -> List[int]:
+        """返回包含所有关键词的候选记录ID（按ID降序）
+
+        Args:
+            query (str): 检索语句，多个关键词用空格分隔
+            before_id (int, optional): 只返回ID小于该值的记录
+        """
+        term_sets = [tokenize(word) for word in query_words(query)]
+        terms = set().union(*term_sets) if term_sets else set()
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for other in postings[1:]:
+                candidates &= other
+                if not candidates:
+                    return []
+        if before_id is not None:
+            candidates = {record_id for record_id in candidates if record_id < before_id}
+        return sorted(candidates, reverse=True)
+
+
+_history_index = InvertedIndex()
+
+
+def get_history_index() -> InvertedIndex:
+    """获取聊天记录的进程内倒排索引"""
+    return _history_index
@@ -0,0 +1,249 @@
+"""会话管理模块，为每个对话维护独立且有界的消息历史"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+from .metrics import METRICS
+
+# 未指定会话时使用的会话ID（终端模式、沙箱页面等单用户场景）
+DEFAULT_SESSION_ID = "default"
+
+# 请求头中可以携带会话ID的字段，按优先级排列
+SESSION_HEADERS = ("x-session-id", "x-koishi-channel-id", "x-channel-id")
+# 请求体中可以携带会话ID的字段，按优先级排列（user是OpenAI标准字段）
+SESSION_FIELDS = ("session_id", "user", "channel_id")
+
+
+def _message_size(message):
+    """估算一条消息占用的字节数"""
+    content = message.get('content', '')
+    if isinstance(content, str):
+        return len(content.encode('utf-8'))
+    return len(str(content).encode('utf-8'))
+
+
+def resolve_session_id(payload: Optional[Dict[str, Any]], headers=None) -> str:
+    """从请求中解析会话ID
+
+    优先使用请求头（X-Session-Id、Koishi频道ID），其次是请求体中的
+    session_id、OpenAI的user字段或channel_id，都没有时使用默认会话。
+
+    Args:
+        payload: 请求体
+        headers: 请求头（大小写不敏感的映射）
+
+    Returns:
+        str: 会话ID
+    """
+    if headers is not None:
+        for name in SESSION_HEADERS:
+            value = headers.get(name)
+            if value:
+                return str(value)
+    if payload:
+        for name in SESSION_FIELDS:
+            value = payload.get(name)
+            if value:
+                return str(value)
+    return DEFAULT_SESSION_ID
+
+
+class ChatSession:
+    """单个对话的消息历史
+
+    第一条消息始终是系统提示语，其后最多保留max_messages条对话消息。
+    lock用于同步调用方，async_lock用于事件循环中的调用方，保证同一会话的
+    多轮对话按顺序执行，不同会话之间互不阻塞。指定store时，追加消息在共享状态
+    存储的一个写事务中完成：先读取其他工作进程写入的最新历史，再追加并写回，
+    多个进程同时处理同一会话时不会互相覆盖。
+    """
+
+    def __init__(self, session_id, system_prompt, max_messages, on_resize=None, store=None, ttl=3600):
+        self.session_id = session_id
+        self.max_messages = max_messages
+        self.messages = [{"role": "system", "content": system_prompt}]
+        self.lock = threading.RLock()
+        self.last_active = time.time()
+        self.size = _message_size(self.messages[0])
+        self.evicted = False
+        self._async_lock = None
+        self._on_resize = on_resize
+        self._store = store
+        self._ttl = ttl
+
+    @property
+    def async_lock(self):
+        """会话的异步锁，首次使用时创建"""
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        return self._async_lock
+
+    def touch(self):
+        """刷新最近活跃时间"""
+        self.last_active = time.time()
+
+    def _trim(self, messages):
+        """丢弃超出上限的最早对话消息，保留系统提示语"""
+        overflow = len(messages) - 1 - self.max_messages
+        if overflow > 0:
+            del messages[1:1 + overflow]
+        return messages
+
+    def append(self, message):
+        """追加一条消息，超出上限时丢弃最早的对话消息
+
+        Args:
+            message (dict): 消息
+        """
+        self.extend([message])
+
+    def extend(self, messages):
+        """追加多条消息，开启共享状态时只写入一次
+
+        Args:
+            messages (list): 消息列表
+        """
+        with self.lock:
+            if self._store is not None:
+                # 共享存储中没有这个会话（已过期或被其他进程重置）时从系统提示语重新开始，
+                # 不使用本地可能已经过时的历史
+                system = self.messages[:1]
+                merged = self._store.update(
+                    'sessions', self.session_id,
+                    lambda persisted: self._trim(list(persisted or system) + list(messages)), self._ttl
+                )
+            else:
+                merged = self._trim(self.messages + list(messages))
+            size = sum(_message_size(message) for message in merged)
+            delta = size - self.size
+            self.messages = merged
+            self.size = size
+            self.touch()
+        if self._on_resize:
+            self._on_resize(self, delta)
+
+    async def extend_async(self, messages):
+        """追加多条消息（异步版本），写入共享状态存储时在线程池中执行"""
+        if self._store is None:
+            self.extend(messages)
+        else:
+            await asyncio.to_thread(self.extend, messages)
+
+    def load(self, messages):
+        """用共享状态中的历史替换本地历史"""
+        with self.lock:
+            size = sum(_message_size(message) for message in messages)
+            delta = size - self.size
+            self.messages = list(messages)
+            self.size = size
+        if self._on_resize and delta:
+            self._on_resize(self, delta)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """返回消息历史的副本，可以安全地传给上游"""
+        with self.lock:
+            return list(self.messages)
+
+
+class SessionManager:
+    """按会话ID管理ChatSession，带LRU淘汰、空闲过期和内存上限
+
+    指定store（SharedStateStore）时，会话历史保存在多个工作进程共享的存储中，
+    本地只缓存会话对象和锁，每次获取会话时从共享存储刷新历史。
+    """
+
+    def __init__(self, system_prompt, max_sessions=1000, ttl=3600, max_messages=40, max_bytes=64 * 1024 * 1024,
+                 store=None):
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.store = store
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+
+    def _on_resize(self, session, delta):
+        with self._lock:
+            if not session.evicted:
+                self._total_bytes += delta
+            self._evict()
+
+    def _drop(self, session_id):
+        """移除一个会话（调用方需持有self._lock）"""
+        session = self._sessions.pop(session_id)
+        session.evicted = True
+        self._total_bytes -= session.size
+        METRICS.incr('sessions_evicted')
+
+    def _evict(self):
+        """淘汰过期会话，并按LRU顺序淘汰超出数量或内存上限的会话（调用方需持有self._lock）"""
+        now = time.time()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            expired = now - session.last_active > self.ttl
+            over_limit = len(self._sessions) > self.max_sessions or self._total_bytes > self.max_bytes
+            # 只剩一个会话时不因内存上限淘汰，避免刚创建的会话被立即移除
+            if not expired and not (over_limit and len(self._sessions) > 1):
+                break
+            self._drop(session_id)
+        METRICS.set_gauge('sessions_active', len(self._sessions))
+        METRICS.set_gauge('sessions_bytes', self._total_bytes)
+
+    def get(self, session_id=None) -> ChatSession:
+        """获取会话，不存在时创建
+
+        Args:
+            session_id (str): 会话ID，为空时使用默认会话
+
+        Returns:
+            ChatSession: 会话对象
+        """
+        session_id = session_id or DEFAULT_SESSION_ID
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id, self.system_prompt, self.max_messages, self._on_resize,
+                                      store=self.store, ttl=self.ttl)
+                self._sessions[session_id] = session
+                self._total_bytes += session.size
+            else:
+                self._sessions.move_to_end(session_id)
+            session.touch()
+            self._evict()
+
+        if self.store is not None:
+            # 其他工作进程可能已经更新或重置了这个会话，共享存储中没有时只保留系统提示语
+            persisted = self.store.get('sessions', session_id)
+            session.load(persisted or session.snapshot()[:1])
+        return session
+
+    async def get_async(self, session_id=None) -> ChatSession:
+        """获取会话（异步版本），需要从共享状态存储刷新历史时在线程池中执行"""
+        if self.store is None:
+            return self.get(session_id)
+        return await asyncio.to_thread(self.get, session_id)
+
+    def reset(self, session_id=None):
+        """删除一个会话的历史"""
+        session_id = session_id or DEFAULT_SESSION_ID
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+        if self.store is not None:
+            self.store.delete('sessions', session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回会话统计信息"""
+        with self._lock:
+            return {
+                'active_sessions': len(self._sessions),
+                'total_bytes': self._total_bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl
+            }
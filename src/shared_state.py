@@ -0,0 +1,183 @@
+"""共享状态模块，多个Koishi服务进程通过本地SQLite（WAL模式）共享会话、缓存和计数器"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .config import CONFIG
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS idx_kv_expires_at ON kv (expires_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class SharedStateStore:
+    """基于SQLite的跨进程键值存储
+
+    每个线程使用独立的连接；数据库开启WAL模式，读写互不阻塞。
+    值以JSON保存，并带有过期时间。读取时跳过过期的值，写入时每隔purge_interval秒
+    删除一次所有过期的值，数据库文件不会因为过期数据一直增长。
+    指定max_entries时每个命名空间最多保存max_entries条，写入后按最近访问时间淘汰最久未使用的条目。
+    """
+
+    def __init__(self, path: str, purge_interval: float = 60, max_entries: Optional[int] = None):
+        self.path = path
+        self.purge_interval = purge_interval
+        self.max_entries = max_entries
+        # 启动后的第一次写入就清理一次
+        self._purged_at = float('-inf')
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(kv)")]
+            if 'accessed_at' not in columns:
+                # 旧版本创建的数据库文件没有accessed_at字段
+                conn.execute("ALTER TABLE kv ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_accessed_at ON kv (namespace, accessed_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str, default=None) -> Any:
+        """读取一个未过期的值"""
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry else default
+
+    def get_entry(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        """读取一个未过期的值及其过期时间，不存在时返回None"""
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        if self.max_entries:
+            # 记录访问时间，淘汰时保留最近使用的条目
+            conn.execute("UPDATE kv SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, namespace: str, key: str, value: Any, ttl: float):
+        """写入一个值
+
+        Args:
+            namespace (str): 命名空间（sessions、response_cache等）
+            key (str): 键
+            value: 可JSON序列化的值
+            ttl (float): 过期时间（秒）
+        """
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+        )
+        self._after_write(namespace)
+
+    def _after_write(self, namespace: str):
+        """写入后按条目上限淘汰，并且距离上次清理超过purge_interval秒时删除过期的值"""
+        if self.max_entries:
+            self._connection().execute(
+                "DELETE FROM kv WHERE namespace = ? AND key IN ("
+                "SELECT key FROM kv WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (namespace, namespace, self.max_entries)
+            )
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            self._purged_at = time.monotonic()
+            self.purge_expired()
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any], ttl: float) -> Any:
+        """在一个写事务中读取、修改并写回一个值
+
+        BEGIN IMMEDIATE在读取前就取得写锁，其他进程对同一数据库的写入会等待本事务提交，
+        读取和写回之间不会被其他进程的修改覆盖。
+
+        Args:
+            fn: 参数为当前未过期的值（不存在时为None），返回要写入的新值
+
+        Returns:
+            写入的新值
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (namespace, key, time.time())
+            ).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._after_write(namespace)
+        return value
+
+    def delete(self, namespace: str, key: str):
+        """删除一个值"""
+        self._connection().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def purge_expired(self) -> int:
+        """删除所有过期的值
+
+        Returns:
+            int: 删除的条目数
+        """
+        cursor = self._connection().execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+
+    def incr(self, name: str, value: int = 1):
+        """原子地增加一个计数器"""
+        self._connection().execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value)
+        )
+
+    def counters(self) -> Dict[str, int]:
+        """读取所有计数器"""
+        return dict(self._connection().execute("SELECT name, value FROM counters").fetchall())
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_shared_state() -> Optional[SharedStateStore]:
+    """获取进程内的共享状态存储，未开启共享状态时返回None"""
+    global _store
+    if not CONFIG['shared_state']['enabled']:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SharedStateStore(CONFIG['shared_state']['path'])
+    return _store
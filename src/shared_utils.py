@@ -2,22 +2,26 @@
 
 import re
 import time
-from typing import Dict, Any, List, Optional
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple
+
+from .tokenizer import count_text_tokens
 
 
 def count_tokens(text: str) -> int:
     """
-    简单的token计数函数（按字符数估算）
+    计算文本的token数
+    
+    默认按DeepSeek的字符换算比例（中文每字0.6、其他字符每字0.3个token）估算，是近似值；
+    放置词表文件（data/tokenizer.json）后按BPE合并规则计数。结果按文本缓存，重复计算同一条消息没有额外开销。
     
     Args:
         text: 要计数的文本
         
     Returns:
-        估算的token数量
+        token数量
     """
-    # 这是一个简化的token计数方法，实际应用中可能需要更精确的方法
-    # 这里我们假设每个中文字符大约为1个token，英文单词大约为1个token
-    return len(text)
+    return count_text_tokens(text or '')
 
 
 def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
@@ -43,6 +47,90 @@ def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
     return total_tokens
 
 
+def normalize_query(text: str) -> str:
+    """
+    规范化用户输入，用作缓存键
+    
+    统一全角/半角字符和大小写，合并空白，并去掉首尾的空白和标点，
+    使"在干嘛？"和"在干嘛?"得到相同的结果。
+    
+    Args:
+        text: 用户输入
+        
+    Returns:
+        规范化后的文本
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(' .,!?;:~～。，！？；：、…')
+
+
+# 时效性强的搜索（结果很快过时，缓存时间短）
+REALTIME_SEARCH_KEYWORDS = (
+    '天气', '新闻', '最新', '最近', '现在', '今天', '明天', '昨天', '实时',
+    '股价', '汇率', '比分', '热搜', '几点', '时间', '日期'
+)
+# 知识性的搜索（定义、教程等，结果长期有效，缓存时间长）
+REFERENCE_SEARCH_KEYWORDS = (
+    '什么是', '是什么', '定义', '解释', '意思', '含义', '介绍', '教程', '攻略',
+    '方法', '步骤', '怎么做', '如何', '原理', '区别', '历史'
+)
+
+
+def classify_search_query(text: str) -> str:
+    """
+    判断搜索问题的类型，用于决定搜索结果的缓存时间
+    
+    Args:
+        text: 用户输入
+        
+    Returns:
+        realtime（时效性强）、reference（知识性）或general
+    """
+    text = text or ''
+    if any(keyword in text for keyword in REALTIME_SEARCH_KEYWORDS):
+        return 'realtime'
+    if any(keyword in text for keyword in REFERENCE_SEARCH_KEYWORDS):
+        return 'reference'
+    return 'general'
+
+
+def trim_messages_to_budget(
+    messages: List[Dict[str, Any]],
+    max_tokens: int
+) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    按token预算裁剪消息列表，保留系统提示语和能放进预算的最新消息
+    
+    Args:
+        messages: 消息列表，第一条可以是系统提示语
+        max_tokens: token预算
+        
+    Returns:
+        (裁剪后的消息列表, 丢弃的消息数, 丢弃的token数)的元组
+    """
+    if not messages:
+        return [], 0, 0
+
+    head = messages[:1] if messages[0].get('role') == 'system' else []
+    body = messages[len(head):]
+    used = estimate_tokens(head)
+
+    kept = []
+    # 从最新的消息开始向前保留，遇到放不下的消息就停止，保证保留的是连续的最近对话
+    for message in reversed(body):
+        cost = estimate_tokens([message])
+        # 最新的一条消息无论如何都要保留
+        if kept and used + cost > max_tokens:
+            break
+        used += cost
+        kept.append(message)
+    kept.reverse()
+
+    dropped = body[:len(body) - len(kept)]
+    return head + kept, len(dropped), estimate_tokens(dropped)
+
+
 def create_chat_completion_response(
     content: str, 
     model: str = "neko",
@@ -182,10 +270,60 @@ def extract_user_input(messages: List[Dict[str, Any]]) -> tuple[str, List[str]]:
     return user_input, image_urls
 
 
+# 触发搜索的关键词：问询类、资讯类、时间类
+SEARCH_QUERY_KEYWORDS = (
+    '搜索', '查', '找', '了解', '知道', '什么是', '是什么', '怎么样', '如何', '怎么', '哪里', '哪儿',
+    '哪个', '哪些', '谁是', '谁的', '几点', '时间', '日期', '天气', '新闻', '最新', '最近', '现在'
+)
+SEARCH_TOPIC_KEYWORDS = (
+    '天气', '新闻', '股价', '比分', '时间', '日期', '定义', '解释', '介绍', '攻略', '评测', '比较',
+    '区别', '方法', '步骤', '教程', '怎么做'
+)
+SEARCH_TIME_KEYWORDS = (
+    '最新', '最近', '现在', '今天', '明天', '昨天', '今年', '去年', '这个月', '下个月', '上个月'
+)
+# 以这些词开头的输入也触发搜索
+SEARCH_PREFIXES = ('查询', '请问', '我想了解', '我想知道')
+
+
+def _trie_pattern(words) -> str:
+    """把一组关键词构建成前缀树形式的正则表达式
+
+    共同前缀只比较一次，每个位置的匹配代价只取决于最长关键词的长度，
+    不随关键词数量增长，也不会回溯。
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        if '' in node and len(node) == 1:
+            return ''
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        body = '(?:' + '|'.join(branches) + ')'
+        # 当前节点本身也是一个完整关键词时，后续字符可选
+        return body + '?' if '' in node else body
+
+    return build(trie)
+
+
+# 所有触发搜索的关键词和问号编译成一个自动机，一次线性扫描完成判断
+_SEARCH_TRIGGER = re.compile(_trie_pattern(
+    set(SEARCH_QUERY_KEYWORDS + SEARCH_TOPIC_KEYWORDS + SEARCH_TIME_KEYWORDS + ('?', '？'))
+))
+
+
 def should_search(user_input: str) -> bool:
     """
     判断是否需要进行网络搜索
     
+    输入中出现任一关键词或问号，或者以"查询"、"请问"等词开头时触发搜索。
+    
     Args:
         user_input: 用户输入
         
@@ -194,26 +332,6 @@ def should_search(user_input: str) -> bool:
     """
     if not user_input:
         return False
-        
-    # 定义触发搜索的关键词模式
-    search_keywords = [
-        r'(?:(?:搜索|查|找|了解|知道|什么是|是什么|怎么样|如何|怎么|哪里|哪儿|哪个|哪些|谁是|谁的|几点|时间|日期|天气|新闻|最新|最近|现在).*)',
-        r'(.*(?:天气|新闻|股价|比分|时间|日期|定义|解释|介绍|攻略|评测|比较|区别|方法|步骤|教程|怎么做).*)',
-        r'(.*(?:最新|最近|现在|今天|明天|昨天|今年|去年|这个月|下个月|上个月).*)'
-    ]
-    
-    # 检查用户输入是否包含触发搜索的关键词
-    for pattern in search_keywords:
-        if re.search(pattern, user_input, re.IGNORECASE):
-            return True
-            
-    # 添加更多智能判断逻辑
-    # 如果输入以"查询"、"请问"等词开头，也触发搜索
-    if re.match(r'^(查询|请问|我想了解|我想知道)', user_input.strip(), re.IGNORECASE):
+    if _SEARCH_TRIGGER.search(user_input):
         return True
-        
-    # 如果输入包含问号且长度较短，可能是一个问题查询
-    if '?' in user_input or '？' in user_input:
-        return True
-        
-    return False
\ No newline at end of file
+    return user_input.strip().startswith(SEARCH_PREFIXES)
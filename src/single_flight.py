@@ -0,0 +1,132 @@
+"""请求合并模块，让同时到达的相同请求共享同一次上游调用"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+from .metrics import METRICS
+
+# 客户端可以通过该请求头显式指定幂等键（例如Koishi超时重试时携带同一个键）
+IDEMPOTENCY_HEADER = "idempotency-key"
+
+
+def request_flight_key(path: str, payload: Dict[str, Any], headers=None, session_id: str = "") -> str:
+    """计算请求的合并键
+
+    优先使用Idempotency-Key请求头，否则使用请求路径、会话ID和规范化请求体的哈希。
+
+    Args:
+        path (str): 请求路径
+        payload (dict): 请求体
+        headers: 请求头（大小写不敏感的映射）
+        session_id (str): 会话ID
+
+    Returns:
+        str: 合并键
+    """
+    if headers is not None and headers.get(IDEMPOTENCY_HEADER):
+        return f"{path}|{session_id}|idem:{headers.get(IDEMPOTENCY_HEADER)}"
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(body.encode('utf-8')).hexdigest()
+    return f"{path}|{session_id}|{digest}"
+
+
+class _StreamFanout:
+    """把一个增量内容流广播给多个订阅者，后加入的订阅者会先补齐已产生的内容"""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def pump(self, source: AsyncIterator[str]):
+        """从上游读取内容并广播"""
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """订阅广播的内容"""
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.items):
+                yield self.items[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """按键合并同时进行中的请求
+
+    同一个键在进行中时，后到的请求不会再调用上游，而是等待同一个结果；
+    流式请求会把上游的增量内容分发给每个等待者。上游调用在独立的任务中执行，
+    发起它的客户端断开连接也不会影响其他等待者。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+    @staticmethod
+    def _forget(table, key, value):
+        """调用结束后移除记录（键已被新的调用占用时保持不变）"""
+        if table.get(key) is value:
+            del table[key]
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """执行或加入一次调用
+
+        Args:
+            key (str): 合并键
+            factory: 返回协程的函数，只有第一个请求会调用它
+
+        Returns:
+            调用结果（所有等待者共享）
+        """
+        task = self._calls.get(key)
+        if task is None:
+            METRICS.incr('single_flight_leaders')
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(self._calls, key, task))
+        else:
+            METRICS.incr('single_flight_shared')
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """执行或加入一次流式调用
+
+        Args:
+            key (str): 合并键
+            factory: 返回增量内容异步迭代器的函数，只有第一个请求会调用它
+
+        Returns:
+            增量内容的异步迭代器
+        """
+        fanout = self._streams.get(key)
+        if fanout is None:
+            METRICS.incr('single_flight_leaders')
+            fanout = _StreamFanout()
+            self._streams[key] = fanout
+            task = asyncio.ensure_future(fanout.pump(factory()))
+            task.add_done_callback(lambda _: self._forget(self._streams, key, fanout))
+        else:
+            METRICS.incr('single_flight_shared')
+        return fanout.subscribe()
@@ -0,0 +1,196 @@
+"""SQLite存储后端，单机部署时代替MySQL，不需要数据库服务
+
+连接以WAL模式打开，读写可以同时进行；每个线程复用自己的连接，sqlite3按SQL文本缓存
+编译好的语句，参数化查询会重复使用同一条预编译语句。
+SQLiteConnection和SQLiteCursor的用法与mysql.connector相同（%s占位符、
+cursor(dictionary=True)），出错时抛出mysql.connector的异常类型。
+语法不同的语句（查询表和索引、DELETE ... LIMIT）由dialects.SQLiteDialect提供，这里不改写SQL。
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict
+
+from mysql.connector import errorcode, errors
+
+from .dialects import SQLITE
+from .metrics import METRICS
+
+
+@lru_cache(maxsize=256)
+def _placeholders(query: str) -> str:
+    """把%s占位符换成SQLite的?（结果缓存，同一条查询每次得到相同的SQL文本）"""
+    return query.replace('%s', '?')
+
+
+def _param(value):
+    """datetime按MySQL的格式保存为文本，与created_at的默认值格式一致"""
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _convert_error(error: sqlite3.Error) -> errors.Error:
+    """把sqlite3的异常转换为mysql.connector的异常，原有的except Error和表结构缓存失效逻辑照常工作"""
+    message = str(error)
+    if message.startswith('no such table'):
+        return errors.ProgrammingError(msg=message, errno=errorcode.ER_NO_SUCH_TABLE)
+    if message.startswith('no such column'):
+        return errors.ProgrammingError(msg=message, errno=errorcode.ER_BAD_FIELD_ERROR)
+    if isinstance(error, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=message)
+    if isinstance(error, sqlite3.OperationalError):
+        return errors.OperationalError(msg=message)
+    return errors.DatabaseError(msg=message)
+
+
+class SQLiteCursor:
+    """与MySQLCursor用法相同的SQLite游标"""
+
+    def __init__(self, cursor: sqlite3.Cursor, dictionary: bool = False):
+        self._cursor = cursor
+        self._dictionary = dictionary
+
+    def execute(self, query, params=()):
+        try:
+            self._cursor.execute(_placeholders(query), tuple(_param(value) for value in params))
+        except sqlite3.Error as e:
+            raise _convert_error(e) from e
+
+    def executemany(self, query, rows):
+        try:
+            self._cursor.executemany(_placeholders(query), [tuple(_param(value) for value in row) for row in rows])
+        except sqlite3.Error as e:
+            raise _convert_error(e) from e
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """与MySQLConnection用法相同的SQLite连接，close()只结束本次借用，连接留给当前线程复用"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def cursor(self, dictionary: bool = False):
+        return SQLiteCursor(self._connection.cursor(), dictionary)
+
+    def commit(self):
+        try:
+            self._connection.commit()
+        except sqlite3.Error as e:
+            raise _convert_error(e) from e
+
+    def rollback(self):
+        self._connection.rollback()
+
+    @property
+    def in_transaction(self):
+        return self._connection.in_transaction
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        # 未提交的事务不会留给下一次借用
+        if self._connection.in_transaction:
+            self._connection.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SQLitePool:
+    """SQLite连接提供者，与ConnectionPool的接口相同
+
+    每个线程打开一个连接并一直复用，写入由SQLite的数据库锁串行化，
+    锁被占用时最多等待busy_timeout毫秒。
+    """
+
+    dialect = SQLITE
+
+    def __init__(self, path: str, busy_timeout: int = 5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, cached_statements=256,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下NORMAL只在检查点时同步磁盘，提交不再每次fsync，掉电时最多丢失最近的事务
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        METRICS.incr('db_pool_connections_opened')
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def acquire(self) -> SQLiteConnection:
+        """获取当前线程的连接，使用完毕后调用close()"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            try:
+                connection = self._local.connection = self._open()
+            except sqlite3.Error as e:
+                raise _convert_error(e) from e
+        METRICS.incr('db_pool_checkouts')
+        return SQLiteConnection(connection)
+
+    def connection(self):
+        """借用一个连接，退出with块时结束借用"""
+        return self.acquire()
+
+    def release(self, connection):
+        SQLiteConnection(connection).close()
+
+    def close(self):
+        """关闭所有线程打开的连接"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回数据库文件和连接数"""
+        return {
+            'backend': self.dialect.name,
+            'path': self.path,
+            'connections': len(self._connections),
+            'checkouts': METRICS.get('db_pool_checkouts'),
+        }
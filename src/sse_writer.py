@@ -0,0 +1,135 @@
+"""SSE输出模块，把上游的增量内容按时间和大小合并成数据帧"""
+
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Optional
+
+from .config import CONFIG
+from .metrics import METRICS
+from .shared_utils import create_streaming_response_chunk
+
+_SENTINEL = "\x00sse-content\x00"
+
+
+def _build_envelope():
+    """预先编码create_streaming_response_chunk生成的固定JSON外壳
+
+    Returns:
+        tuple: (内容之前的部分, 内容之后的部分)
+    """
+    encoded = json.dumps(create_streaming_response_chunk(_SENTINEL))
+    prefix, suffix = encoded.split(json.dumps(_SENTINEL))
+    return f"data: {prefix}", f"{suffix}\n\n"
+
+
+_FRAME_PREFIX, _FRAME_SUFFIX = _build_envelope()
+DONE_FRAME = "data: [DONE]\n\n"
+
+
+class SSEWriter:
+    """合并增量内容的SSE帧写入器
+
+    增量内容先进入缓冲区，距离上次发送超过flush_interval秒或缓冲区达到
+    flush_bytes字节时才编码成一帧。每帧只对内容做JSON转义，外壳是预先编码好的。
+    """
+
+    def __init__(self, flush_interval: Optional[float] = None, flush_bytes: Optional[int] = None):
+        self.flush_interval = CONFIG['streaming']['flush_interval'] if flush_interval is None else flush_interval
+        self.flush_bytes = CONFIG['streaming']['flush_bytes'] if flush_bytes is None else flush_bytes
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def encode(content: str) -> str:
+        """把一段内容编码成完整的SSE数据帧"""
+        return f"{_FRAME_PREFIX}{json.dumps(content)}{_FRAME_SUFFIX}"
+
+    def time_until_flush(self) -> Optional[float]:
+        """距离下一次按时间发送还有多少秒，缓冲区为空时返回None"""
+        if not self._buffer:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+
+    def feed(self, delta: str) -> Optional[str]:
+        """写入一段增量内容
+
+        Returns:
+            str: 达到发送条件时返回编码好的帧，否则返回None
+        """
+        if not delta:
+            return None
+        METRICS.incr('sse_deltas')
+        self._buffer.append(delta)
+        self._buffered_bytes += len(delta.encode('utf-8'))
+        if (self._buffered_bytes >= self.flush_bytes or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """立即把缓冲区编码成一帧，缓冲区为空时返回None"""
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        frame = self.encode("".join(self._buffer))
+        self._buffer.clear()
+        self._buffered_bytes = 0
+        METRICS.incr('sse_frames')
+        METRICS.incr('sse_bytes', len(frame.encode('utf-8')))
+        return frame
+
+
+async def sse_event_stream(deltas: AsyncIterator[str], writer: Optional[SSEWriter] = None) -> AsyncIterator[str]:
+    """把增量内容的异步迭代器转换为合并后的SSE帧流
+
+    上游长时间没有新内容时也会按flush_interval发送已缓冲的内容，
+    结束时发送剩余内容和[DONE]标记。
+
+    Args:
+        deltas: 增量文本的异步迭代器
+        writer: 帧写入器，默认使用配置中的参数
+
+    Yields:
+        str: SSE数据帧
+    """
+    writer = writer or SSEWriter()
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for delta in deltas:
+                await queue.put(delta)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(finished)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=writer.time_until_flush())
+            except asyncio.TimeoutError:
+                frame = writer.flush()
+                if frame:
+                    yield frame
+                continue
+
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            frame = writer.feed(item)
+            if frame:
+                yield frame
+
+        frame = writer.flush()
+        if frame:
+            yield frame
+        yield DONE_FRAME
+    finally:
+        if not task.done():
+            task.cancel()
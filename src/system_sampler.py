@@ -0,0 +1,224 @@
+"""系统指标采样模块，后台线程按固定间隔采集CPU、内存、磁盘、网络和负载
+
+监控接口只读取最近一次的采样结果，不再在请求中等待CPU使用率的测量窗口；
+CPU型号等不会变化的信息只在启动时获取一次。
+"""
+
+import platform
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import psutil
+
+from .config import CONFIG
+from .metrics import METRICS
+
+
+def _cpu_name() -> str:
+    """获取用户友好的CPU名称"""
+    try:
+        if platform.system() == "Windows":
+            result = subprocess.run(["wmic", "cpu", "get", "name"],
+                                    capture_output=True, text=True, timeout=3)
+            # 第一行是表头，第二行是CPU名称
+            lines = [line.strip() for line in result.stdout.strip().split('\n') if line.strip()]
+            if len(lines) > 1:
+                return lines[1]
+        elif platform.system() == "Linux":
+            with open('/proc/cpuinfo', 'r') as f:
+                for line in f:
+                    if line.startswith('model name'):
+                        return line.split(':')[1].strip()
+        elif platform.system() == "Darwin":  # macOS
+            result = subprocess.run(["sysctl", "-n", "machdep.cpu.brand_string"],
+                                    capture_output=True, text=True, timeout=3)
+            return result.stdout.strip()
+    except Exception:
+        pass
+    # 如果无法获取CPU名称，返回默认值
+    return platform.processor()
+
+
+def _disk_path() -> str:
+    """统计磁盘使用情况的路径（Windows上没有/时使用C盘）"""
+    try:
+        psutil.disk_usage('/')
+        return '/'
+    except OSError:
+        return 'C:\\'
+
+
+class SystemSampler:
+    """系统指标采样器
+
+    采样结果保存在预先分配的环形缓冲区中，最多保留capacity个，写满后覆盖最早的采样。
+    CPU使用率按两次采样之间的时间计算，网络速率按两次采样的字节数差计算。
+    """
+
+    def __init__(self, interval: float = 1.0, capacity: int = 600):
+        self.interval = interval
+        self.capacity = capacity
+        self._samples: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.static = None
+        self._disk_path = None
+        self._last_net = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """注册采样监听器，每次采样后在采样线程中以采样结果为参数调用"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def start(self):
+        """启动采样线程（可以重复调用）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止采样线程"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _collect_static(self):
+        self._disk_path = _disk_path()
+        self.static = {
+            'cpu': _cpu_name(),
+            'cpu_count': psutil.cpu_count(),
+            'boot_time': psutil.boot_time(),
+            'python_version': platform.python_version(),
+            'platform': platform.platform()
+        }
+
+    def _sample(self) -> Dict[str, Any]:
+        now = time.time()
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self._disk_path)
+        net_io = psutil.net_io_counters()
+        try:
+            load_avg = psutil.getloadavg()
+        except (AttributeError, OSError):
+            load_avg = (0, 0, 0)  # Windows不支持此功能
+
+        sent_rate = recv_rate = 0.0
+        if self._last_net is not None:
+            elapsed = now - self._last_net[0]
+            if elapsed > 0:
+                sent_rate = max(0, net_io.bytes_sent - self._last_net[1]) / elapsed
+                recv_rate = max(0, net_io.bytes_recv - self._last_net[2]) / elapsed
+        self._last_net = (now, net_io.bytes_sent, net_io.bytes_recv)
+
+        return {
+            'timestamp': now,
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'cpu_per_core': psutil.cpu_percent(interval=None, percpu=True),
+            'memory_percent': memory.percent,
+            'memory': {
+                'total': memory.total,
+                'available': memory.available,
+                'percent': memory.percent,
+                'used': memory.used,
+                'free': memory.free,
+                'active': getattr(memory, 'active', 0),
+                'inactive': getattr(memory, 'inactive', 0),
+                'buffers': getattr(memory, 'buffers', 0),
+                'cached': getattr(memory, 'cached', 0),
+                'shared': getattr(memory, 'shared', 0)
+            },
+            'disk': {
+                'total': disk.total,
+                'used': disk.used,
+                'free': disk.free,
+                'percent': (disk.used / disk.total) * 100 if disk.total else 0.0
+            },
+            'net': {
+                'bytes_sent': net_io.bytes_sent,
+                'bytes_recv': net_io.bytes_recv,
+                'sent_per_second': sent_rate,
+                'recv_per_second': recv_rate
+            },
+            'load_avg': tuple(load_avg)
+        }
+
+    def _record(self, sample):
+        with self._lock:
+            self._samples[self._next] = sample
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def _run(self):
+        self._collect_static()
+        # cpu_percent第一次调用只记录起点，之后每次返回与上一次调用之间的使用率
+        psutil.cpu_percent(interval=None)
+        psutil.cpu_percent(interval=None, percpu=True)
+        # 第一次采样只等待很短的时间，让接口尽快有数据可用
+        wait = min(0.1, self.interval)
+        while not self._stop.wait(wait):
+            start = time.perf_counter()
+            try:
+                sample = self._sample()
+                self._record(sample)
+                self._ready.set()
+            except Exception as e:
+                print(f"采集系统指标失败: {e}")
+            else:
+                for listener in list(self._listeners):
+                    try:
+                        listener(sample)
+                    except Exception as e:
+                        print(f"处理系统指标采样失败: {e}")
+            elapsed = time.perf_counter() - start
+            METRICS.incr('system_sampler_samples')
+            METRICS.incr('system_sampler_seconds', elapsed)
+            wait = max(0.0, self.interval - elapsed)
+
+    def latest(self, timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+        """返回最近一次采样，采样线程刚启动时最多等待timeout秒"""
+        if not self._ready.is_set():
+            self.start()
+            self._ready.wait(timeout)
+        with self._lock:
+            if not self._count:
+                return None
+            return self._samples[(self._next - 1) % self.capacity]
+
+    def history(self, since: float = None) -> List[Dict[str, Any]]:
+        """按时间顺序返回缓冲区中的采样
+
+        Args:
+            since (float, optional): 只返回该时间戳之后的采样
+        """
+        with self._lock:
+            start = (self._next - self._count) % self.capacity
+            samples = [self._samples[(start + i) % self.capacity] for i in range(self._count)]
+        if since is not None:
+            samples = [sample for sample in samples if sample['timestamp'] > since]
+        return samples
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler() -> SystemSampler:
+    """获取进程内共享的采样器（首次使用时创建并启动）"""
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                settings = CONFIG['system_sampler']
+                _sampler = SystemSampler(interval=settings['interval'], capacity=settings['capacity'])
+                _sampler.start()
+    return _sampler
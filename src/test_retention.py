@@ -0,0 +1,82 @@
+"""聊天记录保留策略测试模块，使用临时的SQLite数据库，不需要MySQL服务"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.config import CONFIG
+from src.retention import ChatArchive, RetentionEngine
+from src.schema import SchemaRegistry
+from src.sqlite_backend import SQLitePool
+
+
+def _insert(connection, count, start=0):
+    cursor = connection.cursor()
+    for i in range(start, start + count):
+        cursor.execute("INSERT INTO chat_history (user_input, ai_response) VALUES (%s, %s)",
+                       (f"问题{i}", f"回答{i}"))
+    connection.commit()
+    cursor.close()
+
+
+def _ids(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT id FROM chat_history ORDER BY id")
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return ids
+
+
+def test_external_delete_between_recounts():
+    """两次完整统计之间其他程序清空了记录，之后新增的记录没有超出上限，不应被归档"""
+    backend = CONFIG['storage']['backend']
+    CONFIG['storage']['backend'] = 'sqlite'
+    with tempfile.TemporaryDirectory() as directory:
+        pool = SQLitePool(os.path.join(directory, 'chat_history.db'))
+        try:
+            connection = pool.acquire()
+            cursor = connection.cursor()
+            assert SchemaRegistry().ensure(cursor, 'chat_history')
+            cursor.close()
+
+            engine = RetentionEngine(ChatArchive(os.path.join(directory, 'archive')),
+                                     max_records=5, chunk_size=2, recount_interval=3600)
+            _insert(connection, 5)
+            assert engine.run_once(connection) == 0
+            assert engine.count == 5
+
+            # 相当于Web管理页面的“清空记录”
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM chat_history")
+            connection.commit()
+            cursor.close()
+
+            _insert(connection, 3, start=5)
+            live = _ids(connection)
+            assert engine.run_once(connection) == 0
+            assert _ids(connection) == live
+            assert engine.count == 3
+
+            # 超出上限时只归档最早的记录
+            _insert(connection, 4, start=8)
+            live = _ids(connection)
+            assert engine.run_once(connection) == 2
+            assert _ids(connection) == live[2:]
+            assert [record['id'] for record in engine.archive.read()] == live[:2]
+            assert engine.count == 5
+            connection.close()
+        finally:
+            pool.close()
+            CONFIG['storage']['backend'] = backend
+    print("保留策略测试通过")
+
+
+def main():
+    """主函数"""
+    test_external_delete_between_recounts()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""时间序列模块，在内存中按多种分辨率保存监控指标的历史
+
+每个指标在每种分辨率下使用固定长度的环形数组保存最小值、总和、最大值和样本数，
+默认1秒一格保留10分钟、1分钟一格保留24小时。数组在创建时分配好，运行多久占用的内存都不变。
+"""
+
+import math
+import threading
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .config import CONFIG
+from .metrics import METRICS
+
+# 记录的指标及说明
+SERIES = {
+    'cpu': 'CPU使用率（%）',
+    'memory': '内存使用率（%）',
+    'net_sent': '网络发送速率（字节/秒）',
+    'net_recv': '网络接收速率（字节/秒）',
+    'requests': 'Web请求速率（次/秒）',
+    'latency_ms': 'Web请求平均耗时（毫秒）',
+    'input_tokens': '输入Token速率（个/秒）',
+    'output_tokens': '输出Token速率（个/秒）',
+}
+
+
+class RollupSeries:
+    """单个分辨率的环形时间序列，每格保存该时间段内的最小值、平均值和最大值"""
+
+    def __init__(self, step: float, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        # 每格对应的时间段编号（时间戳 // step），-1表示空
+        self._slots = array('q', [-1]) * capacity
+        self._min = array('d', [0.0]) * capacity
+        self._max = array('d', [0.0]) * capacity
+        self._sum = array('d', [0.0]) * capacity
+        self._count = array('L', [0]) * capacity
+
+    @property
+    def span(self) -> float:
+        """能够覆盖的时间长度（秒）"""
+        return self.step * self.capacity
+
+    def add(self, value: float, timestamp: float):
+        bucket = int(timestamp // self.step)
+        slot = bucket % self.capacity
+        if self._slots[slot] != bucket:
+            # 这一格保存的是一圈之前的数据，直接覆盖
+            self._slots[slot] = bucket
+            self._min[slot] = self._max[slot] = self._sum[slot] = value
+            self._count[slot] = 1
+            return
+        self._min[slot] = min(self._min[slot], value)
+        self._max[slot] = max(self._max[slot], value)
+        self._sum[slot] += value
+        self._count[slot] += 1
+
+    def points(self, start: float, end: float) -> List[Tuple[float, float, float, float]]:
+        """返回时间范围内的数据点 [(时间段起点, 最小值, 平均值, 最大值), ...]，按时间顺序"""
+        first = int(start // self.step)
+        last = int(end // self.step)
+        # 超出保留范围的部分已经被覆盖
+        first = max(first, last - self.capacity + 1)
+        result = []
+        for bucket in range(first, last + 1):
+            slot = bucket % self.capacity
+            if self._slots[slot] == bucket and self._count[slot]:
+                result.append((bucket * self.step, self._min[slot],
+                               self._sum[slot] / self._count[slot], self._max[slot]))
+        return result
+
+
+class TimeSeriesStore:
+    """多分辨率的指标历史
+
+    每个值同时写入所有分辨率，查询时选择能够覆盖所需时间范围的最细分辨率。
+    """
+
+    def __init__(self, resolutions: Sequence[Sequence[float]] = ((1, 600), (60, 1440)), names=SERIES):
+        self.resolutions = sorted((float(step), int(capacity)) for step, capacity in resolutions)
+        self._series = {
+            name: [RollupSeries(step, capacity) for step, capacity in self.resolutions] for name in names
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def max_span(self) -> float:
+        """保留时间最长的分辨率覆盖的秒数，查询范围不会超过它"""
+        return max(step * capacity for step, capacity in self.resolutions)
+
+    def record(self, name: str, value: float, timestamp: float = None):
+        """记录一个指标值"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            for series in self._series[name]:
+                series.add(float(value), timestamp)
+
+    def query(self, name: str, seconds: float, now: float = None) -> Dict[str, Any]:
+        """查询最近seconds秒的数据
+
+        Returns:
+            dict: step为数据点间隔（秒），points为[(时间, 最小值, 平均值, 最大值), ...]
+
+        Raises:
+            KeyError: 未知的指标名
+        """
+        now = time.time() if now is None else now
+        candidates = self._series[name]
+        series = next((s for s in candidates if s.span >= seconds), candidates[-1])
+        with self._lock:
+            points = series.points(now - seconds, now)
+        return {'step': series.step, 'points': points}
+
+    def memory_bytes(self) -> int:
+        """所有环形数组占用的字节数（固定不变）"""
+        return sum(
+            len(arr) * arr.itemsize
+            for series_list in self._series.values()
+            for series in series_list
+            for arr in (series._slots, series._min, series._max, series._sum, series._count)
+        )
+
+
+class MetricsRecorder:
+    """把系统采样和进程内计数器的变化写入时间序列
+
+    作为SystemSampler的监听器调用；请求速率、平均耗时和Token速率由两次采样之间
+    METRICS计数器的差值计算。
+    """
+
+    COUNTERS = ('web_requests', 'web_request_seconds', 'input_tokens', 'output_tokens')
+
+    def __init__(self, store: TimeSeriesStore):
+        self.store = store
+        self._last: Optional[Tuple[float, Dict[str, float]]] = None
+
+    def __call__(self, sample: Dict[str, Any]):
+        now = sample['timestamp']
+        record = self.store.record
+        record('cpu', sample['cpu_percent'], now)
+        record('memory', sample['memory_percent'], now)
+        record('net_sent', sample['net']['sent_per_second'], now)
+        record('net_recv', sample['net']['recv_per_second'], now)
+
+        counters = {name: METRICS.get(name) for name in self.COUNTERS}
+        if self._last is not None:
+            elapsed = now - self._last[0]
+            delta = {name: counters[name] - self._last[1][name] for name in self.COUNTERS}
+            if elapsed > 0:
+                record('requests', delta['web_requests'] / elapsed, now)
+                record('input_tokens', delta['input_tokens'] / elapsed, now)
+                record('output_tokens', delta['output_tokens'] / elapsed, now)
+            if delta['web_requests'] > 0:
+                record('latency_ms', delta['web_request_seconds'] / delta['web_requests'] * 1000, now)
+        self._last = (now, counters)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_timeseries() -> TimeSeriesStore:
+    """获取进程内共享的时间序列（首次使用时创建，并开始记录系统采样）"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from .system_sampler import get_sampler
+                store = TimeSeriesStore(CONFIG['timeseries']['resolutions'])
+                get_sampler().add_listener(MetricsRecorder(store))
+                _store = store
+    return _store
+
+
+def parse_range(value: str, max_seconds: Optional[float] = None) -> float:
+    """解析时间范围参数：纯数字表示秒，也可以使用s、m、h、d后缀（例如10m、24h）
+
+    Args:
+        max_seconds: 超过该秒数时截断为该值（通常为TimeSeriesStore.max_span）
+
+    Raises:
+        ValueError: 格式不正确、不是正数或不是有限值（inf、nan）
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        seconds = float(value[:-1]) * units[value[-1]]
+    else:
+        seconds = float(value)
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"无效的时间范围: {value}")
+    if max_seconds is not None:
+        seconds = min(seconds, max_seconds)
+    return seconds
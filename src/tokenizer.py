@@ -0,0 +1,156 @@
+"""Token计数模块，离线估算DeepSeek模型的token数
+
+仓库中不附带词表文件，默认按DeepSeek官方给出的换算比例（1个中文字符约0.6个token，
+1个英文字符约0.3个token）估算，结果是近似值。
+另行放置data/tokenizer.json（HuggingFace tokenizers格式的字节级BPE词表，例如DeepSeek-V3的
+tokenizer.json）后按BPE合并规则计数；预分词规则是近似实现，结果接近官方分词器，但不保证完全一致。
+"""
+
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from .config import CONFIG
+
+# 预分词规则：中日文字符连续成段，数字最多3位一组，英文单词带前导空格，其余按标点和空白切分
+_PRETOKENIZE = re.compile(
+    r"[一-鿿㐀-䶿぀-ヿ]+"
+    r"|'(?:[sdmt]|ll|ve|re)"
+    r"| ?[^\W\d_一-鿿㐀-䶿぀-ヿ]+"
+    r"|\d{1,3}"
+    r"| ?[^\s\w]+[\r\n]*"
+    r"|\s*[\r\n]+"
+    r"|\s+(?!\S)"
+    r"|\s+",
+    re.IGNORECASE
+)
+_CJK = re.compile(r"[一-鿿㐀-䶿぀-ヿ가-힯＀-￯　-〿]")
+
+# DeepSeek官方文档给出的换算比例
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """字节级BPE使用的字节到可见字符的映射（与GPT-2相同）"""
+    visible = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + \
+        list(range(ord("®"), ord("ÿ") + 1))
+    codes = visible[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in visible:
+            visible.append(byte)
+            codes.append(256 + extra)
+            extra += 1
+    return dict(zip(visible, map(chr, codes)))
+
+
+class BPETokenizer:
+    """字节级BPE计数器，只计算token数，不输出token id"""
+
+    def __init__(self, merges: List[Tuple[str, str]]):
+        self.ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.byte_encoder = _bytes_to_unicode()
+        self._word_tokens = lru_cache(maxsize=65536)(self._count_word)
+
+    @classmethod
+    def from_file(cls, path: str) -> "BPETokenizer":
+        """从HuggingFace格式的tokenizer.json加载"""
+        with open(path, 'r', encoding='utf-8') as f:
+            model = json.load(f)['model']
+        merges = [tuple(merge.split(' ', 1)) if isinstance(merge, str) else tuple(merge)
+                  for merge in model['merges']]
+        return cls(merges)
+
+    def _count_word(self, word: str) -> int:
+        """对一个预分词片段执行BPE合并，返回token数
+
+        每次合并排名最小的相邻片段（排名相同时取最左边的），与逐轮扫描所有片段的结果相同。
+        候选片段对放在按(排名, 位置)排序的堆中，片段用双向链表连接，合并后只需加入
+        与左右相邻片段组成的新候选，整段中文组成的长片段也是O(n log n)。
+        """
+        parts = [self.byte_encoder[byte] for byte in word.encode('utf-8')]
+        count = len(parts)
+        if count < 2:
+            return count
+        ranks = self.ranks
+        prev = list(range(-1, count - 1))
+        following = list(range(1, count + 1))
+        following[-1] = -1
+        heap = []
+        for i in range(count - 1):
+            rank = ranks.get((parts[i], parts[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, parts[i], parts[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i, left, right = heapq.heappop(heap)
+            j = following[i]
+            # 片段已经被合并过，堆中的这个候选已经失效
+            if parts[i] != left or j < 0 or parts[j] != right:
+                continue
+            parts[i] = left + right
+            parts[j] = None
+            following[i] = following[j]
+            if following[j] >= 0:
+                prev[following[j]] = i
+            count -= 1
+            if prev[i] >= 0:
+                pair_rank = ranks.get((parts[prev[i]], parts[i]))
+                if pair_rank is not None:
+                    heapq.heappush(heap, (pair_rank, prev[i], parts[prev[i]], parts[i]))
+            if following[i] >= 0:
+                pair_rank = ranks.get((parts[i], parts[following[i]]))
+                if pair_rank is not None:
+                    heapq.heappush(heap, (pair_rank, i, parts[i], parts[following[i]]))
+        return count
+
+    def count(self, text: str) -> int:
+        return sum(self._word_tokens(word) for word in _PRETOKENIZE.findall(text))
+
+
+def heuristic_count(text: str) -> int:
+    """按DeepSeek的字符换算比例估算token数"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return math.ceil(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR)
+
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer() -> Optional[BPETokenizer]:
+    """加载词表文件（只加载一次），文件不存在或无法解析时返回None"""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                path = CONFIG['tokenizer']['vocab_path']
+                if os.path.exists(path):
+                    try:
+                        _tokenizer = BPETokenizer.from_file(path)
+                    except (OSError, ValueError, KeyError) as e:
+                        print(f"加载词表失败，使用估算的token数: {e}")
+                _tokenizer_loaded = True
+    return _tokenizer
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text: str) -> int:
+    """计算一段文本的token数，结果按文本缓存
+
+    会话历史每轮都会重新估算，缓存后只有新追加的消息需要真正计数。
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return tokenizer.count(text)
+    return heuristic_count(text)
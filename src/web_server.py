@@ -10,9 +10,8 @@ import time
 import subprocess
 import threading
 import webbrowser
-import psutil
 import locale
-import platform
+from datetime import datetime
 from flask import Flask, request, jsonify, Response, send_from_directory, render_template
 from flask.cli import pass_script_info
 from colorama import Fore, Back, Style, init
@@ -24,6 +23,11 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from src.ai_chat_system import AIChatSystem
 from src.config import CONFIG, generate_system_prompt
+from src.db_pool import db_pool_stats, reset_pool
+from src.http_clients import http_client_stats
+from src.metrics import METRICS
+from src.system_sampler import get_sampler
+from src.timeseries import SERIES, get_timeseries, parse_range
 
 init(autoreset=True)
 
@@ -101,6 +105,21 @@ def run_web_server():
     # }
     
     chat_system = AIChatSystem()
+    # 提前启动系统指标采样和监控历史记录，监控页面第一次请求时就有数据
+    get_sampler()
+    get_timeseries()
+
+    @app.before_request
+    def start_request_timer():
+        request.start_time = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        # 静态文件和监控页面自身的轮询不计入请求速率和耗时
+        if not request.path.startswith(('/static/', '/api/monitoring')):
+            METRICS.incr('web_requests')
+            METRICS.incr('web_request_seconds', time.perf_counter() - request.start_time)
+        return response
 
     # 配置日志写入 app.log
     log_handler = RotatingFileHandler(CONFIG['server']['log_file'], maxBytes=1e6, backupCount=2, encoding='utf-8')
@@ -129,7 +148,7 @@ def run_web_server():
             if not data or (not data.get('message') and not data.get('image')):
                 return jsonify({'success': False, 'error': '无效请求'}), 400
 
-            response = chat_system.chat(data.get('message'), data.get('image'))
+            response = chat_system.chat(data.get('message'), data.get('image'), session_id=data.get('session_id'))
             return jsonify({'success': True, 'reply': response})
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 500
@@ -170,113 +189,50 @@ def run_web_server():
     @app.route('/api/monitoring')
     def api_monitoring():
         try:
-            # 添加超时控制
-            timeout = 5.0  # 5秒超时
-            
-            # 获取CPU使用率，使用更短的间隔以获得更准确的数据
-            # 第一次调用返回0.0，第二次调用返回实际使用率
-            psutil.cpu_percent(interval=None)  # 初始化测量
-            time.sleep(0.1)  # 短暂等待
-            cpu_percent = psutil.cpu_percent(interval=None)  # 获取实际使用率
-            
-            # 获取内存信息
-            memory = psutil.virtual_memory()
-            memory_percent = memory.percent
-            
-            # 获取磁盘使用情况
-            try:
-                disk = psutil.disk_usage('/')
-            except:
-                disk = psutil.disk_usage('C:\\')  # Windows fallback
-            
-            # 获取网络IO统计信息
-            net_io = psutil.net_io_counters()
-            
-            # 获取系统启动时间
-            boot_time = psutil.boot_time()
-            
-            # 获取系统负载（在Windows上此值可能为None）
-            try:
-                load_avg = psutil.getloadavg()
-            except AttributeError:
-                load_avg = (0, 0, 0)  # Windows不支持此功能
-            
-            # 获取用户友好的CPU名称
-            def get_cpu_name():
-                try:
-                    if platform.system() == "Windows":
-                        result = subprocess.run(["wmic", "cpu", "get", "name"], 
-                                              capture_output=True, text=True, timeout=3)
-                        # 解析输出，获取CPU名称
-                        lines = result.stdout.strip().split('\n')
-                        # 过滤掉空行
-                        non_empty_lines = [line.strip() for line in lines if line.strip()]
-                        if len(non_empty_lines) > 1:
-                            return non_empty_lines[1]  # 第二行是CPU名称
-                    elif platform.system() == "Linux":
-                        with open('/proc/cpuinfo', 'r') as f:
-                            for line in f:
-                                if line.startswith('model name'):
-                                    return line.split(':')[1].strip()
-                    elif platform.system() == "Darwin":  # macOS
-                        result = subprocess.run(["sysctl", "-n", "machdep.cpu.brand_string"], 
-                                              capture_output=True, text=True, timeout=3)
-                        return result.stdout.strip()
-                except Exception:
-                    pass
-                # 如果无法获取CPU名称，返回默认值
-                return platform.processor()
-            
+            # 系统指标由后台线程定时采集，这里只读取最近一次的结果
+            sampler = get_sampler()
+            sample = sampler.latest()
+            if sample is None:
+                return jsonify({'error': '系统指标尚未采集完成'}), 503
+            memory = sample['memory']
+            disk = sample['disk']
+            load_avg = sample['load_avg']
+            cpu_percent = sample['cpu_percent']
+            cpu_per_core = sample['cpu_per_core']
+            memory_percent = sample['memory_percent']
+            memory_details = memory
+
             # 获取系统信息
-            system_info = {
-                'cpu': get_cpu_name(),
-                'cpu_count': psutil.cpu_count(),
-                'total_memory': memory.total,
-                'used_memory': memory.used,
-                'available_memory': memory.available,
-                'memory_unit': memory_percent,
-                'total_disk': disk.total,
-                'used_disk': disk.used,
-                'free_disk': disk.free,
-                'disk_percent': (disk.used / disk.total) * 100,
-                'net_bytes_sent': net_io.bytes_sent,
-                'net_bytes_recv': net_io.bytes_recv,
-                'boot_time': boot_time,
-                'load_avg_1min': load_avg[0],
-                'load_avg_5min': load_avg[1],
-                'load_avg_15min': load_avg[2],
-                'python_version': platform.python_version(),
-                'platform': platform.platform()
-            }
+            system_info = dict(
+                sampler.static,
+                total_memory=memory['total'],
+                used_memory=memory['used'],
+                available_memory=memory['available'],
+                memory_unit=memory_percent,
+                total_disk=disk['total'],
+                used_disk=disk['used'],
+                free_disk=disk['free'],
+                disk_percent=disk['percent'],
+                net_bytes_sent=sample['net']['bytes_sent'],
+                net_bytes_recv=sample['net']['bytes_recv'],
+                net_sent_per_second=sample['net']['sent_per_second'],
+                net_recv_per_second=sample['net']['recv_per_second'],
+                load_avg_1min=load_avg[0],
+                load_avg_5min=load_avg[1],
+                load_avg_15min=load_avg[2],
+                sampled_at=sample['timestamp']
+            )
             
             # 计算运行时间
             uptime = time.time() - START_TIME
             
             # Token统计信息
+            input_tokens = INPUT_TOKENS + METRICS.get('input_tokens')
+            output_tokens = OUTPUT_TOKENS + METRICS.get('output_tokens')
             token_stats = {
-                'input_tokens': INPUT_TOKENS,
-                'output_tokens': OUTPUT_TOKENS,
-                'total_tokens': INPUT_TOKENS + OUTPUT_TOKENS
-            }
-            
-            # 获取每个CPU核心的使用率
-            # 对于每个核心也使用更短的测量间隔
-            psutil.cpu_percent(interval=None, percpu=True)  # 初始化测量
-            time.sleep(0.1)  # 短暂等待
-            cpu_per_core = psutil.cpu_percent(interval=None, percpu=True)  # 获取实际使用率
-            
-            # 获取详细的内存信息
-            memory_details = {
-                'total': memory.total,
-                'available': memory.available,
-                'percent': memory.percent,
-                'used': memory.used,
-                'free': memory.free,
-                'active': getattr(memory, 'active', 0),
-                'inactive': getattr(memory, 'inactive', 0),
-                'buffers': getattr(memory, 'buffers', 0),
-                'cached': getattr(memory, 'cached', 0),
-                'shared': getattr(memory, 'shared', 0)
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens
             }
             
             return jsonify({
@@ -286,70 +242,154 @@ def run_web_server():
                 'memory_details': memory_details,
                 'system_info': system_info,
                 'uptime': uptime,
-                'token_stats': token_stats
+                'token_stats': token_stats,
+                'cache_stats': {
+                    'response_cache': chat_system.response_cache.stats(),
+                    'search_cache': dict(chat_system.get_search_cache().stats(),
+                                         bytes_saved=METRICS.get('search_cache_bytes_saved')),
+                    'image_cache': dict(chat_system.get_image_cache().stats(),
+                                        bytes_saved=METRICS.get('image_cache_bytes_saved'))
+                },
+                'http_clients': http_client_stats(),
+                'db_pool': db_pool_stats(),
+                'metrics': METRICS.snapshot()
             })
         except Exception as e:
             app.logger.error(f"获取监控数据时出错: {str(e)}")
             return jsonify({'error': str(e)}), 500
 
+    @app.route('/api/monitoring/history')
+    def api_monitoring_history():
+        """获取监控指标的历史
+
+        查询参数：metric（逗号分隔的指标名，默认全部）、range（时间范围，如600、10m、1h、24h，默认10m）。
+        按时间范围自动选择分辨率，每个数据点为[时间戳, 最小值, 平均值, 最大值]。
+        """
+        store = get_timeseries()
+        try:
+            seconds = parse_range(request.args.get('range', '10m'), store.max_span)
+        except ValueError:
+            return jsonify({'error': '无效的range参数'}), 400
+        names = [name for name in request.args.get('metric', '').split(',') if name] or list(SERIES)
+        unknown = [name for name in names if name not in SERIES]
+        if unknown:
+            return jsonify({'error': f"未知的指标: {', '.join(unknown)}", 'metrics': SERIES}), 400
+
+        series = {}
+        step = None
+        for name in names:
+            result = store.query(name, seconds)
+            step = result['step']
+            series[name] = [list(point) for point in result['points']]
+        return jsonify({'range': seconds, 'step': step, 'series': series})
+
     # 后端获取记录
     @app.route('/api/records')
     def api_records():
-        from src.database import DatabaseManager
-        db_manager = DatabaseManager()
+        """按ID游标分页获取聊天记录
+
+        查询参数：limit、after_id、before_id、since/until（ISO时间）、
+        columns（逗号分隔的字段名）、order（asc或desc）；翻页时只需传入上一页响应头
+        X-Next-Cursor中的cursor。响应体仍是记录数组，没有下一页时不返回该响应头。
+        """
+        from src.database import cursor_arguments
+        # 复用聊天系统的DatabaseManager，连接从共享连接池借用
+        db_manager = chat_system.db
         try:
-            # 减少默认查询数量，提高响应速度
-            limit = min(int(request.args.get('limit', 50)), 100)  # 限制最大100条记录
-            rows = db_manager.get_chat_history(limit=limit)
-            return jsonify(rows)
+            if request.args.get('cursor'):
+                arguments = cursor_arguments(request.args['cursor'])
+            else:
+                arguments = {
+                    'after_id': request.args.get('after_id', type=int),
+                    'before_id': request.args.get('before_id', type=int),
+                    'ascending': request.args.get('order', 'desc') == 'asc',
+                    'limit': request.args.get('limit', 50, type=int),
+                }
+                for key in ('since', 'until'):
+                    if request.args.get(key):
+                        arguments[key] = datetime.fromisoformat(request.args[key])
+                if request.args.get('columns'):
+                    arguments['columns'] = request.args['columns'].split(',')
+            # 减少单页查询数量，提高响应速度
+            arguments['limit'] = max(1, min(arguments['limit'], 100))  # 限制最大100条记录
+            rows, next_cursor = db_manager.get_chat_history_page(**arguments)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             app.logger.error(f"获取聊天记录时出错: {str(e)}")
-            return jsonify([]) 
-        finally:
-            db_manager.close()
+            return jsonify([])
+        response = jsonify(rows)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    @app.route('/api/records/search')
+    def api_search_records():
+        """按关键词检索聊天记录
+
+        查询参数：q（多个关键词用空格分隔）、limit；翻页时只需传入上一页响应头
+        X-Next-Cursor中的cursor。
+        """
+        from src.database import decode_cursor
+        db_manager = chat_system.db
+        try:
+            if request.args.get('cursor'):
+                state = decode_cursor(request.args['cursor'])
+                query = str(state.get('q', ''))
+                limit = int(state.get('limit', 50))
+                before_id = int(state['before_id'])
+            else:
+                query = request.args.get('q', '')
+                limit = request.args.get('limit', 50, type=int)
+                before_id = None
+            limit = max(1, min(limit, 100))
+            rows, next_cursor = db_manager.search_chat_history(query, limit=limit, before_id=before_id)
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': f"无效的游标: {request.args.get('cursor')}"}), 400
+        except Exception as e:
+            app.logger.error(f"检索聊天记录时出错: {str(e)}")
+            return jsonify([])
+        response = jsonify(rows)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
 
     @app.route('/api/delete_record', methods=['POST'])
     def api_del_record():
         data = request.get_json()
         rid = data.get('id')
-        from src.database import DatabaseManager
-        db_manager = DatabaseManager()
+        # 复用聊天系统的DatabaseManager，连接从共享连接池借用
+        db_manager = chat_system.db
         try:
             db_manager.delete_chat_record(rid)
             return jsonify({'message': 'ok'})
         except Exception as e:
             app.logger.error(f"删除聊天记录时出错: {str(e)}")
             return jsonify({'message': 'error'}), 500
-        finally:
-            db_manager.close()
 
     @app.route('/api/clear_records', methods=['POST'])
     def api_clear():
-        from src.database import DatabaseManager
-        db_manager = DatabaseManager()
+        # 复用聊天系统的DatabaseManager，连接从共享连接池借用
+        db_manager = chat_system.db
         try:
             db_manager.clear_chat_history()
             return jsonify({'message': 'cleared'})
         except Exception as e:
             app.logger.error(f"清空聊天记录时出错: {str(e)}")
             return jsonify({'message': 'error'}), 500
-        finally:
-            db_manager.close()
 
     @app.route('/api/delete_first_n', methods=['POST'])
     def api_del_n():
         data = request.get_json()
         n = data.get('n', 0)
-        from src.database import DatabaseManager
-        db_manager = DatabaseManager()
+        # 复用聊天系统的DatabaseManager，连接从共享连接池借用
+        db_manager = chat_system.db
         try:
             db_manager.delete_first_n_records(n)
             return jsonify({'message': 'deleted_first_n'})
         except Exception as e:
             app.logger.error(f"删除前N条聊天记录时出错: {str(e)}")
             return jsonify({'message': 'error'}), 500
-        finally:
-            db_manager.close()
 
     # 启动模式
     @app.route('/api/run_mode', methods=['POST'])
@@ -575,13 +615,12 @@ def run_web_server():
             
             # 从数据库获取角色信息
             try:
-                from src.reset_database import get_connection
+                from src.database import get_connection, table_exists
                 conn = get_connection()
                 if conn:
                     cur = conn.cursor()
-                    # 检查表是否存在
-                    cur.execute("SHOW TABLES LIKE 'character_info'")
-                    if cur.fetchone():
+                    # 检查表是否存在（结果有缓存）
+                    if table_exists(cur, 'character_info'):
                         cur.execute("SELECT name, personality, brother_qqid, height, weight, catchphrases FROM character_info WHERE name = '小雫'")
                         row = cur.fetchone()
                         if row:
@@ -622,28 +661,28 @@ def run_web_server():
             # 更新角色配置到数据库
             if 'character' in new_config:
                 try:
-                    from src.reset_database import get_connection
+                    from src.database import get_connection, table_exists
                     conn = get_connection()
                     if conn:
                         cur = conn.cursor()
-                        # 检查表是否存在
-                        cur.execute("SHOW TABLES LIKE 'character_info'")
-                        if cur.fetchone():
+                        # 检查表是否存在（结果有缓存）
+                        if table_exists(cur, 'character_info'):
                             # 先检查是否有记录
-                            cur.execute("SELECT COUNT(*) FROM character_info")
-                            count = cur.fetchone()[0]
-                            if count > 0:
-                                # 如果存在记录，则更新第一条记录
+                            cur.execute("SELECT id FROM character_info ORDER BY id LIMIT 1")
+                            first = cur.fetchone()
+                            if first:
+                                # 如果存在记录，则更新第一条记录（按ID更新，MySQL和SQLite存储后端通用）
                                 cur.execute("""UPDATE character_info 
                                              SET name = %s, personality = %s, brother_qqid = %s, 
                                                  height = %s, weight = %s, catchphrases = %s 
-                                             LIMIT 1""", (
+                                             WHERE id = %s""", (
                                     new_config['character'].get('name', 'Default Character'),
                                     new_config['character'].get('personality', ''),
                                     new_config['character'].get('brother_qqid', ''),
                                     new_config['character'].get('height', ''),
                                     new_config['character'].get('weight', ''),
-                                    new_config['character'].get('catchphrases', '')
+                                    new_config['character'].get('catchphrases', ''),
+                                    first[0]
                                 ))
                             else:
                                 # 如果没有记录，则插入新记录
@@ -665,6 +704,8 @@ def run_web_server():
             # 更新数据库配置（在内存中）
             if 'database' in new_config:
                 CONFIG['database'].update(new_config['database'])
+                # 丢弃按旧配置建立的连接，下次借用时按新配置重新连接
+                reset_pool()
             
             # 写入配置文件
             with open(config_path, 'w', encoding='utf-8') as f:
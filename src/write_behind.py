@@ -0,0 +1,167 @@
+"""延迟写入模块，把聊天记录放入有界队列，由后台线程批量写入数据库"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Tuple
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# 通知后台线程退出的哨兵
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """后台批量写入器
+
+    submit()把一行数据放入队列后立即返回；后台线程攒够batch_size行或等待
+    flush_interval秒后调用一次flush_rows批量写入。队列最多保存max_pending行，
+    队列满时调用方最多阻塞put_timeout秒（背压），仍然放不进去时改为同步写入，
+    保证数据不丢失。写入失败时按retry_backoff、2*retry_backoff……的间隔重试max_retries次，
+    仍然失败时逐行写入，一行数据有问题不会连累同一批的其他行。
+    进程退出时（close()或atexit）会写完队列中剩余的数据。
+    """
+
+    def __init__(self, flush_rows: Callable[[List[Tuple]], None], batch_size: int = 50,
+                 flush_interval: float = 0.5, max_pending: int = 10000, put_timeout: float = 5,
+                 max_retries: int = 3, retry_backoff: float = 0.5):
+        self.flush_rows = flush_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        # 正在往队列中放入数据的调用方数量；close()等它们都放完之后才放入_STOP，
+        # 锁只保护这两个字段，阻塞的put不在锁内执行
+        self._submitting = 0
+        self._submit_lock = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, row: Tuple):
+        """提交一行数据
+
+        Args:
+            row (tuple): 传给flush_rows的一行数据
+        """
+        with self._submit_lock:
+            closed = self._closed
+            if not closed:
+                self._submitting += 1
+
+        queued = False
+        if not closed:
+            try:
+                # 多个调用方可以同时等待队列空位，每个最多等待put_timeout秒
+                self._queue.put(row, timeout=self.put_timeout)
+                queued = True
+            except queue.Full:
+                # 数据库跟不上写入速度，由调用方同步写入
+                METRICS.incr('write_behind_sync_fallback')
+            finally:
+                with self._submit_lock:
+                    self._submitting -= 1
+                    if not self._submitting:
+                        self._submit_lock.notify_all()
+        if not queued:
+            self._write([row])
+            return
+        METRICS.incr('write_behind_queued')
+        METRICS.set_gauge('write_behind_pending', self._queue.qsize())
+
+    def _write(self, rows):
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # 数据库暂时不可用（断线、锁等待超时等）时退避后重试
+                METRICS.incr('write_behind_retries')
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                self.flush_rows(rows)
+                METRICS.incr('write_behind_batches')
+                METRICS.incr('write_behind_rows', len(rows))
+                break
+            except Exception as e:
+                logger.warning("批量写入聊天记录失败（%d条，第%d次）: %s", len(rows), attempt + 1, e)
+        else:
+            self._write_each(rows)
+        METRICS.incr('write_behind_flush_seconds', time.perf_counter() - start)
+
+    def _write_each(self, rows):
+        """整批重试后仍然失败时逐行写入，只丢弃本身写不进去的行"""
+        for row in rows:
+            try:
+                self.flush_rows([row])
+                METRICS.incr('write_behind_rows')
+            except Exception as e:
+                METRICS.incr('write_behind_failed_rows')
+                logger.error("写入聊天记录失败，已丢弃: %r: %s", row, e)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                self._queue.task_done()
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+            METRICS.set_gauge('write_behind_pending', self._queue.qsize())
+
+        # 退出前写完队列中剩余的数据
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rest.append(item)
+            self._queue.task_done()
+        for i in range(0, len(rest), self.batch_size):
+            self._write(rest[i:i + self.batch_size])
+        METRICS.set_gauge('write_behind_pending', 0)
+
+    def flush(self):
+        """等待队列中已提交的数据全部写入"""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        """写完剩余数据并停止后台线程（可以重复调用）"""
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            # 等待已经开始的submit放完数据，_STOP之后不会再有数据进入队列
+            self._submit_lock.wait_for(lambda: not self._submitting)
+        self._queue.put(_STOP)
+        self._thread.join()